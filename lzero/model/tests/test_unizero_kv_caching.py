@@ -0,0 +1,106 @@
+import numpy as np
+import pytest
+import torch
+
+from lzero.model.unizero_world_models.modeling.kv_caching import KeysValues, QuantizedKeysValues
+from lzero.model.unizero_world_models.utils import copy_kv_cache_into
+
+n, num_heads, max_tokens, embed_dim, num_layers = 2, 2, 8, 16, 3
+head_dim = embed_dim // num_heads
+device = torch.device('cpu')
+
+
+def make_keys_values(num_tokens: int) -> KeysValues:
+    kv = KeysValues(n, num_heads, max_tokens, embed_dim, num_layers, device)
+    for kv_cache in kv:
+        if num_tokens > 0:
+            kv_cache.update(
+                torch.randn(n, num_heads, num_tokens, head_dim), torch.randn(n, num_heads, num_tokens, head_dim)
+            )
+    return kv
+
+
+@pytest.mark.unittest
+class TestQuantizedKeysValues:
+
+    def test_empty_round_trip(self):
+        src = make_keys_values(0)
+        snapshot = QuantizedKeysValues(n, num_heads, max_tokens, embed_dim, num_layers, device)
+        snapshot.quantize_from(src)
+        assert snapshot.size == 0
+        assert torch.all(snapshot._scale == 1)
+        dst = make_keys_values(3)
+        copy_kv_cache_into(dst, snapshot)
+        assert dst.size == 0
+
+    @pytest.mark.parametrize('num_tokens', [1, 5, max_tokens])
+    def test_round_trip(self, num_tokens):
+        src = make_keys_values(num_tokens)
+        snapshot = QuantizedKeysValues(n, num_heads, max_tokens, embed_dim, num_layers, device)
+        copy_kv_cache_into(snapshot, src)
+        assert snapshot.size == num_tokens
+        dst = make_keys_values(0)
+        copy_kv_cache_into(dst, snapshot)
+        assert dst.size == num_tokens
+        for src_cache, dst_cache in zip(src, dst):
+            for src_tensor, dst_tensor in zip(src_cache.get(), dst_cache.get()):
+                # Symmetric int8 quantization is exact up to half a step of amax / 127 per (sample, head).
+                tolerance = src_tensor.abs().amax(dim=(-2, -1), keepdim=True) / 127.
+                assert torch.all((src_tensor - dst_tensor).abs() <= tolerance * 0.5 + 1e-6)
+
+    def test_empty_after_non_empty(self):
+        snapshot = QuantizedKeysValues(n, num_heads, max_tokens, embed_dim, num_layers, device)
+        copy_kv_cache_into(snapshot, make_keys_values(4))
+        copy_kv_cache_into(snapshot, make_keys_values(0))
+        assert snapshot.size == 0
+        assert torch.all(snapshot._scale == 1)
+
+
+@pytest.mark.unittest
+class TestStackedKeysValues:
+
+    def test_new_cache_is_stacked(self):
+        kv = make_keys_values(3)
+        assert kv.is_stacked()
+        assert kv.size == 3
+        assert kv._buffer.shape == (num_layers, 2, n, num_heads, max_tokens, head_dim)
+        for layer, kv_cache in enumerate(kv):
+            k, v = kv_cache.get()
+            assert torch.equal(kv._buffer[layer, 0, :, :, :3], k)
+            assert torch.equal(kv._buffer[layer, 1, :, :, :3], v)
+
+    def test_sample_views_the_storage(self):
+        kv = make_keys_values(3)
+        view = kv.sample(1)
+        assert view.n == 1 and view.size == 3 and view.is_stacked()
+        assert torch.equal(view._buffer[:, :, 0], kv._buffer[:, :, 1])
+        view._buffer.zero_()
+        assert torch.all(kv._buffer[:, :, 1] == 0)
+        assert torch.any(kv._buffer[:, :, 0] != 0)
+
+    def test_bind_buffer_keeps_sizes(self):
+        kv = make_keys_values(4)
+        expected = [kv_cache.get() for kv_cache in kv]
+        kv._bind_buffer(kv._buffer.clone())
+        assert kv.is_stacked() and kv.size == 4
+        for kv_cache, (k, v) in zip(kv, expected):
+            assert torch.equal(kv_cache.get()[0], k)
+            assert torch.equal(kv_cache.get()[1], v)
+
+    def test_replaced_caches_are_not_stacked(self):
+        kv = make_keys_values(2)
+        kv.prune(np.array([True, False]))
+        assert not kv.is_stacked()
+        kv._bind_buffer(kv._buffer)
+        assert kv.is_stacked()
+
+    def test_copy_between_stacked_and_unstacked(self):
+        src = make_keys_values(5)
+        dst = make_keys_values(0)
+        dst[0]._k_cache._cache = dst[0]._k_cache._cache.clone()
+        assert not dst.is_stacked()
+        copy_kv_cache_into(dst, src)
+        assert dst.size == 5
+        for src_cache, dst_cache in zip(src, dst):
+            assert torch.equal(src_cache.get()[0], dst_cache.get()[0])
+            assert torch.equal(src_cache.get()[1], dst_cache.get()[1])
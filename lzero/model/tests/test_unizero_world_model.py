@@ -0,0 +1,256 @@
+import numpy as np
+import pytest
+import torch
+from easydict import EasyDict
+from torch.distributions import Categorical
+
+from lzero.model.unizero_model import UniZeroModel
+from lzero.model.unizero_world_models.utils import copy_kv_cache_into
+from lzero.model.unizero_world_models.world_model import WorldModel
+from lzero.policy.unizero import UniZeroPolicy
+
+embed_dim = 64
+action_space_size = 2
+
+
+def build_world_model(device: str = 'cpu', **overrides):
+    world_model_cfg = EasyDict(UniZeroPolicy.default_config().model.world_model_cfg)
+    world_model_cfg.update(
+        dict(
+            obs_type='vector',
+            device=device,
+            action_space_size=action_space_size,
+            num_layers=2,
+            num_heads=2,
+            embed_dim=embed_dim,
+            max_blocks=5,
+            max_tokens=2 * 5,
+            context_length=2 * 4,
+            num_unroll_steps=5,
+            env_num=4,
+            support_size=21,
+            aha=False,
+            interleave_local_causal=False,
+            local_window_size=8,
+            adaptive_span_regularization=0.,
+            gaam_span_diversity_coeff=0.,
+        )
+    )
+    world_model_cfg.update(overrides)
+    model = UniZeroModel(
+        observation_shape=4, action_space_size=action_space_size, norm_type='LN', world_model_cfg=world_model_cfg
+    )
+    world_model = model.world_model.to(device)
+    world_model.eval()
+    return world_model
+
+
+def reset_pass(world_model, obs_embeddings):
+    keys_values = world_model.transformer.generate_empty_keys_values(
+        n=obs_embeddings.shape[0], max_tokens=world_model.context_length
+    )
+    with torch.no_grad():
+        return world_model.forward({'obs_embeddings': obs_embeddings}, past_keys_values=keys_values, is_init_infer=True)
+
+
+def assert_outputs_close(actual, expected):
+    for name in ('output_sequence', 'logits_observations', 'logits_rewards', 'logits_policy', 'logits_value'):
+        torch.testing.assert_close(getattr(actual, name), getattr(expected, name), rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.unittest
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='CUDA graphs need a CUDA device')
+class TestWorldModelCudaGraphs:
+
+    def eager_and_graphed(self, world_model, obs_embeddings):
+        world_model.cuda_graph_miss_reset = False
+        eager = reset_pass(world_model, obs_embeddings)
+        world_model.cuda_graph_miss_reset = True
+        graphed = reset_pass(world_model, obs_embeddings)
+        return eager, graphed
+
+    def test_replay_after_optimizer_step(self):
+        world_model = build_world_model('cuda')
+        obs_embeddings = torch.randn(4, 1, embed_dim, device='cuda')
+        eager, graphed = self.eager_and_graphed(world_model, obs_embeddings)
+        assert len(world_model._cuda_graphs) == 1
+        assert_outputs_close(graphed, eager)
+
+        optimizer = torch.optim.SGD(world_model.parameters(), lr=0.1)
+        for param in world_model.parameters():
+            param.grad = torch.randn_like(param)
+        optimizer.step()
+
+        eager_after, graphed_after = self.eager_and_graphed(world_model, obs_embeddings)
+        # The in-place update is seen by the replay of the graph captured before the step.
+        assert len(world_model._cuda_graphs) == 1
+        assert not torch.allclose(eager_after.logits_policy, eager.logits_policy)
+        assert_outputs_close(graphed_after, eager_after)
+
+    def test_recapture_after_storage_change(self):
+        world_model = build_world_model('cuda')
+        obs_embeddings = torch.randn(4, 1, embed_dim, device='cuda')
+        self.eager_and_graphed(world_model, obs_embeddings)
+        graph = next(iter(world_model._cuda_graphs.values()))[0]
+
+        # Moving the model replaces the storages the graph reads, so the graph must be captured again.
+        world_model.to('cpu').to('cuda')
+        assert len(world_model._cuda_graphs) == 0
+
+        eager, graphed = self.eager_and_graphed(world_model, obs_embeddings)
+        assert next(iter(world_model._cuda_graphs.values()))[0] is not graph
+        assert_outputs_close(graphed, eager)
+
+    def test_load_state_dict_clears_graphs(self):
+        world_model = build_world_model('cuda')
+        obs_embeddings = torch.randn(4, 1, embed_dim, device='cuda')
+        self.eager_and_graphed(world_model, obs_embeddings)
+        state_dict = {k: v + 0.1 if v.is_floating_point() else v for k, v in world_model.state_dict().items()}
+        world_model.load_state_dict(state_dict)
+        assert len(world_model._cuda_graphs) == 0
+        eager, graphed = self.eager_and_graphed(world_model, obs_embeddings)
+        assert_outputs_close(graphed, eager)
+
+    def test_recurrent_step_copies_valid_tokens(self):
+        world_model = build_world_model('cuda')
+        world_model.cuda_graph_miss_reset = True
+        keys_values = world_model.transformer.generate_empty_keys_values(n=4, max_tokens=world_model.context_length)
+        with torch.no_grad():
+            for step in range(3):
+                obs_embeddings = torch.randn(4, 1, embed_dim, device='cuda')
+                reference = world_model.transformer.generate_empty_keys_values(
+                    n=4, max_tokens=world_model.context_length
+                )
+                copy_kv_cache_into(reference, keys_values)
+                outputs = world_model._graphed_forward_core(obs_embeddings, keys_values, None, 1, step)
+                expected = WorldModel._forward_core(
+                    world_model, obs_embeddings, reference, False, None, None, 1, step, None, False
+                )
+                assert keys_values.size == reference.size == step + 1
+                for actual, wanted in zip(outputs, expected):
+                    torch.testing.assert_close(actual, wanted, rtol=1e-4, atol=1e-4)
+                for kv_cache, reference_kv_cache in zip(keys_values, reference):
+                    for actual, wanted in zip(kv_cache.get(), reference_kv_cache.get()):
+                        torch.testing.assert_close(actual, wanted, rtol=1e-4, atol=1e-4)
+
+    def test_graph_cache_is_bounded(self):
+        world_model = build_world_model('cuda', cuda_graph_max_graphs=2)
+        world_model.cuda_graph_miss_reset = True
+        for batch_size in (1, 2, 4):
+            reset_pass(world_model, torch.randn(batch_size, 1, embed_dim, device='cuda'))
+        assert len(world_model._cuda_graphs) == 2
+        # The least recently replayed signature, batch size 1, was released.
+        assert [key[0][0] for key in world_model._cuda_graphs] == [2, 4]
+
+
+@pytest.mark.unittest
+class TestWorldModelMissRows:
+
+    @pytest.mark.parametrize(
+        'miss_indices, expected', [
+            ([3], [3]),
+            ([0, 2], [0, 2]),
+            ([0, 1, 5], [0, 1, 5, 5]),
+            ([0, 1, 2, 3, 4], [0, 1, 2, 3, 4, 4, 4, 4]),
+        ]
+    )
+    def test_pad_miss_rows(self, miss_indices, expected):
+        world_model = build_world_model()
+        assert world_model._pad_miss_rows(miss_indices) == miss_indices
+        world_model.cuda_graph_miss_reset = True
+        assert world_model._pad_miss_rows(miss_indices) == expected
+
+
+@pytest.mark.unittest
+class TestWorldModelRootCacheMiss:
+
+    def continue_episode(self, world_model, last_obs_embeddings, current_obs_embeddings, timestep):
+        with torch.no_grad():
+            return world_model.wm_forward_for_initial_infererence(
+                last_obs_embeddings, batch_action=[0, 1, 1, 0], current_obs_embeddings=current_obs_embeddings,
+                start_pos=timestep
+            )
+
+    def test_miss_with_list_timestep(self):
+        world_model = build_world_model()
+        last_obs_embeddings = torch.randn(4, 1, embed_dim)
+        current_obs_embeddings = torch.randn(4, 1, embed_dim)
+        # The collector passes the timesteps as a list of numpy scalars.
+        timestep = [np.int64(t) for t in (3, 0, 7, 2)]
+        outputs = self.continue_episode(world_model, last_obs_embeddings, current_obs_embeddings, timestep)
+        assert world_model.root_total_query_cnt == 4 and world_model.root_hit_cnt == 0
+        assert outputs.logits_policy.shape[0] == 4
+
+        reference = build_world_model()
+        reference.load_state_dict(world_model.state_dict())
+        expected = self.continue_episode(reference, last_obs_embeddings, current_obs_embeddings, np.array(timestep))
+        assert_outputs_close(outputs, expected)
+
+
+@pytest.mark.unittest
+class TestWorldModelLossHelpers:
+
+    def test_first_middle_last_means(self):
+        losses = torch.randn(4, 6, 10)
+        mask_padding = torch.rand(6, 10) > 0.3
+        mask_padding[0] = True
+        means = WorldModel._first_middle_last_means(losses, mask_padding)
+        assert means.shape == (4, 3)
+        for column, step in enumerate((0, 5, 9)):
+            expected = losses[:, mask_padding[:, step], step].mean(dim=1)
+            torch.testing.assert_close(means[:, column], expected)
+
+    def test_first_middle_last_means_fully_padded_step(self):
+        losses = torch.randn(2, 3, 4)
+        mask_padding = torch.ones(3, 4, dtype=torch.bool)
+        mask_padding[:, -1] = False
+        means = WorldModel._first_middle_last_means(losses, mask_padding)
+        assert torch.isnan(means[:, 2]).all()
+        assert not torch.isnan(means[:, :2]).any()
+
+    @pytest.mark.parametrize('num_categories', [2, 9])
+    def test_masked_categorical_entropy(self, num_categories):
+        probs = torch.rand(32, num_categories)
+        probs[0, 0] = 0.
+        mask = torch.rand(32) > 0.4
+        mask[0] = True
+        # A padded, all-zero target row is not a valid distribution and must be selected out.
+        probs[1] = 0.
+        mask[1] = False
+        entropy = WorldModel._masked_categorical_entropy(probs, mask)
+        expected = Categorical(probs=probs[mask]).entropy().mean()
+        torch.testing.assert_close(entropy, expected)
+
+    def test_masked_categorical_entropy_without_valid_rows(self):
+        entropy = WorldModel._masked_categorical_entropy(torch.zeros(4, 3), torch.zeros(4, dtype=torch.bool))
+        assert entropy.item() == 0.
+
+
+@pytest.mark.unittest
+class TestIndependentTransformerPass:
+
+    def make_cache(self, world_model, size):
+        keys_values = world_model.transformer.generate_empty_keys_values(n=1, max_tokens=world_model.context_length)
+        if size > 0:
+            world_model.transformer(torch.randn(1, size, embed_dim), keys_values)
+        return keys_values
+
+    def clone_cache(self, world_model, keys_values):
+        clone = world_model.transformer.generate_empty_keys_values(n=1, max_tokens=world_model.context_length)
+        return copy_kv_cache_into(clone, keys_values)
+
+    @pytest.mark.parametrize('sizes, num_tokens', [([2, 2, 2], 1), ([0, 3, 6], 1), ([1, 4, 5], 2)])
+    def test_matches_unbatched_passes(self, sizes, num_tokens):
+        world_model = build_world_model()
+        sequences = torch.randn(len(sizes), num_tokens, embed_dim)
+        with torch.no_grad():
+            caches = [self.make_cache(world_model, size) for size in sizes]
+            reference_caches = [self.clone_cache(world_model, cache) for cache in caches]
+            x = world_model._independent_transformer_pass(sequences, caches, None)
+            for i, reference_cache in enumerate(reference_caches):
+                expected = world_model.transformer(sequences[i:i + 1], reference_cache)
+                torch.testing.assert_close(x[i:i + 1], expected, rtol=1e-4, atol=1e-5)
+                assert caches[i].size == sizes[i] + num_tokens
+                for kv_cache, reference_kv_cache in zip(caches[i], reference_cache):
+                    for actual, reference in zip(kv_cache.get(), reference_kv_cache.get()):
+                        torch.testing.assert_close(actual, reference, rtol=1e-4, atol=1e-5)
@@ -0,0 +1,188 @@
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+
+from lzero.model.unizero_world_models.slicer import FusedHeads, Head
+from lzero.model.unizero_world_models.modeling.kv_caching import KeysValues
+from lzero.model.unizero_world_models.utils import KVCacheIndexTable, LossWithIntermediateLosses, \
+    calculate_cuda_memory_gb, convert_to_depth, custom_copy_kv_cache, hash_state, hash_states
+
+
+@pytest.mark.unittest
+class TestHashStates:
+
+    @pytest.mark.parametrize('shape', [(1, 8), (16, 64), (4, 2, 3)])
+    def test_tensor_and_numpy_consistency(self, shape):
+        states = torch.randn(*shape)
+        assert hash_states(states) == hash_states(states.numpy())
+        assert hash_states(states.double()) == hash_states(states.numpy())
+
+    def test_deterministic(self):
+        states = torch.randn(8, 32)
+        assert hash_states(states) == hash_states(states.clone())
+
+    def test_rows_are_hashed_independently(self):
+        states = torch.randn(8, 32)
+        keys = hash_states(states)
+        assert keys[3] == hash_states(states[3:4])[0]
+
+    def test_no_structured_collisions(self):
+        # Swapping, shifting or scaling the elements of a row must change its key; a linear weighted sum of the
+        # element bits collides on such structured perturbations.
+        base = torch.randn(1, 64)
+        variants = [
+            base,
+            base.flip(1),
+            base.roll(1, dims=1),
+            base * 2,
+            base + 1e-6,
+            torch.cat([base[:, 1:2], base[:, 0:1], base[:, 2:]], dim=1),
+        ]
+        keys = hash_states(torch.cat(variants))
+        assert len(set(keys)) == len(variants)
+
+    def test_single_state_matches_batch(self):
+        states = torch.randn(3, 8)
+        assert [hash_state(state) for state in states] == hash_states(states)
+        assert hash_state(states[1].numpy()) == hash_states(states)[1]
+
+    def test_no_collisions_on_random_states(self):
+        states = torch.randn(4096, 16)
+        assert len(set(hash_states(states))) == len(states)
+        small_ints = np.arange(4096, dtype=np.float32).reshape(-1, 1).repeat(4, axis=1)
+        assert len(set(hash_states(small_ints))) == len(small_ints)
+
+
+@pytest.mark.unittest
+class TestKVCacheHelpers:
+
+    def make_keys_values(self, num_tokens):
+        kv = KeysValues(2, 2, 8, 16, 3, torch.device('cpu'))
+        for kv_cache in kv:
+            kv_cache.update(torch.randn(2, 2, num_tokens, 8), torch.randn(2, 2, num_tokens, 8))
+        return kv
+
+    @pytest.mark.parametrize('dtype', [None, torch.bfloat16])
+    def test_custom_copy_kv_cache(self, dtype):
+        src = self.make_keys_values(5)
+        dst = custom_copy_kv_cache(src, dtype=dtype)
+        assert dst is not src and dst.size == 5
+        assert dst._buffer.dtype == (dtype or src._buffer.dtype)
+        torch.testing.assert_close(dst._buffer.float(), src._buffer.to(dst._buffer.dtype).float())
+
+    def test_calculate_cuda_memory_gb(self):
+        kv = self.make_keys_values(1)
+        expected = kv._buffer.numel() * kv._buffer.element_size() / 1024 ** 3
+        assert calculate_cuda_memory_gb({'a': kv, 'b': kv}, num_layers=3) == pytest.approx(2 * expected)
+
+    def test_convert_to_depth(self):
+        # Node 0 is the root, node 1 its child and node 2 the child of node 1.
+        depth_arr, parent_arr = np.zeros(3, dtype=np.int64), np.array([0, 0, 1])
+        last_depth = []
+        convert_to_depth([0, 1], depth_arr, parent_arr, last_depth)
+        convert_to_depth([0, 1, 2], depth_arr, parent_arr, last_depth)
+        assert last_depth == [1, 2]
+
+
+@pytest.mark.unittest
+class TestLossWithIntermediateLosses:
+
+    def test_weighted_total_and_division(self):
+        params = torch.randn(3, requires_grad=True)
+        losses = LossWithIntermediateLosses(
+            loss_obs=params[0] ** 2, loss_value=params[1] ** 2, loss_policy=params[2] ** 2,
+            span_metrics={'span': params[0].detach()}, step=4.
+        )
+        expected = 10 * params[0] ** 2 + 0.5 * params[1] ** 2 + params[2] ** 2
+        torch.testing.assert_close(losses.loss_total, expected)
+        losses = losses / 2
+        torch.testing.assert_close(losses.loss_total, expected / 2)
+        assert losses.intermediate_losses['step'] == 2.
+        torch.testing.assert_close(losses.intermediate_losses['span_metrics']['span'], params[0].detach() / 2)
+        losses.loss_total.backward()
+        torch.testing.assert_close(params.grad, torch.stack([10 * params[0], 0.5 * params[1], params[2]]).detach())
+
+
+@pytest.mark.unittest
+class TestKVCacheIndexTable:
+
+    def test_dict_api(self):
+        table = KVCacheIndexTable(capacity=8)
+        table[3] = 30
+        table[11] = 110  # Collides with key 3 in a table of 8 slots.
+        assert len(table) == 2
+        assert table[3] == 30 and table.get(11) == 110
+        assert 3 in table and 19 not in table
+        assert table.get(19) is None and table.get(19, -5) == -5
+        with pytest.raises(KeyError):
+            table[19]
+        table[3] = 31
+        assert len(table) == 2 and table[3] == 31
+
+    def test_grow(self):
+        table = KVCacheIndexTable(capacity=4)
+        keys = [i * 4 for i in range(100)] + [2 ** 63 - 1, 2 ** 40 + 7]
+        for value, key in enumerate(keys):
+            table[key] = value
+        assert len(table) == len(keys)
+        assert len(table._keys) >= 4 * len(keys) // 3
+        assert [table[key] for key in keys] == list(range(len(keys)))
+
+    def test_get_many(self):
+        table = KVCacheIndexTable(capacity=8)
+        for key in (1, 9, 17, 4):
+            table[key] = key * 10
+        assert table.get_many([9, 2, 17, 1, 25, 4]) == [90, None, 170, 10, None, 40]
+        assert table.get_many([]) == []
+
+    def test_clear(self):
+        table = KVCacheIndexTable(capacity=4)
+        for key in range(10):
+            table[key] = key
+        capacity = len(table._keys)
+        table.clear()
+        assert len(table) == 0
+        assert len(table._keys) == capacity
+        assert table.get_many(list(range(10))) == [None] * 10
+        table[5] = 50
+        assert table[5] == 50 and len(table) == 1
+
+
+@pytest.mark.unittest
+class TestFusedHeads:
+
+    max_blocks, embed_dim = 5, 16
+
+    def make_head(self, output_dim):
+        return Head(
+            max_blocks=self.max_blocks,
+            block_mask=torch.tensor([1, 0]),
+            head_module=nn.Sequential(
+                nn.Linear(self.embed_dim, self.embed_dim), nn.GELU(approximate='tanh'),
+                nn.Linear(self.embed_dim, output_dim)
+            )
+        )
+
+    @pytest.mark.parametrize('num_steps, prev_steps', [(1, 0), (2, 3), (10, 0), (1, 1)])
+    def test_matches_separate_heads(self, num_steps, prev_steps):
+        heads = [self.make_head(6), self.make_head(21)]
+        fused = FusedHeads(heads)
+        x = torch.randn(3, num_steps, self.embed_dim)
+        with torch.no_grad():
+            outputs = fused(x, num_steps=num_steps, prev_steps=prev_steps)
+            for head, output in zip(heads, outputs):
+                expected = head(x, num_steps=num_steps, prev_steps=prev_steps)
+                assert output.shape == expected.shape
+                torch.testing.assert_close(output, expected, rtol=1e-5, atol=1e-5)
+
+    def test_follows_in_place_updates(self):
+        heads = [self.make_head(6), self.make_head(21)]
+        fused = FusedHeads(heads)
+        x = torch.randn(3, 2, self.embed_dim)
+        with torch.no_grad():
+            fused(x, num_steps=2, prev_steps=0)
+            heads[1].head_module[2].weight.add_(1.)
+            outputs = fused(x, num_steps=2, prev_steps=0)
+            for head, output in zip(heads, outputs):
+                torch.testing.assert_close(output, head(x, num_steps=2, prev_steps=0), rtol=1e-5, atol=1e-5)
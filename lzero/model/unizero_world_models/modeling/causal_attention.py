@@ -9,7 +9,7 @@ import torch.nn as nn
 from torch.nn import functional as F
 from einops import rearrange
 from .kv_caching import KeysValues
-from .transformer import apply_rotary_emb
+from .transformer import apply_rotary_emb, apply_rotary_emb_by_slot
 from .attention import Attention
 from .transformer_config import TransformerConfig
 
@@ -39,6 +39,8 @@ class CausalAttention(Attention):
 
         self.config = config
         self.num_heads = config.num_heads
+        # Whether the cached keys are kept unrotated, with RoPE applied by cache slot after reading the cache.
+        self.rope_unrotated_kv_cache = config.rotary_emb and getattr(config, 'rope_unrotated_kv_cache', False)
 
         self.key = nn.Linear(config.embed_dim, config.embed_dim)
         self.query = nn.Linear(config.embed_dim, config.embed_dim)
@@ -78,27 +80,30 @@ class CausalAttention(Attention):
         v = self.value(x).view(B, T, self.num_heads, C // self.num_heads).transpose(1,
                                                                                     2)  # (B, num_heads, T, head_size)
 
-        if self.config.rotary_emb:
+        if self.config.rotary_emb and not self.rope_unrotated_kv_cache:
             q, k = apply_rotary_emb(q, k, freqs_cis=freqs_cis)
 
         if kv_cache is not None:
             kv_cache.update(k, v)  # time occupancy 21%
             k, v = kv_cache.get()  # time occupancy 5%
 
+        if self.rope_unrotated_kv_cache:
+            # freqs_cis holds the rows of the L + T cache slots; the queries occupy the last T of them.
+            q = apply_rotary_emb_by_slot(q, freqs_cis[L:L + T])
+            k = apply_rotary_emb_by_slot(k, freqs_cis[:L + T])
+
         att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
 
         if valid_context_lengths is not None:
             # Final mask.shape: (B, T, L + T)
             # L is the context length, T is the current input length,
             # valid_context_lengths is the valid length at the end of the context.
-            mask = torch.zeros(B, T, L + T, device=att.device)
-            # For each sample, set the invalid parts to 0 based on its valid length.
-            for i in range(B):
-                mask[i] = self.mask[L:L + T, :L + T].clone()
-                mask[i, :, :(L - valid_context_lengths[i])] = 0  # Set invalid parts to 0.
-                # Adjust mask dimensions to match the last two dimensions of att.
-                # (B, T, L + T) -> (B, 1, T, L + T) -> (B, num_heads, T, L + T)
-                mask = mask.unsqueeze(1).expand(-1, att.size(1), -1, -1)
+            # For each sample, set the invalid parts, the first L - valid_context_lengths[i] positions, to 0.
+            stale = (L - torch.as_tensor(valid_context_lengths, device=att.device)).view(B, 1, 1)
+            positions = torch.arange(L + T, device=att.device)
+            mask = self.mask[L:L + T, :L + T] * (positions >= stale)
+            # Adjust mask dimensions to match att: (B, T, L + T) -> (B, 1, T, L + T), broadcast over the heads.
+            mask = mask.unsqueeze(1)
         else:
             # mask.shape: (T, L + T)
             mask = self.mask[L:L + T, :L + T]  # Causal Mask being Applied
@@ -1,13 +1,31 @@
 # Modified from https://github.com/eloialonso/iris/blob/main/src/models/kv_caching.py
 
-from typing import Tuple
+from typing import Optional, Tuple
 
 import numpy as np
 import torch
 
 
+def _pin_memory(device: torch.device) -> bool:
+    """
+    Overview:
+        Whether host storage on ``device`` should be page-locked: CPU caches are pinned when CUDA is available, so \
+        that their transfers to and from the GPU can run asynchronously.
+    """
+    return torch.device(device).type == 'cpu' and torch.cuda.is_available()
+
+
 class Cache:
-    def __init__(self, num_samples: int, num_heads: int, max_tokens: int, embed_dim: int, device: torch.device) -> None:
+    def __init__(
+            self,
+            num_samples: int,
+            num_heads: int,
+            max_tokens: int,
+            embed_dim: int,
+            device: torch.device,
+            buffer: Optional[torch.Tensor] = None,
+            dtype: Optional[torch.dtype] = None
+    ) -> None:
         """
         Overview:
             Cache for storing intermediate results in a transformer model.
@@ -17,10 +35,16 @@ class Cache:
             - max_tokens (:obj:`int`): The maximum number of tokens.
             - embed_dim (:obj:`int`): The dimension of the embeddings.
             - device (:obj:`torch.device`): The device on which to store the cache.
+            - buffer (:obj:`Optional[torch.Tensor]`): Preallocated storage of shape (num_samples, num_heads, max_tokens, \
+                head_dim), typically a view into a buffer shared by all layers. If None, the cache allocates its own storage.
+            - dtype (:obj:`Optional[torch.dtype]`): The storage dtype. If None, the default dtype is used.
         """
         assert embed_dim % num_heads == 0
         self._num_samples, self._cache, self._size = num_samples, None, None
-        self._reset = lambda n: torch.empty(n, num_heads, max_tokens, embed_dim // num_heads, device=device)  # (B, nh, T, hs)
+        self._buffer = buffer
+        self._reset = lambda n: torch.empty(
+            n, num_heads, max_tokens, embed_dim // num_heads, device=device, dtype=dtype
+        )  # (B, nh, T, hs)
         self.reset()
 
     @property
@@ -39,7 +63,7 @@ class Cache:
         Overview:
             Reset the cache to its initial state.
         """
-        self._cache = self._reset(self._num_samples)
+        self._cache = self._buffer if self._buffer is not None else self._reset(self._num_samples)
         self._size = 0
 
     def prune(self, mask: np.ndarray) -> None:
@@ -52,6 +76,8 @@ class Cache:
         assert mask.ndim == 1 and mask.shape[0] == self.shape[0]
         self._cache = self._cache[mask]
         self._num_samples = self._cache.shape[0]
+        # The pruned cache no longer matches the shared buffer, so later resets allocate their own storage.
+        self._buffer = None
 
     def get(self) -> torch.Tensor:
         """
@@ -77,7 +103,17 @@ class Cache:
 
 
 class KVCache:
-    def __init__(self, n: int, num_heads: int, max_tokens: int, embed_dim: int, device: torch.device) -> None:
+    def __init__(
+            self,
+            n: int,
+            num_heads: int,
+            max_tokens: int,
+            embed_dim: int,
+            device: torch.device,
+            k_buffer: Optional[torch.Tensor] = None,
+            v_buffer: Optional[torch.Tensor] = None,
+            dtype: Optional[torch.dtype] = None
+    ) -> None:
         """
         Overview:
             Cache for storing key and value tensors in a transformer model.
@@ -87,9 +123,14 @@ class KVCache:
             - max_tokens (:obj:`int`): The maximum number of tokens.
             - embed_dim (:obj:`int`): The dimension of the embeddings.
             - device (:obj:`torch.device`): The device on which to store the cache.
-        """
-        self._k_cache = Cache(n, num_heads, max_tokens, embed_dim, device)
-        self._v_cache = Cache(n, num_heads, max_tokens, embed_dim, device)
+            - k_buffer (:obj:`Optional[torch.Tensor]`): Optional preallocated storage for the key cache.
+            - v_buffer (:obj:`Optional[torch.Tensor]`): Optional preallocated storage for the value cache.
+            - dtype (:obj:`Optional[torch.dtype]`): The storage dtype. If None, the default dtype is used.
+        """
+        self._k_cache = Cache(n, num_heads, max_tokens, embed_dim, device, buffer=k_buffer, dtype=dtype)
+        self._v_cache = Cache(n, num_heads, max_tokens, embed_dim, device, buffer=v_buffer, dtype=dtype)
+        # The dtype of the keys and values written by the attention, which may differ from a reduced-precision storage.
+        self._compute_dtype = None
 
     @property
     def shape(self) -> Tuple[int, int, int, int]:
@@ -127,7 +168,11 @@ class KVCache:
             - key_cache (:obj:`torch.Tensor`): The current contents of the key cache.
             - value_cache (:obj:`torch.Tensor`): The current contents of the value cache.
         """
-        return self._k_cache.get(), self._v_cache.get()
+        k, v = self._k_cache.get(), self._v_cache.get()
+        if self._compute_dtype is not None and k.dtype != self._compute_dtype:
+            # Upcast reduced-precision storage back to the dtype the attention computes in.
+            k, v = k.to(self._compute_dtype), v.to(self._compute_dtype)
+        return k, v
 
     def update(self, k: torch.Tensor, v: torch.Tensor):
         """
@@ -137,12 +182,23 @@ class KVCache:
             - k (:obj:`torch.Tensor`): The new values to update the key cache with.
             - v (:obj:`torch.Tensor`): The new values to update the value cache with.
         """
+        self._compute_dtype = k.dtype
         self._k_cache.update(k, k.size(2))
         self._v_cache.update(v, v.size(2))
 
 
 class KeysValues:
-    def __init__(self, n: int, num_heads: int, max_tokens: int, embed_dim: int, num_layers: int, device: torch.device) -> None:
+    def __init__(
+            self,
+            n: int,
+            num_heads: int,
+            max_tokens: int,
+            embed_dim: int,
+            num_layers: int,
+            device: torch.device,
+            dtype: Optional[torch.dtype] = None,
+            buffer: Optional[torch.Tensor] = None
+    ) -> None:
         """
         Overview:
             Class for managing multiple layers of key and value caches in a transformer model.
@@ -153,8 +209,67 @@ class KeysValues:
             - embed_dim (:obj:`int`): The dimension of the embeddings.
             - num_layers (:obj:`int`): The number of layers in the transformer model.
             - device (:obj:`torch.device`): The device on which to store the caches.
+            - dtype (:obj:`Optional[torch.dtype]`): The storage dtype, e.g. ``torch.bfloat16`` for snapshots kept at \
+                reduced precision. If None, the default dtype is used.
+            - buffer (:obj:`Optional[torch.Tensor]`): Optional preallocated storage of shape (num_layers, 2, n, \
+                num_heads, max_tokens, head_dim), e.g. a slot of a ``StaticKVCachePool``.
+        """
+        assert embed_dim % num_heads == 0
+        # The keys and values of all layers live in one contiguous buffer of shape
+        # (num_layers, 2, n, num_heads, max_tokens, head_dim), and each layer's caches are views into it, so a whole
+        # KeysValues can be copied with a single copy_().
+        if buffer is None:
+            buffer = torch.empty(
+                num_layers, 2, n, num_heads, max_tokens, embed_dim // num_heads, device=device, dtype=dtype,
+                pin_memory=_pin_memory(device)
+            )
+        self._buffer = buffer
+        self._k_buffer, self._v_buffer = buffer[:, 0], buffer[:, 1]
+        self._keys_values = tuple(
+            [
+                KVCache(
+                    n,
+                    num_heads,
+                    max_tokens,
+                    embed_dim,
+                    device,
+                    k_buffer=buffer[i, 0],
+                    v_buffer=buffer[i, 1],
+                    dtype=buffer.dtype
+                ) for i in range(num_layers)
+            ]
+        )
+        self.num_layers = num_layers
+        self._update_metadata()
+
+    def _bind_buffer(self, buffer: torch.Tensor) -> None:
+        """
+        Overview:
+            Make ``buffer`` the storage of all layers, e.g. after it has been moved to another device. The token \
+            counts of the caches are kept.
+        """
+        self._buffer = buffer
+        self._k_buffer, self._v_buffer = buffer[:, 0], buffer[:, 1]
+        for i, kv_cache in enumerate(self._keys_values):
+            kv_cache._k_cache._cache = kv_cache._k_cache._buffer = buffer[i, 0]
+            kv_cache._v_cache._cache = kv_cache._v_cache._buffer = buffer[i, 1]
+        self._update_metadata()
+
+    def _update_metadata(self) -> None:
         """
-        self._keys_values = tuple([KVCache(n, num_heads, max_tokens, embed_dim, device) for _ in range(num_layers)])
+        Overview:
+            Cache the shape, device and dtype of the caches as plain attributes, so that hot paths do not have to \
+            walk ``_keys_values[0]._k_cache._cache``. Must be called whenever the cache tensors are re-created.
+        """
+        cache = self._keys_values[0]._k_cache._cache
+        self.n, self.num_heads, self.max_tokens, self.head_dim = cache.shape
+        self.embed_dim = self.num_heads * self.head_dim
+        self.device = cache.device
+        # The arguments needed to construct a KeysValues of the same shape, on the device and with the dtype actually
+        # used by the caches.
+        self._shape_signature = (
+            self.n, self.num_heads, self.max_tokens, self.embed_dim, self.num_layers, self.device, cache.dtype
+        )
 
     def __getitem__(self, index: int) -> KVCache:
         """
@@ -174,7 +289,7 @@ class KeysValues:
         Returns:
             - length (:obj:`int`): The number of layers.
         """
-        return len(self._keys_values)
+        return self.num_layers
 
     @property
     def size(self):
@@ -203,6 +318,225 @@ class KeysValues:
         """
         for kv_cache in self._keys_values:
             kv_cache.prune(mask)
+        self._update_metadata()
+
+    def sample(self, index: int) -> 'KeysValues':
+        """
+        Overview:
+            Get a single-sample KeysValues viewing the caches of sample ``index``, without copying. The view shares \
+            the storage, so later writes to either are visible in both.
+        Arguments:
+            - index (:obj:`int`): The sample index.
+        Returns:
+            - kv (:obj:`KeysValues`): The single-sample view, with the token count of this KeysValues.
+        """
+        assert self.is_stacked(), "Only caches backed by the stacked buffer can be viewed per sample."
+        kv = KeysValues(
+            1, self.num_heads, self.max_tokens, self.embed_dim, self.num_layers, self.device,
+            buffer=self._buffer[:, :, index:index + 1]
+        )
+        size = self.size
+        for kv_cache in kv:
+            kv_cache._k_cache._size = kv_cache._v_cache._size = size
+        return kv
+
+    def is_stacked(self) -> bool:
+        """
+        Overview:
+            Check whether every layer's key and value caches are still backed by the stacked buffers. This is no \
+            longer the case once a cache tensor has been replaced, e.g. by a padded copy or by pruning.
+        Returns:
+            - stacked (:obj:`bool`): Whether the stacked buffers hold the contents of all layers.
+        """
+        buffer = self._buffer
+        layer_shape = buffer.shape[2:]
+        element_size = buffer.element_size()
+        layer_bytes, kv_bytes = buffer.stride(0) * element_size, buffer.stride(1) * element_size
+        base_ptr = buffer.data_ptr()
+        for i, kv_cache in enumerate(self._keys_values):
+            k_cache, v_cache = kv_cache._k_cache._cache, kv_cache._v_cache._cache
+            k_ptr = base_ptr + i * layer_bytes
+            if k_cache.data_ptr() != k_ptr or v_cache.data_ptr() != k_ptr + kv_bytes:
+                return False
+            if k_cache.shape != layer_shape or v_cache.shape != layer_shape:
+                return False
+        return True
+
+
+class StaticKVCachePool:
+    def __init__(
+            self,
+            num_slots: int,
+            n: int,
+            num_heads: int,
+            max_tokens: int,
+            embed_dim: int,
+            num_layers: int,
+            device: torch.device,
+            dtype: Optional[torch.dtype] = None
+    ) -> None:
+        """
+        Overview:
+            A fixed number of KeysValues slots backed by one storage tensor of shape (num_slots, num_layers, 2, n, \
+            num_heads, max_tokens, head_dim) that is allocated once, e.g. at the start of an MCTS search. Snapshots \
+            are written into a slot in place, so no allocation takes place on the copy path.
+        Arguments:
+            - num_slots (:obj:`int`): The number of slots in the pool.
+            - n (:obj:`int`): The number of samples per slot.
+            - num_heads (:obj:`int`): The number of attention heads.
+            - max_tokens (:obj:`int`): The maximum number of tokens.
+            - embed_dim (:obj:`int`): The dimension of the embeddings.
+            - num_layers (:obj:`int`): The number of layers in the transformer model.
+            - device (:obj:`torch.device`): The device on which to store the caches.
+            - dtype (:obj:`Optional[torch.dtype]`): The storage dtype. If None, the default dtype is used.
+        """
+        assert embed_dim % num_heads == 0
+        self._storage = torch.empty(
+            num_slots, num_layers, 2, n, num_heads, max_tokens, embed_dim // num_heads, device=device, dtype=dtype,
+            pin_memory=_pin_memory(device)
+        )
+        self.slots = [
+            KeysValues(
+                n,
+                num_heads,
+                max_tokens,
+                embed_dim,
+                num_layers,
+                device,
+                dtype=self._storage.dtype,
+                buffer=self._storage[i]
+            ) for i in range(num_slots)
+        ]
+
+    def __getitem__(self, slot_id: int) -> KeysValues:
+        """
+        Overview:
+            Get the KeysValues view of a slot.
+        """
+        return self.slots[slot_id]
+
+    def __len__(self) -> int:
+        """
+        Overview:
+            Get the number of slots in the pool.
+        """
+        return len(self.slots)
+
+
+class QuantizedKeysValues:
+    def __init__(
+            self,
+            n: int,
+            num_heads: int,
+            max_tokens: int,
+            embed_dim: int,
+            num_layers: int,
+            device: torch.device,
+    ) -> None:
+        """
+        Overview:
+            An int8 snapshot of a KeysValues object, e.g. for the recurrent-inference shared pool. Keys and values are \
+            stored in one (num_layers, 2, n, num_heads, max_tokens, head_dim) int8 buffer with a symmetric float32 \
+            scale per (layer, key/value, sample, head), computed from the valid tokens. The snapshot is quantized \
+            on write and dequantized when it is copied back into a KeysValues object.
+        Arguments:
+            - n (:obj:`int`): The number of samples to cache.
+            - num_heads (:obj:`int`): The number of attention heads.
+            - max_tokens (:obj:`int`): The maximum number of tokens.
+            - embed_dim (:obj:`int`): The dimension of the embeddings.
+            - num_layers (:obj:`int`): The number of layers in the transformer model.
+            - device (:obj:`torch.device`): The device on which to store the snapshot.
+        """
+        assert embed_dim % num_heads == 0
+        head_dim = embed_dim // num_heads
+        pin_memory = _pin_memory(device)
+        self._q_buffer = torch.zeros(
+            num_layers, 2, n, num_heads, max_tokens, head_dim, dtype=torch.int8, device=device, pin_memory=pin_memory
+        )
+        self._scale = torch.ones(
+            num_layers, 2, n, num_heads, 1, 1, dtype=torch.float32, device=device, pin_memory=pin_memory
+        )
+        self._sizes = [0] * num_layers
+        self.n, self.num_heads, self.max_tokens, self.head_dim = n, num_heads, max_tokens, head_dim
+        self.embed_dim = embed_dim
+        self.num_layers = num_layers
+        self.device = self._q_buffer.device
+
+    def __len__(self) -> int:
+        """
+        Overview:
+            Get the number of layers in the transformer model.
+        """
+        return self.num_layers
+
+    @property
+    def size(self) -> int:
+        """
+        Overview:
+            Get the size of the tokens in the snapshot.
+        """
+        return self._sizes[0]
+
+    def quantize_from(self, src_kv: KeysValues) -> 'QuantizedKeysValues':
+        """
+        Overview:
+            Quantize the valid tokens of ``src_kv`` into this snapshot.
+        Arguments:
+            - src_kv (:obj:`KeysValues`): The source KeysValues object.
+        Returns:
+            - self (:obj:`QuantizedKeysValues`): This snapshot.
+        """
+        self._sizes = [kv_cache._k_cache._size for kv_cache in src_kv]
+        size = max(self._sizes)
+        if size == 0:
+            # An empty cache has no tokens to reduce over: keep a unit scale and leave the buffer untouched.
+            self._scale.fill_(1.)
+            return self
+        if src_kv.is_stacked():
+            values = src_kv._buffer[..., :size, :]
+        else:
+            src_k, src_v = stack_keys_values(src_kv)
+            values = torch.stack([src_k[..., :size, :], src_v[..., :size, :]], dim=1)
+        values = values.float()
+        scale = values.abs().amax(dim=(-2, -1), keepdim=True).clamp_min_(1e-8).div_(127.)
+        self._scale.copy_(scale)
+        self._q_buffer[..., :size, :].copy_(values.div_(scale).round_().clamp_(-127, 127))
+        return self
+
+    def dequantize_into(self, dst_kv: KeysValues) -> KeysValues:
+        """
+        Overview:
+            Dequantize the snapshot into ``dst_kv`` in place.
+        Arguments:
+            - dst_kv (:obj:`KeysValues`): The destination KeysValues object.
+        Returns:
+            - dst_kv (:obj:`KeysValues`): The destination KeysValues object.
+        """
+        size = max(self._sizes)
+        values = self._q_buffer[..., :size, :].float().mul_(self._scale)
+        if dst_kv.is_stacked():
+            dst_kv._buffer[..., :size, :].copy_(values)
+        else:
+            for layer, kv_cache in enumerate(dst_kv):
+                kv_cache._k_cache._cache[..., :size, :].copy_(values[layer, 0])
+                kv_cache._v_cache._cache[..., :size, :].copy_(values[layer, 1])
+        for kv_cache, layer_size in zip(dst_kv, self._sizes):
+            kv_cache._k_cache._size = kv_cache._v_cache._size = layer_size
+        return dst_kv
+
+
+def stack_keys_values(kv: KeysValues) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Overview:
+        Get the keys and values of all layers as two (num_layers, n, num_heads, max_tokens, head_dim) tensors, \
+        without copying when ``kv`` is still backed by its stacked buffers.
+    """
+    if kv.is_stacked():
+        return kv._k_buffer, kv._v_buffer
+    return (
+        torch.stack([kv_cache._k_cache._cache for kv_cache in kv]),
+        torch.stack([kv_cache._v_cache._cache for kv_cache in kv]),
+    )
 
 
 class AssignWithoutInplaceCheck(torch.autograd.Function):
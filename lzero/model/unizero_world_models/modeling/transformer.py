@@ -4,7 +4,7 @@ The following code is modified from https://github.com/karpathy/nanoGPT.
 import copy
 
 import numpy as np
-from typing import Optional, Tuple
+from typing import Optional, Tuple, Union
 import torch
 import torch.nn as nn
 from ding.torch_utils.network import GRUGatingUnit
@@ -79,6 +79,21 @@ def apply_rotary_emb(
     return xq_out.type_as(xq), xk_out.type_as(xk)
 
 
+def apply_rotary_emb_by_slot(x: torch.Tensor, freqs_cis: torch.Tensor) -> torch.Tensor:
+    """
+    Apply rotary positional embeddings shared by all samples to a query or key tensor.
+
+    Arguments:
+        - x (torch.Tensor): The tensor of shape (batch_size, num_heads, seq_len, head_dim).
+        - freqs_cis (torch.Tensor): The frequency components of the seq_len positions, of shape (seq_len, head_dim // 2).
+
+    Returns:
+        - torch.Tensor: The rotated tensor.
+    """
+    x_ = torch.view_as_complex(x.float().reshape(*x.shape[:-1], -1, 2))
+    return torch.view_as_real(x_ * freqs_cis).flatten(-2).type_as(x)
+
+
 class Transformer(nn.Module):
     """
     Transformer model class.
@@ -110,23 +125,41 @@ class Transformer(nn.Module):
                 self.config.rope_theta,
             )
             self.register_buffer("freqs_cis", freqs_cis)
-
-    def generate_empty_keys_values(self, n: int, max_tokens: int) -> KeysValues:
+            # Row offsets within a sequence, used to gather the rows of freqs_cis for all samples at once.
+            self.register_buffer("rope_offsets", torch.arange(freqs_cis.shape[0]), persistent=False)
+        # Storage dtype of the KV caches created by generate_empty_keys_values when no dtype is given. The caches
+        # upcast their contents back to the compute dtype when they are read.
+        working_kv_cache_dtype = getattr(self.config, 'working_kv_cache_dtype', None)
+        self.working_kv_cache_dtype = getattr(torch, working_kv_cache_dtype) if working_kv_cache_dtype else None
+        # Whether the attention keeps the cached keys unrotated and applies RoPE by cache slot.
+        self.rope_unrotated_kv_cache = self.config.rotary_emb and getattr(self.config, 'rope_unrotated_kv_cache', False)
+        if self.rope_unrotated_kv_cache and (getattr(config, 'attention', 'causal') != 'causal'
+                                             or getattr(config, 'aha', False)
+                                             or getattr(config, 'interleave_local_causal', False)):
+            raise ValueError("rope_unrotated_kv_cache is only supported by causal attention.")
+
+    def generate_empty_keys_values(self, n: int, max_tokens: int, dtype: Optional[torch.dtype] = None) -> KeysValues:
         """
         Generate a placeholder for keys and values.
 
         Arguments:
             - n (:obj:`int`): Batch size.
             - max_tokens (:obj:`int`): Maximum number of tokens in the sequence.
+            - dtype (:obj:`Optional[torch.dtype]`): Storage dtype of the caches. If None, the configured \
+                working_kv_cache_dtype, or else the default dtype, is used.
 
         Returns:
             - KeysValues: An object containing empty keys and values.
         """
         device = self.ln_f.weight.device  # Assumption: All submodules are on the same device
-        return KeysValues(n, self.config.num_heads, max_tokens, self.config.embed_dim, self.config.num_layers, device)
+        if dtype is None:
+            dtype = self.working_kv_cache_dtype
+        return KeysValues(n, self.config.num_heads, max_tokens, self.config.embed_dim, self.config.num_layers, device,
+                          dtype=dtype)
 
     def forward(self, sequences: torch.Tensor, past_keys_values: Optional[KeysValues] = None,
-                valid_context_lengths: Optional[torch.Tensor] = None, start_pos: int = 0) -> torch.Tensor:
+                valid_context_lengths: Optional[torch.Tensor] = None,
+                start_pos: Union[int, torch.Tensor] = 0) -> torch.Tensor:
         """
         Forward pass of the Transformer model.
 
@@ -134,38 +167,40 @@ class Transformer(nn.Module):
             - sequences (:obj:`torch.Tensor`): Input tensor of shape (batch_size, seq_length, embed_dim).
             - past_keys_values (:obj:`Optional[KeysValues]`): Precomputed keys and values for faster generation (default: None).
             - valid_context_lengths (:obj:`Optional[torch.Tensor]`): Valid lengths of context for masking (default: None).
-            - start_pos (:obj:`int`): Starting position for rotary embeddings (default: 0).
+            - start_pos (:obj:`Union[int, torch.Tensor]`): Starting position for rotary embeddings, a scalar or one per sample;
+                for a 2-D tensor the first column is used (default: 0).
 
         Returns:
             - torch.Tensor: Output tensor of shape (batch_size, seq_length, embed_dim).
         """
         seqlen = sequences.shape[1]
         # If using Rotary Position Embeddings (RoPE), slice the frequency components accordingly
-        if self.config.rotary_emb:
-            if isinstance(start_pos, (int, float, np.integer)):
-                # In the reanalyze_phase or reset stage in collection/evaluation phase, create a tensor filled with start_pos, expanded to match the batch size, and adjust for sequence type,  e.g., start_pos=2.
-                start_pos_tensor = torch.full((sequences.shape[0],), int(start_pos), device=sequences.device)
-            elif isinstance(start_pos, (list, np.ndarray, torch.Tensor)):
-                if isinstance(start_pos[0], (np.ndarray, torch.Tensor, list)):
-                    # In the training phase, flatten start_pos, take the first element, convert to tensor, e.g., start_pos=[array([ 8, 10, 12, 14, 16]), array([12, 14, 16, 18, 20])]
-                    start_pos_tensor = torch.as_tensor(
-                    [x.reshape(-1)[0].item() for x in start_pos],  # Force flatten and take the first element
-                        device=sequences.device
-                    )
-                elif isinstance(start_pos[0], (int, float, np.integer)):
-                    # In the collection/evaluation phase, e.g., start_pos = [0, 0, 0, 0, 0, 0, 0, 0]
-                    start_pos_tensor = torch.as_tensor([int(x) for x in start_pos], device=sequences.device)
-            else:
-                raise ValueError("start_pos must be an int, float, list, numpy array or torch.Tensor.")
+        if self.rope_unrotated_kv_cache:
+            # The positions are the cache slots [0, L + seqlen): RoPE scores only depend on position differences,
+            # which the slots preserve, so start_pos is not needed.
+            num_cached = 0 if past_keys_values is None else past_keys_values.size
+            freqs_cis = self.freqs_cis[:num_cached + seqlen]
+        elif self.config.rotary_emb:
+            if isinstance(start_pos, (list, tuple)) and len(start_pos) > 0 and \
+                    isinstance(start_pos[0], (np.ndarray, torch.Tensor, list)):
+                # Per-sample position sequences, e.g. start_pos=[array([ 8, 10, 12]), array([12, 14, 16])]: take the
+                # first element of each.
+                start_pos = [torch.as_tensor(x).reshape(-1)[0].item() for x in start_pos]
+            start_pos_tensor = torch.as_tensor(start_pos, dtype=torch.long, device=sequences.device)
+            if start_pos_tensor.dim() == 0:
+                # A scalar start_pos, e.g. in the reset stage, is shared by the whole batch.
+                start_pos_tensor = start_pos_tensor.expand(sequences.shape[0])
+            elif start_pos_tensor.dim() > 1:
+                # In the training phase start_pos has shape (batch_size, num_steps); the first column is the start.
+                start_pos_tensor = start_pos_tensor.reshape(start_pos_tensor.shape[0], -1)[:, 0]
 
             # TODO: Determine how to handle cases when episode length exceeds max_seq_len
             # Use modulo operation to ensure start_pos does not exceed max_seq_len
             start_pos_tensor = torch.remainder(start_pos_tensor, self.config.max_seq_len)
-            # Convert each sample's start_pos to a list
-            start_pos_list = start_pos_tensor.tolist()
-            # For each sample, slice the corresponding range of freqs_cis based on start_pos
-            freqs_cis_slices = [self.freqs_cis[int(pos): int(pos) + seqlen] for pos in start_pos_list]
-            freqs_cis = torch.stack(freqs_cis_slices)
+            # Gather the rows [start_pos, start_pos + seqlen) of the table shared by all layers for every sample on
+            # device, without a host round-trip for the positions.
+            positions = start_pos_tensor.unsqueeze(1) + self.rope_offsets[:seqlen]
+            freqs_cis = self.freqs_cis[positions]
 
             if freqs_cis.ndim == 3 and freqs_cis.shape[1] == 1:
                 # Convert shape [seq_len, 1, num_pairs] to [seq_len, num_pairs]
@@ -1,10 +1,11 @@
 # Modified from https://github.com/eloialonso/iris/blob/main/src/models/slicer.py
 
 import math
-from typing import List
+from typing import List, Tuple
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 
 class Slicer(nn.Module):
@@ -17,22 +18,29 @@ class Slicer(nn.Module):
             - block_mask (:obj:`torch.Tensor`): A tensor mask indicating which blocks to keep.
         """
         super().__init__()
+        # The slices are computed on the host and moved to the device of ``block_mask`` in a single copy, so that
+        # indexing device tensors with them needs no host-to-device transfer.
+        device = block_mask.device
+        block_mask = block_mask.cpu().bool()
         self.block_size = block_mask.size(0)
-        self.num_kept_tokens = block_mask.sum().long().item()
+        self.num_kept_tokens = int(block_mask.sum())
         kept_indices = torch.where(block_mask)[0].repeat(max_blocks)
         offsets = torch.arange(max_blocks).repeat_interleave(self.num_kept_tokens)
-        self.indices = kept_indices + block_mask.size(0) * offsets
+        indices = kept_indices + block_mask.size(0) * offsets
 
         print("precompute_slices() begin")
-        self.cache = {}
+        keys, results = [], []
         max_steps = max_blocks * self.block_size  # 5*17
         for num_steps in range(max_steps + 1):
             for prev_steps in range(max_steps + 1):
                 total_steps = num_steps + prev_steps
                 num_blocks = math.ceil(total_steps / self.block_size)  # self.block_size=17
-                indices = self.indices[:num_blocks * self.num_kept_tokens]
-                result = indices[torch.logical_and(prev_steps <= indices, indices < total_steps)] - prev_steps
-                self.cache[(num_steps, prev_steps)] = result
+                kept = indices[:num_blocks * self.num_kept_tokens]
+                keys.append((num_steps, prev_steps))
+                results.append(kept[torch.logical_and(prev_steps <= kept, kept < total_steps)] - prev_steps)
+        self.indices = indices.to(device)
+        flat_results = torch.cat(results).to(device)
+        self.cache = dict(zip(keys, flat_results.split([len(result) for result in results])))
         print("precompute_slices() done")
 
     def compute_slice(self, num_steps: int, prev_steps: int = 0) -> torch.Tensor:
@@ -69,6 +77,24 @@ class Head(Slicer):
         super().__init__(max_blocks, block_mask)
         assert isinstance(head_module, nn.Module)
         self.head_module = head_module
+        linears = [m for m in head_module.modules() if isinstance(m, nn.Linear)]
+        self.output_dim = linears[-1].out_features if linears else None
+
+    def slice_input(self, x: torch.Tensor, num_steps: int, prev_steps: int) -> torch.Tensor:
+        """
+        Overview:
+            Select the tokens of ``x`` that this head reads.
+        Arguments:
+            - x (:obj:`torch.Tensor`): The input tensor.
+            - num_steps (:obj:`int`): The number of steps to consider.
+            - prev_steps (:obj:`int | :obj:`torch.Tensor`): The number of previous steps to consider.
+        Returns:
+            - torch.Tensor: The selected tokens.
+        """
+        if isinstance(prev_steps, torch.Tensor):
+            x_sliced = [x[i, self.compute_slice(num_steps, prev_steps[i].item())] for i in range(prev_steps.shape[0])]
+            return torch.cat(x_sliced, dim=0)
+        return x[:, self.compute_slice(num_steps, prev_steps)]  # x is (B, T, E)
 
     def forward(self, x: torch.Tensor, num_steps: int, prev_steps: int) -> torch.Tensor:
         """
@@ -81,14 +107,70 @@ class Head(Slicer):
         Returns:
             - torch.Tensor: The processed tensor.
         """
-        if isinstance(prev_steps, torch.Tensor):
-            x_sliced = [x[i, self.compute_slice(num_steps, prev_steps[i].item())] for i in range(prev_steps.shape[0])]
-            x_sliced = torch.cat(x_sliced, dim=0)
-        elif isinstance(prev_steps, int):
-            x_sliced = x[:, self.compute_slice(num_steps, prev_steps)]  # x is (B, T, E)
+        x_sliced = self.slice_input(x, num_steps, prev_steps)
+        if x_sliced.numel() == 0 and self.output_dim is not None and not torch.is_grad_enabled():
+            # No token of this head in the sequence, e.g. the value head on an action token: skip the kernel launches.
+            return x_sliced.new_empty(*x_sliced.shape[:-1], self.output_dim)
         return self.head_module(x_sliced)
 
 
+class FusedHeads:
+    def __init__(self, heads: List[Head]) -> None:
+        """
+        Overview:
+            Inference-time fusion of heads that read the same tokens and share the Linear -> GELU(tanh) -> Linear \
+            layout, e.g. the policy and value heads: the first layers run as one matmul against the concatenated \
+            weights and the second layers as one matmul against a block-diagonal weight. The fused weights are \
+            cached and rebuilt whenever a parameter is updated in place or moved, which is detected from the \
+            ``data_ptr`` and ``_version`` of the parameters on each call. This check only runs eagerly: a CUDA graph \
+            or a ``torch.compile`` graph would keep reading the fused weights of the capture, so such regions must \
+            call the separate heads instead.
+        Arguments:
+            - heads (:obj:`List[Head]`): The heads to fuse, all with the same block mask.
+        """
+        for head in heads:
+            assert len(head.head_module) == 3 and isinstance(head.head_module[0], nn.Linear) \
+                and isinstance(head.head_module[2], nn.Linear)
+        self.heads = heads
+        self.output_dims = [head.output_dim for head in heads]
+        self._cache_key = None
+        self._weights = None
+
+    def _parameters(self) -> List[torch.Tensor]:
+        return [p for head in self.heads for p in (head.head_module[0].weight, head.head_module[0].bias,
+                                                   head.head_module[2].weight, head.head_module[2].bias)]
+
+    def _fused_weights(self) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        params = self._parameters()
+        cache_key = tuple((p.data_ptr(), p._version) for p in params)
+        if cache_key != self._cache_key:
+            fc1_weight = torch.cat(params[0::4], dim=0)
+            fc1_bias = torch.cat(params[1::4], dim=0)
+            fc2_weight = torch.block_diag(*params[2::4])
+            fc2_bias = torch.cat(params[3::4], dim=0)
+            self._weights = (fc1_weight, fc1_bias, fc2_weight, fc2_bias)
+            self._cache_key = cache_key
+        return self._weights
+
+    def __call__(self, x: torch.Tensor, num_steps: int, prev_steps: int) -> List[torch.Tensor]:
+        """
+        Overview:
+            Compute the outputs of all heads. Must be called with gradients disabled.
+        Arguments:
+            - x (:obj:`torch.Tensor`): The input tensor.
+            - num_steps (:obj:`int`): The number of steps to consider.
+            - prev_steps (:obj:`int | :obj:`torch.Tensor`): The number of previous steps to consider.
+        Returns:
+            - outputs (:obj:`List[torch.Tensor]`): The output of each head, in order.
+        """
+        x_sliced = self.heads[0].slice_input(x, num_steps, prev_steps)
+        if x_sliced.numel() == 0:
+            return [x_sliced.new_empty(*x_sliced.shape[:-1], dim) for dim in self.output_dims]
+        fc1_weight, fc1_bias, fc2_weight, fc2_bias = self._fused_weights()
+        h = F.gelu(F.linear(x_sliced, fc1_weight, fc1_bias), approximate='tanh')
+        return list(torch.split(F.linear(h, fc2_weight, fc2_bias), self.output_dims, dim=-1))
+
+
 class PolicyHeadCont(Slicer):
     def __init__(self, max_blocks: int, block_mask: torch.Tensor, head_module: nn.Module) -> None:
         """
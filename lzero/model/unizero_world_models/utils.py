@@ -1,62 +1,185 @@
-import xxhash
+import logging
+import time
+from collections import defaultdict
 from dataclasses import dataclass
+from typing import List, Optional
 
+import numpy as np
 import torch
 import torch.nn as nn
-import time
-from lzero.model.unizero_world_models.modeling.kv_caching import KeysValues
+import xxhash
+from lzero.model.unizero_world_models.modeling.kv_caching import KeysValues, QuantizedKeysValues, \
+    stack_keys_values
 
+logger = logging.getLogger(__name__)
 
-def custom_copy_kv_cache_to_dict_speed(src_kv: KeysValues, dst_dict: dict, cache_key: str, reuse_cache: bool = True) -> None:
+
+def _new_kv_cache_like(src_kv: KeysValues, dtype: Optional[torch.dtype] = None) -> KeysValues:
     """
     Overview:
-        Efficiently copy the contents of a KeysValues object to a new entry in a dictionary.
-    Arguments:
-        - src_kv (:obj:`KeysValues`): The source KeysValues object to copy from.
-        - dst_dict (:obj:`dict`): The destination dictionary to copy to.
-        - cache_key (:obj:`str`): The key for the new entry in the destination dictionary.
-        - reuse_cache (:obj:`bool`, optional): Whether to reuse the existing cache if the cache_key already exists.
-                                               If True, the existing cache will not be overwritten.
-                                               If False, the cache will be overwritten every time.
-                                               Default: True.
+        Construct a KeysValues with the same shape and device as ``src_kv`` (and the same dtype unless ``dtype`` is \
+        given).
     """
-    if reuse_cache and cache_key in dst_dict:
-        print(f"Cache key '{cache_key}' already exists in the destination dictionary. Reusing the existing cache.")
-        print(f"Dictionary size: {len(dst_dict)}")
-        return
+    key = src_kv._shape_signature if dtype is None else src_kv._shape_signature[:6] + (dtype, )
+    return KeysValues(*key)
 
-    start_time = time.time()
-    src_kv_shape = src_kv._keys_values[0]._k_cache._cache.shape
-    dst_kv = KeysValues(
-        src_kv_shape[0],  # n
-        src_kv_shape[1],  # num_heads
-        src_kv_shape[2],  # max_tokens
-        src_kv_shape[3] * src_kv_shape[1],  # embed_dim
-        len(src_kv._keys_values),  # num_layers
-        src_kv._keys_values[0]._k_cache._cache.device,  # device
-    )
-    shape_time = time.time() - start_time
 
-    start_time = time.time()
+@torch.jit.script
+def _copy_tensor_list_(dst_tensors: List[torch.Tensor], src_tensors: List[torch.Tensor], non_blocking: bool) -> None:
+    """
+    Overview:
+        TorchScript per-tensor copy loop, so that the loop and the copy_() dispatch run without the Python \
+        interpreter.
+    """
+    for i in range(len(dst_tensors)):
+        dst_tensors[i].copy_(src_tensors[i], non_blocking=non_blocking)
+
+
+def _foreach_copy_(dst_tensors: list, src_tensors: list, non_blocking: bool = False) -> None:
+    """
+    Overview:
+        Copy a list of tensors into another with ``torch._foreach_copy_`` when available (PyTorch >= 2.1), and with \
+        a scripted per-tensor copy loop otherwise.
+    """
+    if hasattr(torch, '_foreach_copy_'):
+        torch._foreach_copy_(dst_tensors, src_tensors, non_blocking=non_blocking)
+    else:
+        _copy_tensor_list_(dst_tensors, src_tensors, non_blocking)
+
+
+def _foreach_zero_(tensors: list) -> None:
+    """
+    Overview:
+        Zero a list of tensors with ``torch._foreach_zero_`` when available, and one by one otherwise.
+    """
+    if hasattr(torch, '_foreach_zero_'):
+        torch._foreach_zero_(tensors)
+    else:
+        for tensor in tensors:
+            tensor.zero_()
+
+
+def _foreach_add_(tensors: list, scalar: float) -> None:
+    """
+    Overview:
+        Add a scalar to a list of tensors with ``torch._foreach_add_`` when available, and one by one otherwise.
+    """
+    if hasattr(torch, '_foreach_add_'):
+        torch._foreach_add_(tensors, scalar)
+    else:
+        for tensor in tensors:
+            tensor.add_(scalar)
+
+
+def copy_kv_cache_into(dst_kv: KeysValues, src_kv: KeysValues) -> KeysValues:
+    """
+    Overview:
+        Copy the contents and sizes of ``src_kv`` into ``dst_kv`` in place. When both objects are still backed by their \
+        stacked buffers, the copy is done with a single copy_() instead of 2 * num_layers. Either side may be an int8 \
+        ``QuantizedKeysValues`` snapshot, which is quantized on write and dequantized on read.
+    Arguments:
+        - dst_kv (:obj:`Union[KeysValues, QuantizedKeysValues]`): The destination, with the same shape as ``src_kv``.
+        - src_kv (:obj:`Union[KeysValues, QuantizedKeysValues]`): The source to copy from.
+    Returns:
+        - dst_kv (:obj:`Union[KeysValues, QuantizedKeysValues]`): The destination.
+    """
+    if isinstance(dst_kv, QuantizedKeysValues):
+        return dst_kv.quantize_from(src_kv)
+    if isinstance(src_kv, QuantizedKeysValues):
+        return src_kv.dequantize_into(dst_kv)
+    if dst_kv.is_stacked() and src_kv.is_stacked():
+        # A single contiguous memcpy covers the keys and values of all layers. Copies into device memory are issued
+        # asynchronously; copies into host memory stay blocking so that the host can read the result right away.
+        dst_kv._buffer.copy_(src_kv._buffer, non_blocking=dst_kv._buffer.is_cuda)
+    else:
+        # The per-layer caches no longer alias the stacked buffers: copy them all with one foreach copy.
+        _foreach_copy_(
+            [cache for layer in dst_kv._keys_values for cache in (layer._k_cache._cache, layer._v_cache._cache)],
+            [cache for layer in src_kv._keys_values for cache in (layer._k_cache._cache, layer._v_cache._cache)],
+        )
     for src_layer, dst_layer in zip(src_kv._keys_values, dst_kv._keys_values):
-        # Copy the key and value caches using torch.copy_()
-        dst_layer._k_cache._cache.copy_(src_layer._k_cache._cache)
-        dst_layer._v_cache._cache.copy_(src_layer._v_cache._cache)
-        dst_layer._k_cache._size = src_layer._k_cache._size
-        dst_layer._v_cache._size = src_layer._v_cache._size
-    copy_time = time.time() - start_time
+        dst_layer._k_cache._size = dst_layer._v_cache._size = src_layer._k_cache._size
+    return dst_kv
+
 
-    dst_dict[cache_key] = dst_kv
+def copy_kv_token_range_into(dst_kv: KeysValues, src_kv: KeysValues, start: int, end: int) -> KeysValues:
+    """
+    Overview:
+        Copy the tokens ``start:end`` of the keys and values of all layers of ``src_kv`` into the same positions of \
+        ``dst_kv``, in place and without changing the sizes of either. When both objects are backed by their stacked \
+        buffers, the copy is a single copy_() of the token range.
+    Arguments:
+        - dst_kv (:obj:`KeysValues`): The destination, with the same shape as ``src_kv``.
+        - src_kv (:obj:`KeysValues`): The source to copy from.
+        - start (:obj:`int`): The index of the first token to copy.
+        - end (:obj:`int`): The index past the last token to copy.
+    Returns:
+        - dst_kv (:obj:`KeysValues`): The destination.
+    """
+    if end <= start:
+        return dst_kv
+    if dst_kv.is_stacked() and src_kv.is_stacked():
+        dst_kv._buffer[..., start:end, :].copy_(src_kv._buffer[..., start:end, :], non_blocking=dst_kv._buffer.is_cuda)
+    else:
+        _foreach_copy_(
+            [cache[..., start:end, :] for layer in dst_kv._keys_values
+             for cache in (layer._k_cache._cache, layer._v_cache._cache)],
+            [cache[..., start:end, :] for layer in src_kv._keys_values
+             for cache in (layer._k_cache._cache, layer._v_cache._cache)],
+        )
+    return dst_kv
 
-    print(f"Shape initialization time: {shape_time:.6f} seconds")
-    print(f"Cache copy time: {copy_time:.6f} seconds")
-    print(f"Total time: {shape_time + copy_time:.6f} seconds")
 
-    # print(f"Cache key '{cache_key}' has been copied to the destination dictionary.")
-    # print(f"Dictionary size: {len(dst_dict)}")
+def custom_copy_kv_cache(
+        src_kv: KeysValues, profile: bool = False, dtype: Optional[torch.dtype] = None
+) -> KeysValues:
+    """
+    Overview:
+        Copy the contents of a KeysValues object into a new KeysValues of the same shape.
+    Arguments:
+        - src_kv (:obj:`KeysValues`): The source KeysValues object to copy from.
+        - profile (:obj:`bool`, optional): Whether to log the time spent allocating the destination and copying. On \
+            CUDA, the timing uses CUDA events and synchronizes on the last one, so it should only be enabled for \
+            debugging. Default: False.
+        - dtype (:obj:`Optional[torch.dtype]`, optional): Storage dtype of the copy, e.g. ``torch.bfloat16`` to halve \
+            the memory and copy bandwidth of snapshots. The cast is fused into the copy, and the values are upcast \
+            again when they are copied back into a cache of the compute dtype. Default: None, i.e. the source dtype.
+    Returns:
+        - dst_kv (:obj:`KeysValues`): The copied KeysValues object.
+    """
+    if not profile:
+        return copy_kv_cache_into(_new_kv_cache_like(src_kv, dtype), src_kv)
+
+    if src_kv.device.type == 'cuda':
+        start, acquired, copied = [torch.cuda.Event(enable_timing=True) for _ in range(3)]
+        start.record()
+        dst_kv = _new_kv_cache_like(src_kv, dtype)
+        acquired.record()
+        copy_kv_cache_into(dst_kv, src_kv)
+        copied.record()
+        copied.synchronize()
+        acquire_time, copy_time = start.elapsed_time(acquired) / 1e3, acquired.elapsed_time(copied) / 1e3
+    else:
+        start = time.perf_counter()
+        dst_kv = _new_kv_cache_like(src_kv, dtype)
+        acquired = time.perf_counter()
+        copy_kv_cache_into(dst_kv, src_kv)
+        acquire_time, copy_time = acquired - start, time.perf_counter() - acquired
+    logger.debug(
+        f"Cache acquire time: {acquire_time:.6f}s, cache copy time: {copy_time:.6f}s, "
+        f"total time: {acquire_time + copy_time:.6f}s"
+    )
+    return dst_kv
 
 
-def custom_copy_kv_cache_to_dict(src_kv: KeysValues, dst_dict: dict, cache_key: str, reuse_cache: bool = True) -> None:
+def custom_copy_kv_cache_to_dict(
+        src_kv: KeysValues,
+        dst_dict: dict,
+        cache_key: str,
+        reuse_cache: bool = True,
+        profile: bool = False,
+        dtype: Optional[torch.dtype] = None
+) -> None:
     """
     Overview:
         Efficiently copy the contents of a KeysValues object to a new entry in a dictionary.
@@ -68,51 +191,112 @@ def custom_copy_kv_cache_to_dict(src_kv: KeysValues, dst_dict: dict, cache_key:
                                                If True, the existing cache will not be overwritten.
                                                If False, the cache will be overwritten every time.
                                                Default: True.
+        - profile (:obj:`bool`, optional): Whether to log the copy timing, see ``custom_copy_kv_cache``. Default: False.
+        - dtype (:obj:`Optional[torch.dtype]`, optional): Storage dtype of the copy, see ``custom_copy_kv_cache``.
     """
     if reuse_cache and cache_key in dst_dict:
-        print(f"Cache key '{cache_key}' already exists in the destination dictionary. Reusing the existing cache.")
-        print(f"Dictionary size: {len(dst_dict)}")
+        logger.debug(f"Cache key '{cache_key}' already exists, reusing the existing cache. Dictionary size: {len(dst_dict)}")
         return
+    dst_dict[cache_key] = custom_copy_kv_cache(src_kv, profile=profile, dtype=dtype)
 
-    src_kv_shape = src_kv._keys_values[0]._k_cache._cache.shape
-    dst_kv = KeysValues(
-        src_kv_shape[0],  # n
-        src_kv_shape[1],  # num_heads
-        src_kv_shape[2],  # max_tokens
-        src_kv_shape[3] * src_kv_shape[1],  # embed_dim
-        len(src_kv._keys_values),  # num_layers
-        src_kv._keys_values[0]._k_cache._cache.device,  # device
-    )
 
-    for src_layer, dst_layer in zip(src_kv._keys_values, dst_kv._keys_values):
-        # Copy the key and value caches using torch.copy_()
-        dst_layer._k_cache._cache.copy_(src_layer._k_cache._cache)
-        dst_layer._v_cache._cache.copy_(src_layer._v_cache._cache)
-        dst_layer._k_cache._size = src_layer._k_cache._size
-        dst_layer._v_cache._size = src_layer._v_cache._size
-
-    dst_dict[cache_key] = dst_kv
-
-
-def custom_copy_kv_cache(src_kv: KeysValues) -> KeysValues:
-    src_kv_shape = src_kv._keys_values[0]._k_cache._cache.shape
-    dst_kv = KeysValues(
-        src_kv_shape[0],  # n
-        src_kv_shape[1],  # num_heads
-        src_kv_shape[2],  # max_tokens
-        src_kv_shape[3] * src_kv_shape[1],  # embed_dim
-        len(src_kv),  # num_layers
-        src_kv._keys_values[0]._k_cache._cache.device,  # device
+def custom_copy_kv_cache_to_dict_speed(src_kv: KeysValues, dst_dict: dict, cache_key: str, reuse_cache: bool = True) -> None:
+    """
+    Overview:
+        Same as ``custom_copy_kv_cache_to_dict``, with the copy timing logged when debug logging is enabled.
+    """
+    custom_copy_kv_cache_to_dict(
+        src_kv, dst_dict, cache_key, reuse_cache=reuse_cache, profile=logger.isEnabledFor(logging.DEBUG)
     )
-    
-    # with torch.no_grad():
-    for src_layer, dst_layer in zip(src_kv._keys_values, dst_kv._keys_values):
-        # Copy the key and value caches using torch.copy_()
-        dst_layer._k_cache._cache.copy_(src_layer._k_cache._cache)
-        dst_layer._v_cache._cache.copy_(src_layer._v_cache._cache)
-        dst_layer._k_cache._size = src_layer._k_cache._size
-        dst_layer._v_cache._size = src_layer._v_cache._size
 
+
+def left_pad_kv_caches_into(
+        dst_kv: KeysValues,
+        src_kvs: List[KeysValues],
+        sizes: List[int],
+        padded_size: Optional[int] = None
+) -> KeysValues:
+    """
+    Overview:
+        Gather single-sample caches of different lengths into the batched ``dst_kv``, left-padded with zeros to a \
+        common length, so that the last token of every sample ends up at the same position. All copies are issued \
+        as one fused multi-tensor copy, with one tensor covering the keys and values of all layers per sample when \
+        the source is stacked.
+    Arguments:
+        - dst_kv (:obj:`KeysValues`): The destination KeysValues, stacked, with one sample per source.
+        - src_kvs (:obj:`List[KeysValues]`): The single-sample source caches.
+        - sizes (:obj:`List[int]`): The number of valid tokens of each source.
+        - padded_size (:obj:`Optional[int]`): The common length, at least ``max(sizes)``. If None, ``max(sizes)``.
+    Returns:
+        - dst_kv (:obj:`KeysValues`): The destination KeysValues, whose caches all hold ``padded_size`` tokens.
+    """
+    max_size = max(sizes) if padded_size is None else padded_size
+    # Only the padding is zeroed, so that nothing is zeroed at all in the common case of caches of equal length.
+    paddings = [dst_kv._buffer[:, :, i, :, :max_size - size] for i, size in enumerate(sizes) if size < max_size]
+    if paddings:
+        _foreach_zero_(paddings)
+    dsts, srcs = [], []
+    for i, (src_kv, size) in enumerate(zip(src_kvs, sizes)):
+        if size == 0:
+            continue
+        if src_kv.is_stacked():
+            dsts.append(dst_kv._buffer[:, :, i, :, max_size - size:max_size])
+            srcs.append(src_kv._buffer[:, :, 0, :, :size])
+        else:
+            src_k, src_v = stack_keys_values(src_kv)
+            dsts += [dst_kv._k_buffer[:, i, :, max_size - size:max_size], dst_kv._v_buffer[:, i, :, max_size - size:max_size]]
+            srcs += [src_k[:, 0, :, :size], src_v[:, 0, :, :size]]
+    if dsts:
+        _foreach_copy_(dsts, srcs)
+    for kv_cache in dst_kv:
+        kv_cache._k_cache._size = max_size
+        kv_cache._v_cache._size = max_size
+    return dst_kv
+
+
+def slice_kv_cache_into(
+        dst_kv: KeysValues,
+        src_kv: KeysValues,
+        sample: int,
+        start: int,
+        size: int,
+        k_offset: Optional[torch.Tensor] = None,
+        v_offset: Optional[torch.Tensor] = None
+) -> KeysValues:
+    """
+    Overview:
+        Copy the ``size`` tokens starting at ``start`` of one sample of the batched ``src_kv`` to the front of the \
+        single-sample ``dst_kv``, for the keys and values of all layers at once. This is the inverse of \
+        ``left_pad_kv_caches_into``: trimming the left padding of a sample is done in one copy, without \
+        intermediate tensors. The tokens past ``size`` are left as they are: like those of a freshly allocated \
+        cache, they are never read, since the size of the caches acts as their write pointer.
+    Arguments:
+        - dst_kv (:obj:`KeysValues`): The destination KeysValues, with ``n == 1``. It is re-attached to its stacked \
+            buffer if its caches were replaced.
+        - src_kv (:obj:`KeysValues`): The batched source KeysValues.
+        - sample (:obj:`int`): The index of the sample in ``src_kv``.
+        - start (:obj:`int`): The index of the first token to copy.
+        - size (:obj:`int`): The number of tokens to copy.
+        - k_offset (:obj:`Optional[torch.Tensor]`): A (num_layers, num_heads, size, head_dim) tensor added to the \
+            copied keys, e.g. a positional-encoding correction. The addition writes straight into ``dst_kv``, so \
+            it costs no extra pass over the tokens.
+        - v_offset (:obj:`Optional[torch.Tensor]`): The same for the values. Given together with ``k_offset``.
+    Returns:
+        - dst_kv (:obj:`KeysValues`): The destination KeysValues, whose caches all hold ``size`` tokens.
+    """
+    if not dst_kv.is_stacked():
+        dst_kv._bind_buffer(dst_kv._buffer)
+    src_k, src_v = stack_keys_values(src_kv)
+    dst_k, dst_v = dst_kv._k_buffer[:, 0, :, :size], dst_kv._v_buffer[:, 0, :, :size]
+    src_k, src_v = src_k[:, sample, :, start:start + size], src_v[:, sample, :, start:start + size]
+    if k_offset is None:
+        _foreach_copy_([dst_k, dst_v], [src_k, src_v])
+    else:
+        torch.add(src_k, k_offset, out=dst_k)
+        torch.add(src_v, v_offset, out=dst_v)
+    for kv_cache in dst_kv:
+        kv_cache._k_cache._size = size
+        kv_cache._v_cache._size = size
     return dst_kv
 
 
@@ -120,6 +304,10 @@ def to_device_for_kvcache(keys_values: KeysValues, device: str) -> KeysValues:
     """
     Transfer all KVCache objects within the KeysValues object to a certain device.
 
+    When the caches are backed by the stacked buffers, the transfer is done with one non-blocking copy for keys and \
+    one for values, which overlaps with other work when the host buffers are pinned. Device-to-host transfers are \
+    synchronized once before returning, so the host tensors are safe to read.
+
     Arguments:
         - keys_values (KeysValues): The KeysValues object to be transferred.
         - device (str): The device to transfer to.
@@ -128,66 +316,196 @@ def to_device_for_kvcache(keys_values: KeysValues, device: str) -> KeysValues:
     """
     target_device = torch.device(device)
 
+    if keys_values.is_stacked():
+        source_device = keys_values._k_buffer.device
+        if source_device == target_device:
+            return keys_values
+        keys_values._bind_buffer(keys_values._buffer.to(target_device, non_blocking=True))
+        if source_device.type == 'cuda' and target_device.type == 'cpu':
+            torch.cuda.current_stream(source_device).synchronize()
+        return keys_values
+
     for kv_cache in keys_values:
         if kv_cache._k_cache._cache.device != target_device:
             kv_cache._k_cache._cache = kv_cache._k_cache._cache.to(target_device)
         if kv_cache._v_cache._cache.device != target_device:
             kv_cache._v_cache._cache = kv_cache._v_cache._cache.to(target_device)
+    keys_values._update_metadata()
     return keys_values
 
 
-def convert_to_depth(search_path, depth_map, last_depth):
-    # Get the newly added element
+def convert_to_depth(search_path, depth_arr, parent_arr, last_depth):
+    """
+    Overview:
+        Compute the depth of the node newly appended to ``search_path`` from the depth of its parent and append it to \
+        ``last_depth``. The depth is read from a per-node array, so each call is O(1) regardless of the tree size.
+    Arguments:
+        - search_path (:obj:`list`): The node indices of the current search path, whose last element is the new node.
+        - depth_arr (:obj:`np.ndarray`): Integer array where ``depth_arr[i]`` is the depth of node ``i``; it is updated \
+            in place for the new node.
+        - parent_arr (:obj:`np.ndarray`): Integer array where ``parent_arr[i]`` is the index of the parent of node ``i``.
+        - last_depth (:obj:`list`): The list of depths to append to.
+    Returns:
+        - last_depth (:obj:`list`): The updated list of depths.
+    """
     new_index = search_path[-1]
-
-    # If the depth of the newly added element has not been calculated, compute it based on the depth of the parent node
-    if new_index not in depth_map:
-        if search_path[new_index] not in depth_map:
-            depth_map[search_path[new_index]] = max(list(depth_map.values())) + 1
-        else:
-            depth_map[new_index] = depth_map[search_path[new_index]] + 1
-
-    # Append the depth of the newly added element to the end of last_depth
-    last_depth.append(depth_map[new_index])
-
+    depth_arr[new_index] = depth_arr[parent_arr[new_index]] + 1
+    last_depth.append(int(depth_arr[new_index]))
     return last_depth
 
 
 # Function to calculate CUDA memory usage in gigabytes
 def calculate_cuda_memory_gb(past_keys_values_cache, num_layers: int):
+    """
+    Overview:
+        Calculate the memory allocated by the key and value caches of all KeysValues in ``past_keys_values_cache``. \
+        Only tensor metadata is read, so no device synchronization takes place.
+    Arguments:
+        - past_keys_values_cache (:obj:`dict`): Mapping whose values are KeysValues objects.
+        - num_layers (:obj:`int`): The number of transformer layers in each KeysValues.
+    Returns:
+        - total_memory_gb (:obj:`float`): The allocated memory in gigabytes.
+    """
     total_memory_bytes = 0
 
     # Iterate over all KeysValues instances in the OrderedDict
     for kv_instance in past_keys_values_cache.values():
-        num_layers = len(kv_instance)  # Get the number of layers
         for layer in range(num_layers):
-            kv_cache = kv_instance[layer]
-            k_shape = kv_cache._k_cache.shape  # Get the shape of the keys cache
-            v_shape = kv_cache._v_cache.shape  # Get the shape of the values cache
-
-            # Calculate the number of elements and multiply by the number of bytes per element
-            k_memory = torch.prod(torch.tensor(k_shape)) * 4
-            v_memory = torch.prod(torch.tensor(v_shape)) * 4
-
-            # Accumulate the memory used by the keys and values cache
-            layer_memory = k_memory + v_memory
-            total_memory_bytes += layer_memory.item()  # .item() ensures conversion to a standard Python number
+            k_cache = kv_instance[layer]._k_cache._cache
+            v_cache = kv_instance[layer]._v_cache._cache
+            total_memory_bytes += k_cache.numel() * k_cache.element_size() + v_cache.numel() * v_cache.element_size()
 
     # Convert total memory from bytes to gigabytes
     total_memory_gb = total_memory_bytes / (1024 ** 3)
     return total_memory_gb
 
-def hash_state(state):
+
+def hash_state(state) -> int:
     """
     Hash the state vector.
 
     Arguments:
-        state: The state vector to be hashed.
+        state: The state vector to be hashed, as a numpy array or a torch tensor.
+    Returns:
+        The 64-bit integer hash value of the state vector, equal to its key in ``hash_states``.
+    """
+    return hash_states(state.reshape(1, -1))[0]
+
+
+def hash_states(states) -> List[int]:
+    """
+    Overview:
+        Hash a batch of states, one 64-bit key per row, with xxh3 over the float32 bytes of each row. CUDA tensors \
+        are moved to the host with a single transfer for the whole batch, and numpy arrays holding the same values \
+        get the same keys.
+    Arguments:
+        - states (:obj:`Union[np.ndarray, torch.Tensor]`): The states, of shape (batch_size, ...).
     Returns:
-        The hash value of the state vector.
+        - keys (:obj:`List[int]`): The hash value of each state.
     """
-    # Use xxhash for faster hashing
-    return xxhash.xxh64(state).hexdigest()
+    if isinstance(states, torch.Tensor):
+        rows = states.detach().reshape(states.shape[0], -1).float().cpu().numpy()
+    else:
+        states = np.asarray(states, dtype=np.float32)
+        rows = states.reshape(states.shape[0], -1)
+    rows = np.ascontiguousarray(rows)
+    # The integer digest avoids hex-encoding and makes a cheaper dict key.
+    return [xxhash.xxh3_64_intdigest(row) for row in rows]
+
+
+class KVCacheIndexTable:
+    """
+    Overview:
+        Map from state hashes (64-bit ints from ``hash_states``) to shared-pool indices, implemented as an open-addressed \
+        table with linear probing over two flat slot arrays. It offers the part of the dict API used for the KV-cache \
+        lookups (``get``, item access, ``in``, ``len`` and ``clear``), plus ``get_many`` to resolve the keys of a \
+        whole batch of environments in one call, and ``clear`` resets the slots in place instead of dropping and \
+        re-allocating entries, so the per-search churn creates no garbage.
+    """
+
+    _EMPTY = -1
+
+    def __init__(self, capacity: int = 1024) -> None:
+        """
+        Overview:
+            Initialize the table.
+        Arguments:
+            - capacity (:obj:`int`): The initial number of slots, rounded up to a power of two. The table grows when \
+                it is three quarters full.
+        """
+        self._allocate(1 << max(int(capacity) - 1, 1).bit_length())
+
+    def _allocate(self, capacity: int) -> None:
+        self._mask = capacity - 1
+        self._empty_values = [self._EMPTY] * capacity
+        self._keys = [0] * capacity
+        self._values = list(self._empty_values)
+        self._len = 0
+
+    def _find_slot(self, key: int) -> int:
+        keys, values, mask = self._keys, self._values, self._mask
+        slot = key & mask
+        while values[slot] != self._EMPTY and keys[slot] != key:
+            slot = (slot + 1) & mask
+        return slot
+
+    def get(self, key: int, default: Optional[int] = None) -> Optional[int]:
+        slot = self._find_slot(key)
+        value = self._values[slot]
+        return default if value == self._EMPTY else value
+
+    def get_many(self, keys: List[int]) -> List[Optional[int]]:
+        """
+        Overview:
+            Look up a batch of keys, with the probing loop inlined so that the per-key cost is a few list accesses.
+        Arguments:
+            - keys (:obj:`List[int]`): The keys to look up.
+        Returns:
+            - values (:obj:`List[Optional[int]]`): The value of each key, or None for a missing key.
+        """
+        table_keys, table_values, mask, empty = self._keys, self._values, self._mask, self._EMPTY
+        results = []
+        for key in keys:
+            slot = key & mask
+            value = table_values[slot]
+            while value != empty and table_keys[slot] != key:
+                slot = (slot + 1) & mask
+                value = table_values[slot]
+            results.append(None if value == empty else value)
+        return results
+
+    def __getitem__(self, key: int) -> int:
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: int, value: int) -> None:
+        slot = self._find_slot(key)
+        if self._values[slot] == self._EMPTY:
+            if 4 * (self._len + 1) > 3 * len(self._keys):
+                self._grow()
+                slot = self._find_slot(key)
+            self._len += 1
+        self._keys[slot] = key
+        self._values[slot] = value
+
+    def _grow(self) -> None:
+        items = [(k, v) for k, v in zip(self._keys, self._values) if v != self._EMPTY]
+        self._allocate(2 * len(self._keys))
+        for key, value in items:
+            self[key] = value
+
+    def __contains__(self, key: int) -> bool:
+        return self.get(key) is not None
+
+    def __len__(self) -> int:
+        return self._len
+
+    def clear(self) -> None:
+        self._values[:] = self._empty_values
+        self._len = 0
+
 
 @dataclass
 class WorldModelOutput:
@@ -201,38 +519,58 @@ class WorldModelOutput:
 
 def init_weights(module, norm_type='BN'):
     """
-    Initialize the weights of the module based on the specified normalization type.
+    Initialize the weights of the module and all of its submodules based on the specified normalization type.
+
+    The parameters are grouped by init rule in a single pass over ``module.modules()``, and each group is initialized
+    with a few fused ops instead of one small kernel per parameter: Linear/Embedding weights are filled from one
+    normal sample per (device, dtype), biases are zeroed and norm weights set to one with foreach ops. Conv2d weights
+    keep their per-module Kaiming/Xavier init. Call it once on the root module rather than through ``module.apply``.
 
     Arguments:
-        module (nn.Module): The module to initialize.
+        module (nn.Module): The root module to initialize.
         norm_type (str): The type of normalization to use ('BN' for BatchNorm, 'LN' for LayerNorm).
     """
-    if isinstance(module, (nn.Linear, nn.Embedding)):
-        module.weight.data.normal_(mean=0.0, std=0.02)
-        if isinstance(module, nn.Linear) and module.bias is not None:
-            module.bias.data.zero_()
-    elif isinstance(module, (nn.LayerNorm, nn.GroupNorm)):
-        print(f"Init {module} using zero bias, 1 weight")
-        module.bias.data.zero_()
-        module.weight.data.fill_(1.0)
-    elif isinstance(module, nn.BatchNorm2d):
-        print(f"Init nn.BatchNorm2d using zero bias, 1 weight")
-        module.weight.data.fill_(1.0)
-        module.bias.data.zero_()
-    elif isinstance(module, nn.Conv2d):
-        if norm_type == 'BN':
-            nn.init.kaiming_normal_(module.weight, mode='fan_out', nonlinearity='relu')
-            print(f"Init nn.Conv2d using kaiming normal for BN")
-        elif norm_type == 'LN':
-            nn.init.xavier_uniform_(module.weight)
-            print(f"Init nn.Conv2d using xavier uniform for LN")
-    elif isinstance(module, nn.Linear):
-        if norm_type == 'BN':
-            nn.init.kaiming_normal_(module.weight, mode='fan_out', nonlinearity='relu')
-            print("Init Linear using kaiming normal for BN")
-        elif norm_type == 'LN':
-            nn.init.xavier_uniform_(module.weight)
-            print("Init Linear using xavier uniform for LN")
+    normal_weights, zero_tensors, one_tensors = [], [], []
+    for m in module.modules():
+        if isinstance(m, (nn.Linear, nn.Embedding)):
+            normal_weights.append(m.weight)
+            if isinstance(m, nn.Linear) and m.bias is not None:
+                zero_tensors.append(m.bias)
+        elif isinstance(m, (nn.LayerNorm, nn.GroupNorm, nn.BatchNorm2d)):
+            logger.debug(f"Init {m} using zero bias, 1 weight")
+            if m.weight is not None:
+                one_tensors.append(m.weight)
+            if m.bias is not None:
+                zero_tensors.append(m.bias)
+        elif isinstance(m, nn.Conv2d):
+            if norm_type == 'BN':
+                nn.init.kaiming_normal_(m.weight, mode='fan_out', nonlinearity='relu')
+                logger.debug("Init nn.Conv2d using kaiming normal for BN")
+            elif norm_type == 'LN':
+                nn.init.xavier_uniform_(m.weight)
+                logger.debug("Init nn.Conv2d using xavier uniform for LN")
+
+    with torch.no_grad():
+        groups = defaultdict(list)
+        for weight in normal_weights:
+            groups[(weight.device, weight.dtype)].append(weight)
+        for (device, dtype), weights in groups.items():
+            flat = torch.empty(sum(w.numel() for w in weights), device=device, dtype=dtype).normal_(mean=0.0, std=0.02)
+            samples = [sample.view_as(w) for sample, w in zip(flat.split([w.numel() for w in weights]), weights)]
+            _foreach_copy_(weights, samples)
+        if zero_tensors:
+            _foreach_zero_(zero_tensors)
+        if one_tensors:
+            _foreach_zero_(one_tensors)
+            _foreach_add_(one_tensors, 1.0)
+
+
+def _copy_nested_dict(d: dict) -> dict:
+    """
+    Overview:
+        Copy a dict and the dicts nested in it, without copying the leaf values.
+    """
+    return {k: _copy_nested_dict(v) if isinstance(v, dict) else v for k, v in d.items()}
 
 
 class LossWithIntermediateLosses:
@@ -246,14 +584,16 @@ class LossWithIntermediateLosses:
     Returns:
         - None
     """
+    # The losses that contribute to ``loss_total``, in the order of the weights built in ``__init__``.
+    _WEIGHT_KEYS = (
+        'loss_obs', 'loss_rewards', 'loss_policy', 'loss_value', 'loss_ends', 'latent_recon_loss', 'perceptual_loss'
+    )
+
     def __init__(self, latent_recon_loss_weight=0, perceptual_loss_weight=0, continuous_action_space=False, **kwargs):
         # Ensure that kwargs is not empty
         if not kwargs:
             raise ValueError("At least one loss must be provided")
 
-        # Get a reference device from one of the provided losses
-        device = next(iter(kwargs.values())).device
-
         # NOTE: Define the weights for each loss type
         if not continuous_action_space:
             # like EZV2, for atari and memory
@@ -273,31 +613,78 @@ class LossWithIntermediateLosses:
         self.latent_recon_loss_weight = latent_recon_loss_weight
         self.perceptual_loss_weight = perceptual_loss_weight
 
-        # Initialize the total loss tensor on the correct device
-        self.loss_total = torch.tensor(0., device=device)
-        for k, v in kwargs.items():
-            if k == 'loss_obs':
-                self.loss_total += self.obs_loss_weight * v
-            elif k == 'loss_rewards':
-                self.loss_total += self.reward_loss_weight * v
-            elif k == 'loss_policy':
-                self.loss_total += self.policy_loss_weight * v
-            elif k == 'loss_value':
-                self.loss_total += self.value_loss_weight * v
-            elif k == 'loss_ends':
-                self.loss_total += self.ends_loss_weight * v
-            elif k == 'latent_recon_loss':
-                self.loss_total += self.latent_recon_loss_weight * v
-            elif k == 'perceptual_loss':
-                self.loss_total += self.perceptual_loss_weight * v
-
-        self.intermediate_losses = {
-            k: v if isinstance(v, dict) or isinstance(v, torch.Tensor) else (v if isinstance(v, float) else v.item())
-            for k, v in kwargs.items()
-        }
+        weights = dict(
+            zip(
+                self._WEIGHT_KEYS, (
+                    self.obs_loss_weight, self.reward_loss_weight, self.policy_loss_weight, self.value_loss_weight,
+                    self.ends_loss_weight, self.latent_recon_loss_weight, self.perceptual_loss_weight
+                )
+            )
+        )
+        # Reduce the weighted losses with a single stack + sum, instead of one in-place add per loss. The products are
+        # plain out-of-place ops, since the losses are still part of the autograd graph.
+        weighted_keys = [k for k in kwargs if k in weights]
+        if weighted_keys:
+            self.loss_total = torch.stack([kwargs[k] * float(weights[k]) for k in weighted_keys]).sum()
+        else:
+            # Initialize the total loss tensor on the device of the provided losses
+            self.loss_total = torch.tensor(0., device=next(iter(kwargs.values())).device)
+
+        # Tensors are kept as they are, so that building the losses never synchronizes with the device; use
+        # ``intermediate_losses_cpu`` to read them as Python numbers.
+        self.intermediate_losses = dict(kwargs)
+        self._intermediate_losses_cpu = None
+
+    @staticmethod
+    def _collect_slots(losses: dict) -> tuple:
+        """
+        Overview:
+            Collect the (container, key) slots of the tensor-valued and of the other leaf values of ``losses``, \
+            descending into nested dicts.
+        """
+        tensor_slots, other_slots = [], []
+        pending = [losses]
+        while pending:
+            container = pending.pop()
+            for k, v in container.items():
+                if isinstance(v, torch.Tensor):
+                    tensor_slots.append((container, k))
+                elif isinstance(v, dict):
+                    pending.append(v)
+                else:
+                    other_slots.append((container, k))
+        return tensor_slots, other_slots
+
+    @property
+    def intermediate_losses_cpu(self) -> dict:
+        """
+        Overview:
+            The intermediate losses with every scalar tensor converted to a Python number. All scalars are moved to \
+            the host with a single ``torch.stack(...).cpu()``, i.e. one device synchronization, on the first access.
+        """
+        if self._intermediate_losses_cpu is None:
+            result = _copy_nested_dict(self.intermediate_losses)
+            tensor_slots, other_slots = self._collect_slots(result)
+            scalar_slots = [(container, k) for container, k in tensor_slots if container[k].dim() == 0]
+            if scalar_slots:
+                device = scalar_slots[0][0][scalar_slots[0][1]].device
+                values = torch.stack(
+                    [container[k].detach().to(device=device, dtype=torch.float32) for container, k in scalar_slots]
+                ).cpu().tolist()
+                for (container, k), value in zip(scalar_slots, values):
+                    container[k] = value
+            for container, k in other_slots:
+                if hasattr(container[k], 'item'):
+                    container[k] = container[k].item()
+            self._intermediate_losses_cpu = result
+        return self._intermediate_losses_cpu
 
     def __truediv__(self, value):
-        for k, v in self.intermediate_losses.items():
-            self.intermediate_losses[k] = v / value
+        # Divide all losses, including those nested in dicts. The division is out of place since these tensors, and
+        # loss_total in particular, may still be needed by autograd.
+        tensor_slots, other_slots = self._collect_slots(self.intermediate_losses)
+        for losses, k in tensor_slots + other_slots:
+            losses[k] = losses[k] / value
         self.loss_total = self.loss_total / value
+        self._intermediate_losses_cpu = None
         return self
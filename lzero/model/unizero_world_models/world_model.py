@@ -1,4 +1,7 @@
 import logging
+import math
+from collections import OrderedDict
+from contextlib import contextmanager
 from typing import Dict, Union, Optional, List, Tuple, Any
 
 import numpy as np
@@ -6,22 +9,28 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from einops import rearrange
-from torch.distributions import Categorical, Independent, Normal, TransformedDistribution, TanhTransform
+from torch.distributions import Independent, Normal
 
 from lzero.model.common import SimNorm
 from lzero.model.utils import cal_dormant_ratio
-from lzero.model.unizero_world_models.modeling.kv_caching import KeysValues
+from lzero.model.unizero_world_models.modeling.kv_caching import KeysValues, QuantizedKeysValues, StaticKVCachePool
 from .modeling.gaam import GAAM
-from .slicer import Head, PolicyHeadCont
+from .slicer import FusedHeads, Head, PolicyHeadCont
 from .tokenizer import Tokenizer
 from lzero.model.unizero_world_models.modeling.transformer import Transformer, TransformerConfig
 from lzero.model.unizero_world_models.modeling.adaptive_attention import AdaptiveSpanAttention
-from .utils import LossWithIntermediateLosses, init_weights, WorldModelOutput, hash_state
+from .utils import LossWithIntermediateLosses, init_weights, WorldModelOutput, hash_states, copy_kv_cache_into, \
+    KVCacheIndexTable, copy_kv_token_range_into, left_pad_kv_caches_into, slice_kv_cache_into
 from .visualize_utils import visualize_reward_value_img_policy, visualize_sequence_only
 from .attention_map import visualize_attention_maps, visualize_attention_map
 
 logging.getLogger().setLevel(logging.DEBUG)
 
+# The heads computed by ``WorldModel.forward``: all of them by default, and per step of a recurrent inference.
+ALL_HEADS = frozenset(('observations', 'rewards', 'policy', 'value'))
+ACT_STEP_HEADS = frozenset(('observations', 'rewards'))
+OBS_STEP_HEADS = frozenset(('policy', 'value'))
+
 
 class WorldModel(nn.Module):
     """
@@ -34,6 +43,16 @@ class WorldModel(nn.Module):
             - and heads, which generate the logits for observations, rewards, policy, and value.
     """
 
+    # ``torch.compile``-d ``_forward_core``, shared by all instances and created on first use, so that the model
+    # itself stays deep-copyable.
+    _compiled_forward_core = None
+    # The compiled ``_assemble_obs_act``, shared by all instances and created on first use.
+    _compiled_assemble_obs_act = None
+    # The compiled ``_masked_obs_loss``, shared by all instances and created on first use.
+    _compiled_masked_obs_loss = None
+    # The compiled ``_masked_cross_entropy``, shared by all instances and created on first use.
+    _compiled_masked_cross_entropy = None
+
     def __init__(self, config: TransformerConfig, tokenizer) -> None:
         """
         Overview:
@@ -46,6 +65,18 @@ class WorldModel(nn.Module):
         self.tokenizer = tokenizer
         self.config = config
         self.transformer = Transformer(self.config)
+        # Key and value projections of every block, used to precompute the projected positional embeddings.
+        self._attn_key_fns = [block.attn.key for block in self.transformer.blocks]
+        self._attn_value_fns = [block.attn.value for block in self.transformer.blocks]
+        # The (layer index, attention) pairs of the adaptive-span and GAAM blocks, whose learned spans are regularized
+        # and logged by compute_loss.
+        self._adaptive_span_attns = [
+            (i, block.attn) for i, block in enumerate(self.transformer.blocks)
+            if isinstance(block.attn, AdaptiveSpanAttention)
+        ]
+        self._gaam_attns = [
+            (i, block.attn) for i, block in enumerate(self.transformer.blocks) if isinstance(block.attn, GAAM)
+        ]
 
         if self.config.device == 'cpu':
             self.device = torch.device('cpu')
@@ -63,6 +94,18 @@ class WorldModel(nn.Module):
 
         self.hidden_size = config.embed_dim // config.num_heads
 
+        # Position ids shared by the position-embedding lookups and the other index computations, so that hot paths
+        # slice them instead of launching a new arange each call; see _arange.
+        self.register_buffer('positions', torch.arange(config.max_tokens, device=self.device), persistent=False)
+        # Discount coefficients gamma ** t of the training losses, sliced per unroll length; see _discounts.
+        self.register_buffer('discounts', config.gamma ** self.positions, persistent=False)
+        # Upper bound of the span center of each GAAM block, so that compute_loss builds no host tensor per step.
+        self.register_buffer(
+            'gaam_max_lens',
+            torch.tensor([float(attn.max_len) for _, attn in self._gaam_attns], device=self.device).view(-1, 1),
+            persistent=False
+        )
+
         # Position embedding
         if not self.config.rotary_emb:
             self.pos_emb = nn.Embedding(config.max_tokens, config.embed_dim, device=self.device)
@@ -74,9 +117,10 @@ class WorldModel(nn.Module):
         # Initialize action embedding table
         if self.continuous_action_space:
             # TODO: check the effect of SimNorm
+            # SimNorm has no parameters, so the instance of the observation head is shared.
             self.act_embedding_table = nn.Sequential(
                 nn.Linear(config.action_space_size, config.embed_dim, device=self.device, bias=False),
-                SimNorm(simnorm_dim=self.group_size))
+                self.sim_norm)
         else:
             # for discrete action space
             self.act_embedding_table = nn.Embedding(config.action_space_size, config.embed_dim, device=self.device)
@@ -93,9 +137,11 @@ class WorldModel(nn.Module):
         else:
             self.head_policy = self._create_head(self.value_policy_tokens_pattern, self.action_space_size)
         self.head_value = self._create_head(self.value_policy_tokens_pattern, self.support_size)
+        # The discrete policy head and the value head read the same tokens, so at inference they run as one fused head.
+        self._fused_policy_value = None if self.continuous_action_space else FusedHeads([self.head_policy, self.head_value])
 
         # Apply weight initialization, the order is important
-        self.apply(lambda module: init_weights(module, norm_type=self.config.norm_type))
+        init_weights(self, norm_type=self.config.norm_type)
         self._initialize_last_layer()
 
         # Cache structures
@@ -107,35 +153,47 @@ class WorldModel(nn.Module):
         # Hit count and query count statistics
         self._initialize_statistics()
 
-        # Initialize keys and values for transformer
-        self._initialize_transformer_keys_values()
-
-        self.latent_recon_loss = torch.tensor(0., device=self.device)
-        self.perceptual_loss = torch.tensor(0., device=self.device)
-
         # TODO: check the size of the shared pool
         # for self.kv_cache_recurrent_infer
         # If needed, recurrent_infer should store the results of the one MCTS search.
         self.num_simulations = getattr(self.config, 'num_simulations', 50)
         self.shared_pool_size = int(self.num_simulations*self.env_num)
-        self.shared_pool_recur_infer = [None] * self.shared_pool_size
         self.shared_pool_index = 0
 
         # for self.kv_cache_init_infer
         # In contrast, init_infer only needs to retain the results of the most recent step.
         # self.shared_pool_size_init = int(2*self.env_num)
         self.shared_pool_size_init = int(2)  # NOTE: Will having too many cause incorrect retrieval of the kv cache?
-        self.shared_pool_init_infer = [[None] * self.shared_pool_size_init for _ in range(self.env_num)]
         self.shared_pool_index_init_envs = [0 for _ in range(self.env_num)]
 
         # for self.kv_cache_wm
         self.shared_pool_size_wm = int(self.env_num)
-        self.shared_pool_wm = [None] * self.shared_pool_size_wm
         self.shared_pool_index_wm = 0
 
+        # Initialize keys and values for transformer, including the shared pools
+        self._initialize_transformer_keys_values()
+
+        # Constant zero losses used while the reconstruction and perceptual losses are disabled. Registered as
+        # non-persistent buffers so that they follow the module across devices without entering the state dict.
+        self.register_buffer('latent_recon_loss', torch.zeros((), device=self.device), persistent=False)
+        self.register_buffer('perceptual_loss', torch.zeros((), device=self.device), persistent=False)
+
         self.reanalyze_phase = False
         self.last_obs_embeddings = []
 
+    def _copy_into_pool(self, pool: List[KeysValues], idx: int, src_kv: KeysValues) -> KeysValues:
+        """
+        Overview:
+            Copy ``src_kv`` into slot ``idx`` of a shared pool. All slots are allocated when the pools are created.
+        Arguments:
+            - pool (:obj:`List[KeysValues]`): The shared pool.
+            - idx (:obj:`int`): The slot index in the pool.
+            - src_kv (:obj:`KeysValues`): The source KeysValues object from which data is copied.
+        Returns:
+            - slot (:obj:`KeysValues`): The pool slot holding the copy.
+        """
+        return copy_kv_cache_into(pool[idx], src_kv)
+
     def custom_copy_kv_cache_to_shared_init_envs(self, src_kv: KeysValues, env_id) -> int:
         """
         Overview:
@@ -146,30 +204,9 @@ class WorldModel(nn.Module):
         Returns:
             - index (:obj:`int`): The index in the shared pool where the KeysValues object is stored.
         """
-        src_kv_shape = src_kv._keys_values[0]._k_cache._cache.shape
-        
-        if self.shared_pool_init_infer[env_id][self.shared_pool_index_init_envs[env_id]] is None:
-            self.shared_pool_init_infer[env_id][self.shared_pool_index_init_envs[env_id]] = KeysValues(
-                src_kv_shape[0],  # Number of elements (n)
-                src_kv_shape[1],  # Number of attention heads (num_heads)
-                src_kv_shape[2],  # Maximum number of tokens (max_tokens)
-                src_kv_shape[3] * src_kv_shape[1],  # Embedding dimension (embed_dim)
-                len(src_kv),  # Number of layers (num_layers)
-                src_kv._keys_values[0]._k_cache._cache.device,  # Device where the cache is stored
-            )
-        
-        dst_kv = self.shared_pool_init_infer[env_id][self.shared_pool_index_init_envs[env_id]]
-        
-        for src_layer, dst_layer in zip(src_kv._keys_values, dst_kv._keys_values):
-            # Copy the key and value caches using torch.copy_() for efficient data transfer
-            dst_layer._k_cache._cache.copy_(src_layer._k_cache._cache)
-            dst_layer._v_cache._cache.copy_(src_layer._v_cache._cache)
-            dst_layer._k_cache._size = src_layer._k_cache._size
-            dst_layer._v_cache._size = src_layer._v_cache._size
-        
         index = self.shared_pool_index_init_envs[env_id]
-        self.shared_pool_index_init_envs[env_id] = (self.shared_pool_index_init_envs[env_id] + 1) % self.shared_pool_size_init
-        
+        self._copy_into_pool(self.shared_pool_init_infer[env_id], index, src_kv)
+        self.shared_pool_index_init_envs[env_id] = (index + 1) % self.shared_pool_size_init
         return index
 
     def custom_copy_kv_cache_to_shared_wm(self, src_kv: KeysValues) -> int:
@@ -179,33 +216,29 @@ class WorldModel(nn.Module):
         Arguments:
             - src_kv (:obj:`KeysValues`): The source KeysValues object from which data is copied.
         Returns:
-            - index (:obj:`int`): The index in the shared pool where the KeysValues object is stored.
+            - dst_kv (:obj:`KeysValues`): The KeysValues object in the shared pool holding the copy.
         """
-        src_kv_shape = src_kv._keys_values[0]._k_cache._cache.shape
-        
-        if self.shared_pool_wm[self.shared_pool_index_wm] is None:
-            self.shared_pool_wm[self.shared_pool_index_wm] = KeysValues(
-                src_kv_shape[0],  # Number of elements (n)
-                src_kv_shape[1],  # Number of attention heads (num_heads)
-                src_kv_shape[2],  # Maximum number of tokens (max_tokens)
-                src_kv_shape[3] * src_kv_shape[1],  # Embedding dimension (embed_dim)
-                len(src_kv),  # Number of layers (num_layers)
-                src_kv._keys_values[0]._k_cache._cache.device,  # Device where the cache is stored
-            )
-        
-        dst_kv = self.shared_pool_wm[self.shared_pool_index_wm]
-        
-        for src_layer, dst_layer in zip(src_kv._keys_values, dst_kv._keys_values):
-            # Copy the key and value caches using torch.copy_() for efficient data transfer
-            dst_layer._k_cache._cache.copy_(src_layer._k_cache._cache)
-            dst_layer._v_cache._cache.copy_(src_layer._v_cache._cache)
-            dst_layer._k_cache._size = src_layer._k_cache._size
-            dst_layer._v_cache._size = src_layer._v_cache._size
-        
+        dst_kv = self._copy_into_pool(self.shared_pool_wm, self.shared_pool_index_wm, src_kv)
         self.shared_pool_index_wm = (self.shared_pool_index_wm + 1) % self.shared_pool_size_wm
-        
         return dst_kv
 
+    def _kv_cache_for_batching(self, matched_value: KeysValues) -> KeysValues:
+        """
+        Overview:
+            Get a pool entry that was hit by a cache lookup, ready to be gathered by ``trim_and_pad_kv_cache``. The \
+            gather only reads its sources and copies them into self.keys_values_wm, on which the forward pass then \
+            runs, so a full-precision entry on the model device is handed out as is. Quantized or reduced-precision \
+            snapshots are first restored into the world model pool.
+        Arguments:
+            - matched_value (:obj:`Union[KeysValues, QuantizedKeysValues]`): The pool entry.
+        Returns:
+            - kv (:obj:`KeysValues`): A KeysValues with the entry's tokens, which must not be written to.
+        """
+        if isinstance(matched_value, KeysValues) and matched_value.device == self.keys_values_wm.device \
+                and matched_value._buffer.dtype == self.keys_values_wm._buffer.dtype:
+            return matched_value
+        return self.custom_copy_kv_cache_to_shared_wm(matched_value)
+
     def custom_copy_kv_cache_to_shared_recur(self, src_kv: KeysValues) -> int:
         """
         Overview:
@@ -215,30 +248,9 @@ class WorldModel(nn.Module):
         Returns:
             - index (:obj:`int`): The index in the shared pool where the KeysValues object is stored.
         """
-        src_kv_shape = src_kv._keys_values[0]._k_cache._cache.shape
-        
-        if self.shared_pool_recur_infer[self.shared_pool_index] is None:
-            self.shared_pool_recur_infer[self.shared_pool_index] = KeysValues(
-                src_kv_shape[0],  # Number of elements (n)
-                src_kv_shape[1],  # Number of attention heads (num_heads)
-                src_kv_shape[2],  # Maximum number of tokens (max_tokens)
-                src_kv_shape[3] * src_kv_shape[1],  # Embedding dimension (embed_dim)
-                len(src_kv),  # Number of layers (num_layers)
-                src_kv._keys_values[0]._k_cache._cache.device,  # Device where the cache is stored
-            )
-        
-        dst_kv = self.shared_pool_recur_infer[self.shared_pool_index]
-        
-        for src_layer, dst_layer in zip(src_kv._keys_values, dst_kv._keys_values):
-            # Copy the key and value caches using torch.copy_() for efficient data transfer
-            dst_layer._k_cache._cache.copy_(src_layer._k_cache._cache)
-            dst_layer._v_cache._cache.copy_(src_layer._v_cache._cache)
-            dst_layer._k_cache._size = src_layer._k_cache._size
-            dst_layer._v_cache._size = src_layer._v_cache._size
-        
         index = self.shared_pool_index
-        self.shared_pool_index = (self.shared_pool_index + 1) % self.shared_pool_size
-        
+        self._copy_into_pool(self.shared_pool_recur_infer, index, src_kv)
+        self.shared_pool_index = (index + 1) % self.shared_pool_size
         return index
 
     def _initialize_config_parameters(self) -> None:
@@ -260,6 +272,41 @@ class WorldModel(nn.Module):
         self.support_size = self.config.support_size
         self.action_space_size = self.config.action_space_size
         self.max_cache_size = self.config.max_cache_size
+        # Reduced-precision storage dtype for the KV-cache snapshots of the init/recurrent inference pools.
+        # Defaults to the dtype of the working caches, so that snapshots are stored and restored without conversion.
+        kv_cache_dtype = getattr(self.config, 'kv_cache_dtype', None) or getattr(self.config, 'working_kv_cache_dtype', None)
+        self.kv_cache_dtype = getattr(torch, kv_cache_dtype) if kv_cache_dtype is not None else None
+        # Whether to run the transformer and heads through torch.compile at inference (requires torch>=2.0).
+        self.compile_forward_core = getattr(self.config, 'compile_forward_core', False) and hasattr(torch, 'compile')
+        # Whether to fuse the action embedding, the obs/act interleave and the position embeddings with torch.compile.
+        self.compile_obs_act_assembly = getattr(self.config, 'compile_obs_act_assembly', False) and \
+            hasattr(torch, 'compile')
+        # Whether to fuse the masked latent-state prediction loss of training with torch.compile.
+        self.compile_obs_loss = getattr(self.config, 'compile_obs_loss', False) and hasattr(torch, 'compile')
+        # Whether to fuse the masked cross-entropy (and policy entropy) losses of training with torch.compile.
+        self.compile_ce_loss = getattr(self.config, 'compile_ce_loss', False) and hasattr(torch, 'compile')
+        # Whether to replay the recurrent inference steps of MCTS from CUDA graphs, one per static input signature.
+        self.cuda_graph_recurrent_step = getattr(self.config, 'cuda_graph_recurrent_step', False) and \
+            torch.cuda.is_available()
+        # Whether to also replay from CUDA graphs the initial-inference passes that start from an empty cache, i.e. the
+        # batched resets of the environments whose KV cache was not found.
+        self.cuda_graph_miss_reset = getattr(self.config, 'cuda_graph_miss_reset', False) and \
+            torch.cuda.is_available()
+        # The captured graphs, from least to most recently replayed, and the maximum number of graphs kept.
+        self._cuda_graphs = OrderedDict()
+        self.cuda_graph_max_graphs = max(int(getattr(self.config, 'cuda_graph_max_graphs', 32)), 1)
+        # Set during the initial/recurrent inference of an eval-mode model: the top-level modules of the forward pass
+        # are then called through ``.forward`` directly, skipping the hook dispatch of ``nn.Module.__call__``.
+        self._fast_eval = False
+        # Scratch buffers reused across inference calls for intermediate tensors, keyed by use; see _scratch_buffer.
+        self._scratch = {}
+        # Whether the recurrent inference pool keeps its KV-cache snapshots as int8 with per-head scales.
+        self.kv_cache_quantize = getattr(self.config, 'kv_cache_quantize', False)
+        # Whether a continuing episode feeds the previous action and the new observation in one pass at initial inference.
+        self.fuse_init_act_obs = getattr(self.config, 'fuse_init_act_obs', True)
+        # Whether compute_cross_entropy_loss checks its logits, labels and loss for NaNs. Each check is a full pass
+        # over the tensor and a host synchronization, so they are only run for debugging.
+        self.debug_nan_checks = getattr(self.config, 'debug_nan_checks', False)
         self.env_num = self.config.env_num
         self.num_layers = self.config.num_layers
         self.obs_per_embdding_dim = self.config.embed_dim
@@ -268,12 +315,18 @@ class WorldModel(nn.Module):
 
     def _initialize_patterns(self) -> None:
         """Initialize patterns for block masks."""
-        self.all_but_last_latent_state_pattern = torch.ones(self.config.tokens_per_block)
-        self.all_but_last_latent_state_pattern[-2] = 0
-        self.act_tokens_pattern = torch.zeros(self.config.tokens_per_block)
-        self.act_tokens_pattern[-1] = 1
-        self.value_policy_tokens_pattern = torch.zeros(self.config.tokens_per_block)
-        self.value_policy_tokens_pattern[-2] = 1
+        # Boolean masks over the tokens of a block, kept on the model device as non-persistent buffers.
+        all_but_last_latent_state_pattern = torch.ones(self.config.tokens_per_block, dtype=torch.bool)
+        all_but_last_latent_state_pattern[-2] = False
+        act_tokens_pattern = torch.zeros(self.config.tokens_per_block, dtype=torch.bool)
+        act_tokens_pattern[-1] = True
+        value_policy_tokens_pattern = torch.zeros(self.config.tokens_per_block, dtype=torch.bool)
+        value_policy_tokens_pattern[-2] = True
+        self.register_buffer(
+            'all_but_last_latent_state_pattern', all_but_last_latent_state_pattern.to(self.device), persistent=False
+        )
+        self.register_buffer('act_tokens_pattern', act_tokens_pattern.to(self.device), persistent=False)
+        self.register_buffer('value_policy_tokens_pattern', value_policy_tokens_pattern.to(self.device), persistent=False)
 
     def _create_head(self, block_mask: torch.Tensor, output_dim: int, norm_layer=None) -> Head:
         """Create head modules for the transformer."""
@@ -327,9 +380,10 @@ class WorldModel(nn.Module):
 
     def _initialize_cache_structures(self) -> None:
         """Initialize cache structures for past keys and values."""
-        from collections import defaultdict
-        self.past_kv_cache_recurrent_infer = defaultdict(dict)
-        self.past_kv_cache_init_infer_envs = [defaultdict(dict) for _ in range(self.env_num)]
+        # Open-addressed tables from state hashes to shared-pool indices, sized for one MCTS search.
+        num_simulations = getattr(self.config, 'num_simulations', 50)
+        self.past_kv_cache_recurrent_infer = KVCacheIndexTable(2 * num_simulations * self.env_num)
+        self.past_kv_cache_init_infer_envs = [KVCacheIndexTable(64) for _ in range(self.env_num)]
 
         self.keys_values_wm_list = []
         self.keys_values_wm_size_list = []
@@ -359,62 +413,77 @@ class WorldModel(nn.Module):
         self.keys_values_wm = self.transformer.generate_empty_keys_values(n=self.env_num,
                                                                           max_tokens=self.context_length)
 
+        # The shared pools are allocated once here, so that no torch.empty() / cudaMalloc happens during MCTS.
+        # Every snapshot they hold is a single-environment cache of context_length tokens.
+        def _empty_pool(size: int, dtype: Optional[torch.dtype] = None) -> List[KeysValues]:
+            return [
+                self.transformer.generate_empty_keys_values(n=1, max_tokens=self.context_length, dtype=dtype)
+                for _ in range(size)
+            ]
+
+        if self.kv_cache_quantize:
+            self.shared_pool_recur_infer = [
+                QuantizedKeysValues(1, self.config.num_heads, self.context_length, self.config.embed_dim,
+                                    self.config.num_layers, self.device)
+                for _ in range(self.shared_pool_size)
+            ]
+        else:
+            self.shared_pool_recur_infer = _empty_pool(self.shared_pool_size, self.kv_cache_dtype)
+        # The init pool of all environments lives in one storage tensor of shape
+        # (env_num * shared_pool_size_init, num_layers, 2, 1, num_heads, context_length, head_dim); the slots of
+        # environment i are the views [i * shared_pool_size_init, (i + 1) * shared_pool_size_init).
+        self._init_pool = StaticKVCachePool(
+            self.env_num * self.shared_pool_size_init, 1, self.config.num_heads, self.context_length,
+            self.config.embed_dim, self.config.num_layers, self.device, dtype=self.kv_cache_dtype
+        )
+        self.shared_pool_init_infer = [
+            self._init_pool.slots[i * self.shared_pool_size_init:(i + 1) * self.shared_pool_size_init]
+            for i in range(self.env_num)
+        ]
+        self.shared_pool_wm = _empty_pool(self.shared_pool_size_wm)
+
     def precompute_pos_emb_diff_kv(self):
         """ Precompute positional embedding differences for key and value. """
         if self.context_length <= 2:
             # If context length is 2 or less, no context is present
             return
-        # Precompute positional embedding matrices for inference in collect/eval stages, not for training
-        self.positional_embedding_k = [
-            self._get_positional_embedding(layer, 'key')
-            for layer in range(self.config.num_layers)
-        ]
-        self.positional_embedding_v = [
-            self._get_positional_embedding(layer, 'value')
-            for layer in range(self.config.num_layers)
-        ]
+        # Precompute positional embedding matrices for inference in collect/eval stages, not for training.
+        # Shape: (num_layers, 1, num_heads, max_tokens, head_dim)
+        self.positional_embedding_k = self._get_positional_embeddings('key')
+        self.positional_embedding_v = self._get_positional_embeddings('value')
+
+        # Positional embedding differences for shifting a trimmed cache back by ``_pos_diff_start`` positions.
+        # Only the (2, context_length - 1) shift is used, so all layers are kept in two stacked tensors of shape
+        # (num_layers, 1, num_heads, end - start, head_dim) that are indexed by layer.
+        start, end = 2, self.context_length - 1
+        self._pos_diff_start, self._pos_diff_end = start, end
+        positional_embedding_k, positional_embedding_v = self.positional_embedding_k, self.positional_embedding_v
+        self.pos_emb_diff_k = positional_embedding_k[:, :, :, :end - start] - positional_embedding_k[:, :, :, start:end]
+        self.pos_emb_diff_v = positional_embedding_v[:, :, :, :end - start] - positional_embedding_v[:, :, :, start:end]
 
-        # Precompute all possible positional embedding differences
-        self.pos_emb_diff_k = []
-        self.pos_emb_diff_v = []
-
-        for layer in range(self.config.num_layers):
-            layer_pos_emb_diff_k = {}
-            layer_pos_emb_diff_v = {}
-
-            for start in [2]:
-                for end in [self.context_length - 1]:
-                    original_pos_emb_k = self.positional_embedding_k[layer][:, :, start:end, :]
-                    new_pos_emb_k = self.positional_embedding_k[layer][:, :, :end - start, :]
-                    layer_pos_emb_diff_k[(start, end)] = new_pos_emb_k - original_pos_emb_k
-
-                    original_pos_emb_v = self.positional_embedding_v[layer][:, :, start:end, :]
-                    new_pos_emb_v = self.positional_embedding_v[layer][:, :, :end - start, :]
-                    layer_pos_emb_diff_v[(start, end)] = new_pos_emb_v - original_pos_emb_v
-
-            self.pos_emb_diff_k.append(layer_pos_emb_diff_k)
-            self.pos_emb_diff_v.append(layer_pos_emb_diff_v)
-
-    def _get_positional_embedding(self, layer, attn_type) -> torch.Tensor:
+    @torch.no_grad()
+    def _get_positional_embeddings(self, attn_type) -> torch.Tensor:
         """
-         Helper function to get positional embedding for a given layer and attention type.
+         Helper function to get the positional embeddings projected by the key or value layer of every block, with
+         one batched matmul over the stacked projection weights.
 
          Arguments:
-         - layer (:obj:`int`): Layer index.
          - attn_type (:obj:`str`): Attention type, either 'key' or 'value'.
 
          Returns:
-         - torch.Tensor: The positional embedding tensor.
+         - torch.Tensor: The positional embeddings of shape (num_layers, 1, num_heads, max_tokens, head_dim).
          """
-        attn_func = getattr(self.transformer.blocks[layer].attn, attn_type)
-        if torch.cuda.is_available():
-            return attn_func(self.pos_emb.weight).view(
-                1, self.config.max_tokens, self.num_heads, self.embed_dim // self.num_heads
-            ).transpose(1, 2).to(self.device).detach()
-        else:
-            return attn_func(self.pos_emb.weight).view(
-                1, self.config.max_tokens, self.num_heads, self.embed_dim // self.num_heads
-            ).transpose(1, 2).detach()
+        projections = self._attn_key_fns if attn_type == 'key' else self._attn_value_fns
+        weight = torch.stack([projection.weight for projection in projections])  # (num_layers, out, in)
+        bias = torch.stack([
+            projection.bias if projection.bias is not None else torch.zeros_like(projection.weight[:, 0])
+            for projection in projections
+        ]).unsqueeze(1)  # (num_layers, 1, out)
+        pos_emb = self.pos_emb.weight.unsqueeze(0).expand(len(projections), -1, -1)  # (num_layers, max_tokens, in)
+        embeddings = torch.baddbmm(bias, pos_emb, weight.transpose(1, 2))
+        return embeddings.view(
+            len(projections), 1, self.config.max_tokens, self.num_heads, self.embed_dim // self.num_heads
+        ).transpose(2, 3).to(self.device)
 
     def forward(
         self,
@@ -427,7 +496,8 @@ class WorldModel(nn.Module):
         search_depth: Optional[List[int]] = None,
         original_images : Optional[torch.Tensor] = None,
         reconstructed_images : Optional[torch.Tensor] = None,
-        plot_attention : Optional[bool] = False
+        plot_attention : Optional[bool] = False,
+        needed_heads: Optional[frozenset] = None
     ) -> "WorldModelOutput":
         """
         Overview:
@@ -440,6 +510,8 @@ class WorldModel(nn.Module):
                 - 'obs_embeddings': torch.Tensor representing observation embeddings.
                 - 'act_tokens': torch.Tensor representing action tokens.
                 - 'obs_embeddings_and_act_tokens': Combined data for both observations and actions.
+                - 'act_then_obs_embeddings': Tuple of action tokens and the observation embeddings that follow them,
+                    processed in one pass at initial inference. The outputs only cover the observation tokens.
             - past_keys_values (Optional[torch.Tensor]): Cached key-value pairs for the transformer. Defaults to None.
             - kvcache_independent (bool): Flag to indicate whether key-value caching is independent. Defaults to False.
             - is_init_infer (bool): Flag to indicate if this is the initial inference step. Defaults to True.
@@ -447,6 +519,8 @@ class WorldModel(nn.Module):
             - start_pos (int or List[int]): Starting positional index for the current sequence (or batch). Defaults to 0.
             - search_depth (Optional[List[int]]): List representing the search depth for each batch element, used for
                 position encoding adjustment. Defaults to None.
+            - needed_heads (Optional[frozenset]): Names of the heads to compute, among 'observations', 'rewards',
+                'policy' and 'value'. The logits of the other heads are None. Defaults to None, i.e. all heads.
         
         Returns:
             WorldModelOutput: An output instance containing:
@@ -477,8 +551,10 @@ class WorldModel(nn.Module):
         # num_steps: int           # Number of timesteps in the sequence
         # start_pos_adjusted: Union[int, List[int]]  # Adjusted starting position index for positional encoding
 
-        if not self.config.rotary_emb:
-            start_pos_adjusted = None
+        start_pos_adjusted = None
+        if self.config.rotary_emb:
+            # Coerce the positions once; every branch below then adjusts them with int64 tensor ops.
+            start_pos, search_depth = self._positions_to_device(start_pos, search_depth)
 
         # Process observation embeddings if available.
         if "obs_embeddings" in obs_embeddings_or_act_tokens:
@@ -498,53 +574,20 @@ class WorldModel(nn.Module):
                 # Keep the observation embeddings unchanged when using rotary embeddings.
                 sequences = obs_embeddings
 
+                # Multiply by 2 because timestep only counts observations, but the sequence contains both
+                # observations and actions. In recurrent inference the search depth is added, and in the reanalyze
+                # phase the batched start_pos of shape (batch, num_columns) is padded with a zero column.
                 if is_init_infer:
-                    if self.reanalyze_phase:
-                        # During reanalyze phase in initial inference, adjust start_pos:
-                        # Multiply by 2 because timestep only counts observations,
-                        # but the sequence contains both observations and actions.
-                        start_pos_adjusted = start_pos * 2
-                        if not isinstance(start_pos_adjusted, (int, float)):
-                            # Pad zero if start_pos_adjusted is not a scalar.
-                            padding = np.zeros((start_pos_adjusted.shape[0], 1), dtype=start_pos_adjusted.dtype)
-                            start_pos_adjusted = np.concatenate([start_pos_adjusted, padding], axis=1).reshape(-1)
-                    else:
-                        # For regular initial inference, adjust start_pos accordingly.
-                        if isinstance(start_pos, (int, float)):
-                            start_pos_adjusted = start_pos * 2
-                        else:
-                            start_pos_adjusted = [pos * 2 for pos in start_pos]
+                    start_pos_adjusted = self._rotary_start_pos(start_pos, 0, pad_after=self.reanalyze_phase)
+                elif self.reanalyze_phase:
+                    start_pos_adjusted = self._rotary_start_pos(start_pos, 3, search_depth, pad_before=True)
                 else:
-                    # For recurrent inference (non-init), calculate the correct positional index.
-                    if self.reanalyze_phase:
-                        # In reanalyze phase, start_pos for batch mode might be an array that needs padding.
-                        if not isinstance(start_pos, (int, float)):
-                            padding = np.zeros((start_pos.shape[0], 1), dtype=start_pos.dtype)
-                            start_pos_adjusted = np.concatenate([start_pos, padding], axis=1).reshape(-1)
-                        # Ensure search_depth length matches adjusted start_pos.
-                        assert len(search_depth) == len(start_pos_adjusted)
-                        start_pos_adjusted = [
-                            (search_depth[i] + pos + 1) * 2 + 1 for i, pos in enumerate(start_pos_adjusted)
-                        ]
-                    else:
-                        start_pos_adjusted = [
-                            (search_depth[i] + pos) * 2 + 2 for i, pos in enumerate(start_pos)
-                        ]
+                    start_pos_adjusted = self._rotary_start_pos(start_pos, 2, search_depth)
 
         # Process action tokens if available.
         elif "act_tokens" in obs_embeddings_or_act_tokens:
-            act_tokens = obs_embeddings_or_act_tokens["act_tokens"]
-            if self.continuous_action_space:
-                num_steps = 1
-                act_tokens = act_tokens.float()
-                if len(act_tokens.shape) == 2:
-                    act_tokens = act_tokens.unsqueeze(1)
-            else:
-                if len(act_tokens.shape) == 3:
-                    act_tokens = act_tokens.squeeze(1)
-                num_steps = act_tokens.size(1)
-            # Convert action tokens to embeddings using the action embedding table.
-            act_embeddings = self.act_embedding_table(act_tokens)
+            act_embeddings = self._embed_act_tokens(obs_embeddings_or_act_tokens["act_tokens"])
+            num_steps = act_embeddings.size(1)
             if not self.config.rotary_emb:
                 sequences = self._add_position_embeddings(
                     act_embeddings, prev_steps, num_steps, kvcache_independent,
@@ -553,33 +596,34 @@ class WorldModel(nn.Module):
             else:
                 sequences = act_embeddings
 
+                # In the reanalyze phase during initial inference, the action tokens represent the current timestep,
+                # while in regular initial inference they precede the current observation.
                 if is_init_infer:
-                    if self.reanalyze_phase:
-                        # In reanalyze phase during initial inference, the action tokens represent the current timestep.
-                        start_pos_adjusted = start_pos * 2 + 1
-                        if not isinstance(start_pos_adjusted, (int, float)):
-                            padding = np.zeros((start_pos_adjusted.shape[0], 1), dtype=start_pos_adjusted.dtype)
-                            start_pos_adjusted = np.concatenate([start_pos_adjusted, padding], axis=1).reshape(-1)
-                    else:
-                        # For regular initial inference using action tokens, adjust start_pos by subtracting 1.
-                        if isinstance(start_pos, (int, float)):
-                            start_pos_adjusted = start_pos * 2 - 1
-                        else:
-                            start_pos_adjusted = [pos * 2 - 1 for pos in start_pos]
+                    offset = 1 if self.reanalyze_phase else -1
+                    start_pos_adjusted = self._rotary_start_pos(start_pos, offset, pad_after=self.reanalyze_phase)
+                elif self.reanalyze_phase:
+                    start_pos_adjusted = self._rotary_start_pos(start_pos, 3, search_depth, pad_before=True)
                 else:
-                    # During recurrent inference for action tokens.
-                    if self.reanalyze_phase:
-                        if not isinstance(start_pos, (int, float)):
-                            padding = np.zeros((start_pos.shape[0], 1), dtype=start_pos.dtype)
-                            start_pos_adjusted = np.concatenate([start_pos, padding], axis=1).reshape(-1)
-                        assert len(search_depth) == len(start_pos_adjusted)
-                        start_pos_adjusted = [
-                            (search_depth[i] + pos + 1) * 2 + 1 for i, pos in enumerate(start_pos_adjusted)
-                        ]
-                    else:
-                        start_pos_adjusted = [
-                            (search_depth[i] + pos) * 2 + 1 for i, pos in enumerate(start_pos)
-                        ]
+                    start_pos_adjusted = self._rotary_start_pos(start_pos, 1, search_depth)
+
+        # Process the action tokens and the observation embeddings that follow them in one sequence.
+        elif "act_then_obs_embeddings" in obs_embeddings_or_act_tokens:
+            assert is_init_infer and not self.reanalyze_phase and not kvcache_independent, \
+                "'act_then_obs_embeddings' is only supported at initial inference outside the reanalyze phase."
+            act_tokens, obs_embeddings = obs_embeddings_or_act_tokens["act_then_obs_embeddings"]
+            act_embeddings = self._embed_act_tokens(act_tokens)
+            if len(obs_embeddings.shape) == 2:
+                obs_embeddings = obs_embeddings.unsqueeze(1)
+            num_act_steps = act_embeddings.size(1)
+            sequences = torch.cat([act_embeddings.to(obs_embeddings.dtype), obs_embeddings], dim=1)
+            num_steps = sequences.size(1)
+            if not self.config.rotary_emb:
+                sequences = self._add_position_embeddings(
+                    sequences, prev_steps, num_steps, kvcache_independent, is_init_infer, valid_context_lengths
+                )
+            else:
+                # The action precedes the observation, so the sequence starts at the action offset.
+                start_pos_adjusted = self._rotary_start_pos(start_pos, -1)
 
         # Process combined observation embeddings and action tokens.
         elif "obs_embeddings_and_act_tokens" in obs_embeddings_or_act_tokens:
@@ -615,25 +659,74 @@ class WorldModel(nn.Module):
                     #     head_id=3,
                     #     suffix=f"{self.config.attention}_layer1_head3"
                     # )
-            # Adjust start positions: multiply by 2 as the sequence has both obs and act.
-            start_pos_adjusted = [pos * 2 for pos in start_pos]
+            if self.config.rotary_emb:
+                # Adjust start positions: multiply by 2 as the sequence has both obs and act.
+                start_pos_adjusted = self._rotary_start_pos(start_pos, 0)
         else:
-            raise ValueError("Input dictionary must contain one of 'obs_embeddings', 'act_tokens', or 'obs_embeddings_and_act_tokens'.")
+            raise ValueError(
+                "Input dictionary must contain one of 'obs_embeddings', 'act_tokens', 'act_then_obs_embeddings' or "
+                "'obs_embeddings_and_act_tokens'."
+            )
 
-        # Pass the sequence through the transformer.
-        x = self._transformer_pass(
-            sequences, past_keys_values, kvcache_independent, valid_context_lengths, start_pos=start_pos_adjusted
+        # Pass the sequence through the transformer and the heads. At inference the core can run compiled, and the
+        # fixed-shape recurrent steps of MCTS, and the resets of the cache misses, can be replayed from CUDA graphs.
+        use_cuda_graph = not kvcache_independent and valid_context_lengths is None and past_keys_values is not None \
+            and isinstance(prev_steps, int) and sequences.is_cuda and not torch.is_grad_enabled()
+        if is_init_infer:
+            use_cuda_graph = use_cuda_graph and self.cuda_graph_miss_reset and prev_steps == 0 \
+                and "act_then_obs_embeddings" not in obs_embeddings_or_act_tokens
+        else:
+            use_cuda_graph = use_cuda_graph and self.cuda_graph_recurrent_step
+        if use_cuda_graph:
+            x, logits_observations, logits_rewards, logits_policy, logits_value = self._graphed_forward_core(
+                sequences, past_keys_values, start_pos_adjusted, num_steps, prev_steps, needed_heads
+            )
+            return WorldModelOutput(x, logits_observations, logits_rewards, None, logits_policy, logits_value)
+
+        forward_core, fuse_heads = WorldModel._forward_core, True
+        if self.compile_forward_core and not torch.is_grad_enabled():
+            if WorldModel._compiled_forward_core is None:
+                # The number of cached tokens changes at almost every MCTS step. With automatic dynamic shapes the
+                # core is recompiled once with a symbolic cache length, instead of once per length until dynamo's
+                # recompile limit is hit and the recurrent steps silently fall back to eager.
+                WorldModel._compiled_forward_core = torch.compile(WorldModel._forward_core, dynamic=None)
+            forward_core, fuse_heads = WorldModel._compiled_forward_core, False
+        x, logits_observations, logits_rewards, logits_policy, logits_value = forward_core(
+            self, sequences, past_keys_values, kvcache_independent, valid_context_lengths, start_pos_adjusted,
+            num_steps, prev_steps, needed_heads, fuse_heads
         )
-
-        # Generate logits for various components.
-        logits_observations = self.head_observations(x, num_steps=num_steps, prev_steps=prev_steps)
-        logits_rewards = self.head_rewards(x, num_steps=num_steps, prev_steps=prev_steps)
-        logits_policy = self.head_policy(x, num_steps=num_steps, prev_steps=prev_steps)
-        logits_value = self.head_value(x, num_steps=num_steps, prev_steps=prev_steps)
+        if "act_then_obs_embeddings" in obs_embeddings_or_act_tokens:
+            # Drop the outputs of the leading action tokens, so that the outputs match a pass over the observation
+            # embeddings alone. Among the heads, only the observation and reward heads read action tokens.
+            x = x[:, num_act_steps:]
+            if logits_observations is not None:
+                logits_observations = logits_observations[:, num_act_steps:]
+            if logits_rewards is not None:
+                logits_rewards = logits_rewards[:, num_act_steps:]
 
         # The 'logits_ends' is intentionally set to None.
         return WorldModelOutput(x, logits_observations, logits_rewards, None, logits_policy, logits_value)
 
+    def _embed_act_tokens(self, act_tokens: torch.Tensor) -> torch.Tensor:
+        """
+        Overview:
+            Convert action tokens to embeddings of shape (batch_size, num_steps, embed_dim) with the action \
+            embedding table.
+        Arguments:
+            - act_tokens (:obj:`torch.Tensor`): Discrete action indices, or continuous action vectors.
+        Returns:
+            - act_embeddings (:obj:`torch.Tensor`): The action embeddings.
+        """
+        if self.continuous_action_space:
+            act_tokens = act_tokens.float()
+            if len(act_tokens.shape) == 2:
+                act_tokens = act_tokens.unsqueeze(1)
+        elif len(act_tokens.shape) == 3:
+            act_tokens = act_tokens.squeeze(1)
+        if self._fast_eval:
+            return self.act_embedding_table.forward(act_tokens)
+        return self.act_embedding_table(act_tokens)
+
     def _add_position_embeddings(self, embeddings, prev_steps, num_steps, kvcache_independent, is_init_infer,
                                  valid_context_lengths):
         """
@@ -650,18 +743,51 @@ class WorldModel(nn.Module):
             - torch.Tensor: Embeddings with position information added.
         """
         if kvcache_independent:
-            steps_indices = prev_steps + torch.arange(num_steps, device=embeddings.device)
-            position_embeddings = self.pos_emb(steps_indices).view(-1, num_steps, embeddings.shape[-1])
-            return embeddings + position_embeddings
+            position_embeddings = self._position_embeddings(prev_steps.view(-1, 1), num_steps)
+            return embeddings + position_embeddings.view(-1, num_steps, embeddings.shape[-1])
         else:
             if is_init_infer:
-                return embeddings + self.pos_emb(prev_steps + torch.arange(num_steps, device=self.device))
+                return embeddings + self._position_embeddings(prev_steps, num_steps)
             else:
                 valid_context_lengths = torch.tensor(self.keys_values_wm_size_list_current, device=self.device)
-                position_embeddings = self.pos_emb(
-                    valid_context_lengths + torch.arange(num_steps, device=self.device)).unsqueeze(1)
+                position_embeddings = self._position_embeddings(valid_context_lengths, num_steps).unsqueeze(1)
                 return embeddings + position_embeddings
 
+    def _position_embeddings(self, prev_steps: Union[int, torch.Tensor], num_steps: int) -> torch.Tensor:
+        """
+        Overview:
+            Look up the absolute position embeddings of positions ``prev_steps + arange(num_steps)``. For an int \
+            ``prev_steps`` this is a slice of the embedding table, a view that needs no index tensor or gather and \
+            still propagates gradients to the table.
+        Arguments:
+            - prev_steps (:obj:`Union[int, torch.Tensor]`): The first position, or a tensor of first positions.
+            - num_steps (:obj:`int`): Number of consecutive positions.
+        Returns:
+            - position_embeddings (:obj:`torch.Tensor`): The position embeddings.
+        """
+        if isinstance(prev_steps, int):
+            return self.pos_emb.weight[prev_steps:prev_steps + num_steps]
+        return self.pos_emb(prev_steps + self._arange(num_steps))
+
+    def _discounts(self, n: int) -> torch.Tensor:
+        """
+        Overview:
+            Get the discount coefficients ``gamma ** torch.arange(n)`` on the model device, as a slice of the \
+            ``discounts`` buffer when it is long enough.
+        """
+        if n <= self.discounts.shape[0]:
+            return self.discounts[:n]
+        return self.gamma ** self._arange(n)
+
+    def _arange(self, n: int) -> torch.Tensor:
+        """
+        Overview:
+            Get ``torch.arange(n)`` on the model device, as a slice of the ``positions`` buffer when it is long enough.
+        """
+        if n <= self.positions.shape[0]:
+            return self.positions[:n]
+        return torch.arange(n, device=self.positions.device)
+
     def _process_obs_act_combined_cont(self, obs_embeddings_or_act_tokens, prev_steps):
         """
         Process combined observation embeddings and action tokens.
@@ -677,29 +803,11 @@ class WorldModel(nn.Module):
             obs_embeddings = obs_embeddings.view(act_tokens.shape[0], act_tokens.shape[1], self.num_observations_tokens,
                                                  -1)
 
-        num_steps = int(obs_embeddings.size(1) * (obs_embeddings.size(2) + 1))
         if self.continuous_action_space:
             act_tokens = act_tokens.float()
             if len(act_tokens.shape) == 2:  # TODO
                 act_tokens = act_tokens.unsqueeze(-1)
-
-        # B, L, E
-        act_embeddings = self.act_embedding_table(act_tokens)
-
-        B, L, K, E = obs_embeddings.size()
-        # B, L*2, E
-        obs_act_embeddings = torch.empty(B, L * (K + 1), E, device=self.device)
-
-        for i in range(L):
-            obs = obs_embeddings[:, i, :, :]
-            act = act_embeddings[:, i, :].unsqueeze(1)
-            obs_act = torch.cat([obs, act], dim=1)
-            obs_act_embeddings[:, i * (K + 1):(i + 1) * (K + 1), :] = obs_act
-
-        return_result = obs_act_embeddings
-        if not self.config.rotary_emb:
-            return_result += self.pos_emb(prev_steps + torch.arange(num_steps, device=self.device))
-        return return_result, num_steps
+        return self._assemble_obs_act_dispatch(obs_embeddings, act_tokens, prev_steps)
 
     def _process_obs_act_combined(self, obs_embeddings_or_act_tokens, prev_steps):
         """
@@ -716,22 +824,322 @@ class WorldModel(nn.Module):
             obs_embeddings = obs_embeddings.view(act_tokens.shape[0], act_tokens.shape[1], self.num_observations_tokens,
                                                  -1)
 
-        num_steps = int(obs_embeddings.size(1) * (obs_embeddings.size(2) + 1))
-        act_embeddings = self.act_embedding_table(act_tokens)
+        return self._assemble_obs_act_dispatch(obs_embeddings, act_tokens, prev_steps)
 
+    def _assemble_obs_act_dispatch(self, obs_embeddings: torch.Tensor, act_tokens: torch.Tensor,
+                                   prev_steps: int) -> Tuple[torch.Tensor, int]:
+        """
+        Overview:
+            Run ``_assemble_obs_act``, through ``torch.compile`` when ``compile_obs_act_assembly`` is set. Only the \
+            batch dimension is marked dynamic, so every phase gets one kernel specialized to its sequence shape.
+        """
+        if not self.compile_obs_act_assembly:
+            return self._assemble_obs_act(obs_embeddings, act_tokens, prev_steps)
+        if WorldModel._compiled_assemble_obs_act is None:
+            WorldModel._compiled_assemble_obs_act = torch.compile(WorldModel._assemble_obs_act)
+        torch._dynamo.mark_dynamic(obs_embeddings, 0)
+        torch._dynamo.mark_dynamic(act_tokens, 0)
+        return WorldModel._compiled_assemble_obs_act(self, obs_embeddings, act_tokens, prev_steps)
+
+    def _assemble_obs_act(self, obs_embeddings: torch.Tensor, act_tokens: torch.Tensor,
+                          prev_steps: int) -> Tuple[torch.Tensor, int]:
+        """
+        Overview:
+            Embed the action tokens, interleave them after the observation tokens of every step and add the \
+            absolute position embeddings when rotary embeddings are not used.
+        Arguments:
+            - obs_embeddings (:obj:`torch.Tensor`): Observation embeddings of shape (B, L, K, E).
+            - act_tokens (:obj:`torch.Tensor`): Action tokens of shape (B, L, 1), or continuous actions of shape \
+                (B, L, action_dim).
+            - prev_steps (:obj:`int`): Previous steps.
+        Returns:
+            - obs_act_embeddings (:obj:`torch.Tensor`): The interleaved embeddings of shape (B, L*(K+1), E).
+            - num_steps (:obj:`int`): The number of tokens, L*(K+1).
+        """
         B, L, K, E = obs_embeddings.size()
-        obs_act_embeddings = torch.empty(B, L * (K + 1), E, device=self.device)
+        num_steps = L * (K + 1)
+
+        # Interleave the K observation tokens and the action token of every step with two strided copies into a
+        # (B, L, K+1, E) buffer, which is contiguous as (B, L*(K+1), E). Without autograd the buffer is only read by
+        # the transformer pass of this call, so a scratch buffer is reused instead of allocating a new one.
+        eager_inference = not torch.is_grad_enabled() and not self.compile_obs_act_assembly
+        if eager_inference:
+            obs_act_embeddings = self._scratch_buffer(
+                'obs_act_embeddings', (B, L, K + 1, E), obs_embeddings.dtype, obs_embeddings.device
+            )
+        else:
+            obs_act_embeddings = obs_embeddings.new_empty(B, L, K + 1, E)
+        obs_act_embeddings[:, :, :K].copy_(obs_embeddings)
+        act_weight = getattr(self.act_embedding_table, 'weight', None)
+        if eager_inference and isinstance(self.act_embedding_table, nn.Embedding) \
+                and act_weight.dtype == obs_act_embeddings.dtype and act_tokens.numel() == B * L:
+            # Gather the embeddings of the discrete actions straight into their (B*L, E) strided slots of the
+            # buffer, instead of materializing them first and copying them over.
+            torch.index_select(act_weight, 0, act_tokens.reshape(-1), out=obs_act_embeddings[:, :, K].view(B * L, E))
+        else:
+            # (B, L, E) for continuous actions and (B, L, 1, E) for discrete ones.
+            act_embeddings = self.act_embedding_table(act_tokens).view(B, L, -1, E)
+            obs_act_embeddings[:, :, K:].copy_(act_embeddings[:, :, :1])
+        obs_act_embeddings = obs_act_embeddings.view(B, num_steps, E)
 
-        for i in range(L):
-            obs = obs_embeddings[:, i, :, :]
-            act = act_embeddings[:, i, 0, :].unsqueeze(1)
-            obs_act = torch.cat([obs, act], dim=1)
-            obs_act_embeddings[:, i * (K + 1):(i + 1) * (K + 1), :] = obs_act
-            
-        return_result = obs_act_embeddings
         if not self.config.rotary_emb:
-            return_result += self.pos_emb(prev_steps + torch.arange(num_steps, device=self.device))
-        return return_result, num_steps
+            obs_act_embeddings += self._position_embeddings(prev_steps, num_steps)
+        return obs_act_embeddings, num_steps
+
+    def _scratch_buffer(self, key: str, shape: Tuple[int, ...], dtype: torch.dtype,
+                        device: torch.device) -> torch.Tensor:
+        """
+        Overview:
+            Get an uninitialized tensor of the given shape that is a view of the scratch buffer registered under \
+            ``key``. The buffer only grows, so that the varying batch sizes of collection, evaluation and \
+            reanalysis settle on one allocation. The returned tensor is overwritten by the next call with the same \
+            ``key`` and must not outlive the current forward pass.
+        Arguments:
+            - key (:obj:`str`): The name of the scratch buffer.
+            - shape (:obj:`Tuple[int, ...]`): The shape of the returned tensor.
+            - dtype (:obj:`torch.dtype`): The dtype of the returned tensor.
+            - device (:obj:`torch.device`): The device of the returned tensor.
+        Returns:
+            - tensor (:obj:`torch.Tensor`): A contiguous view of the scratch buffer.
+        """
+        numel = 1
+        for size in shape:
+            numel *= size
+        buffer = self._scratch.get(key)
+        if buffer is None or buffer.numel() < numel or buffer.dtype != dtype or buffer.device != device:
+            buffer = self._scratch[key] = torch.empty(numel, dtype=dtype, device=device)
+        return buffer[:numel].view(shape)
+
+    def _miss_keys_values(self, n: int) -> KeysValues:
+        """
+        Overview:
+            Get empty KV caches of ``context_length`` tokens for the ``n`` environments reset after a cache miss. \
+            Their storage is the ``miss_kv`` scratch buffer, so the reset caches are not reallocated at every search \
+            step. The caches are only read by ``trim_and_pad_kv_cache`` within the same inference call, which copies \
+            them into ``self.keys_values_wm``.
+        Arguments:
+            - n (:obj:`int`): The number of missed environments.
+        Returns:
+            - keys_values (:obj:`KeysValues`): The empty caches, viewing the scratch buffer.
+        """
+        dtype = self.transformer.working_kv_cache_dtype or torch.get_default_dtype()
+        shape = (self.num_layers, 2, n, self.config.num_heads, self.context_length,
+                 self.config.embed_dim // self.config.num_heads)
+        buffer = self._scratch_buffer('miss_kv', shape, dtype, self.device)
+        return KeysValues(n, self.config.num_heads, self.context_length, self.config.embed_dim, self.num_layers,
+                          self.device, buffer=buffer)
+
+    def _pad_miss_rows(self, miss_indices: List[int]) -> List[int]:
+        """
+        Overview:
+            Get the rows of the batched reset of the missed environments. When the resets are replayed from CUDA \
+            graphs, the batch is padded to the next power of two by repeating the last missed environment, so that \
+            a few graphs cover every number of misses. The padded rows are computed and ignored.
+        Arguments:
+            - miss_indices (:obj:`List[int]`): The indices of the missed environments.
+        Returns:
+            - miss_rows (:obj:`List[int]`): The indices to gather, starting with ``miss_indices``.
+        """
+        if not self.cuda_graph_miss_reset:
+            return miss_indices
+        num_rows = 1 << (len(miss_indices) - 1).bit_length()
+        return miss_indices + miss_indices[-1:] * (num_rows - len(miss_indices))
+
+    def _as_int_tensor(self, value: Union[int, List[int], np.ndarray, torch.Tensor]) -> torch.Tensor:
+        """
+        Overview:
+            Convert positions or search depths to an int64 tensor on the model device; a no-op for such a tensor.
+        """
+        return torch.as_tensor(value, dtype=torch.int64, device=self.device)
+
+    def _positions_to_device(self, start_pos, search_depth) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        """
+        Overview:
+            Convert the timesteps and the search depths of a batch to int64 tensors on the model device, with a \
+            single host-to-device transfer when both are host sequences of the same shape.
+        Arguments:
+            - start_pos (:obj:`Union[int, List[int], np.ndarray, torch.Tensor]`): The timestep of each sample.
+            - search_depth (:obj:`Optional[Union[List[int], np.ndarray, torch.Tensor]]`): The depth of each sample \
+                in the search tree.
+        Returns:
+            - start_pos (:obj:`torch.Tensor`): The int64 timesteps.
+            - search_depth (:obj:`Optional[torch.Tensor]`): The int64 depths, or None.
+        """
+        if search_depth is not None and not isinstance(start_pos, torch.Tensor) \
+                and not isinstance(search_depth, torch.Tensor):
+            start_pos_np = np.asarray(start_pos, dtype=np.int64)
+            search_depth_np = np.asarray(search_depth, dtype=np.int64)
+            if start_pos_np.shape == search_depth_np.shape:
+                start_pos, search_depth = self._as_int_tensor(np.stack([start_pos_np, search_depth_np]))
+                return start_pos, search_depth
+        start_pos = self._as_int_tensor(start_pos)
+        if search_depth is not None:
+            search_depth = self._as_int_tensor(search_depth)
+        return start_pos, search_depth
+
+    def _rotary_start_pos(self, start_pos: torch.Tensor, offset: int, search_depth: Optional[torch.Tensor] = None,
+                          pad_before: bool = False, pad_after: bool = False) -> torch.Tensor:
+        """
+        Overview:
+            Compute the rotary-embedding start positions ``(start_pos + search_depth) * 2 + offset``.
+        Arguments:
+            - start_pos (:obj:`torch.Tensor`): The int64 timestep of each sample, a scalar, a 1-D tensor, or a \
+                (batch, num_columns) tensor in the reanalyze phase.
+            - offset (:obj:`int`): The offset of the token type within the (obs, act) pair.
+            - search_depth (:obj:`Optional[torch.Tensor]`): The int64 depth of each sample in the search tree.
+            - pad_before (:obj:`bool`): Append a zero column to a 2-D ``start_pos`` and flatten it before the \
+                adjustment.
+            - pad_after (:obj:`bool`): Append a zero column to a 2-D result and flatten it after the adjustment.
+        Returns:
+            - start_pos_adjusted (:obj:`torch.Tensor`): The adjusted start positions.
+        """
+        if pad_before and start_pos.dim() == 2:
+            start_pos = F.pad(start_pos, (0, 1)).reshape(-1)
+        if search_depth is not None:
+            start_pos = start_pos + search_depth
+        start_pos_adjusted = start_pos * 2 + offset
+        if pad_after and start_pos_adjusted.dim() == 2:
+            start_pos_adjusted = F.pad(start_pos_adjusted, (0, 1)).reshape(-1)
+        return start_pos_adjusted
+
+    def _forward_core(self, sequences: torch.Tensor, past_keys_values: Optional[KeysValues], kvcache_independent: bool,
+                      valid_context_lengths: Optional[torch.Tensor], start_pos: Optional[torch.Tensor], num_steps: int,
+                      prev_steps: Union[int, torch.Tensor],
+                      needed_heads: Optional[frozenset] = None,
+                      fuse_heads: bool = True) -> Tuple[Optional[torch.Tensor], ...]:
+        """
+        Overview:
+            The tensor part of ``forward``: the transformer pass followed by the observation, reward, policy and \
+            value heads. Kept free of Python-side input handling so that it can be wrapped with ``torch.compile``.
+            Heads missing from ``needed_heads`` are skipped and their logits are None. ``fuse_heads`` must be False \
+            when the core is compiled or captured into a CUDA graph, since the fused policy/value weights are only \
+            refreshed eagerly.
+        Returns:
+            - outputs (:obj:`Tuple[Optional[torch.Tensor], ...]`): The transformer output and the logits for \
+                observations, rewards, policy and value.
+        """
+        x = self._transformer_pass(
+            sequences, past_keys_values, kvcache_independent, valid_context_lengths, start_pos=start_pos
+        )
+        if self._fast_eval:
+            head_observations, head_rewards = self.head_observations.forward, self.head_rewards.forward
+            head_policy, head_value = self.head_policy.forward, self.head_value.forward
+        else:
+            head_observations, head_rewards = self.head_observations, self.head_rewards
+            head_policy, head_value = self.head_policy, self.head_value
+        if needed_heads is None:
+            needed_heads = ALL_HEADS
+        logits_observations = logits_rewards = logits_policy = logits_value = None
+        if 'observations' in needed_heads:
+            logits_observations = head_observations(x, num_steps=num_steps, prev_steps=prev_steps)
+        if 'rewards' in needed_heads:
+            logits_rewards = head_rewards(x, num_steps=num_steps, prev_steps=prev_steps)
+        if fuse_heads and self._fused_policy_value is not None and not torch.is_grad_enabled() \
+                and 'policy' in needed_heads and 'value' in needed_heads:
+            logits_policy, logits_value = self._fused_policy_value(x, num_steps=num_steps, prev_steps=prev_steps)
+        else:
+            if 'policy' in needed_heads:
+                logits_policy = head_policy(x, num_steps=num_steps, prev_steps=prev_steps)
+            if 'value' in needed_heads:
+                logits_value = head_value(x, num_steps=num_steps, prev_steps=prev_steps)
+        return x, logits_observations, logits_rewards, logits_policy, logits_value
+
+    def _graphed_forward_core(self, sequences: torch.Tensor, past_keys_values: KeysValues,
+                              start_pos: Optional[torch.Tensor], num_steps: int, prev_steps: int,
+                              needed_heads: Optional[frozenset] = None) -> Tuple[Optional[torch.Tensor], ...]:
+        """
+        Overview:
+            Run ``_forward_core`` for a recurrent step by replaying a CUDA graph. One graph is captured per static \
+            signature (input shape, cache size, number of steps) on first use. Each graph owns a static input, a \
+            static KeysValues and static outputs: the inputs and the cached tokens of the caller's caches are \
+            copied in, the graph is replayed, and the new tokens and cloned outputs are handed back. Nothing is \
+            copied in for an empty cache, as in the resets of the cache misses.
+        Arguments:
+            - sequences (:obj:`torch.Tensor`): Input sequences.
+            - past_keys_values (:obj:`KeysValues`): The caches of the step, updated in place.
+            - start_pos (:obj:`Optional[torch.Tensor]`): Rotary start positions, or None.
+            - num_steps (:obj:`int`): The number of steps in ``sequences``.
+            - prev_steps (:obj:`int`): The number of cached steps.
+            - needed_heads (:obj:`Optional[frozenset]`): The heads to compute, or None for all of them.
+        Returns:
+            - outputs (:obj:`Tuple[Optional[torch.Tensor], ...]`): The transformer output and the logits for \
+                observations, rewards, policy and value.
+        """
+        # The graphs read the parameters and buffers at their addresses of capture time and run the heads unfused,
+        # so in-place updates such as optimizer steps are seen by later replays. The graphs are dropped by _apply and
+        # _load_from_state_dict, which may replace those storages, see clear_cuda_graphs.
+        # The cache tensors may have been replaced, e.g. by trim_and_pad_kv_cache, so their shape is read directly.
+        cache = past_keys_values[0]._k_cache._cache
+        key = (
+            tuple(sequences.shape), None if start_pos is None else tuple(start_pos.shape), tuple(cache.shape),
+            cache.dtype, num_steps, prev_steps, needed_heads
+        )
+        entry = self._cuda_graphs.get(key)
+        if entry is None:
+            if len(self._cuda_graphs) >= self.cuda_graph_max_graphs:
+                # Release the least recently replayed graph, so that the graph memory stays bounded.
+                self._cuda_graphs.popitem(last=False)
+            entry = self._capture_forward_core(
+                sequences, past_keys_values, start_pos, num_steps, prev_steps, needed_heads
+            )
+            self._cuda_graphs[key] = entry
+        else:
+            self._cuda_graphs.move_to_end(key)
+        graph, static_sequences, static_start_pos, static_kv, static_outputs = entry
+
+        static_sequences.copy_(sequences)
+        if static_start_pos is not None:
+            static_start_pos.copy_(start_pos)
+        # Only the valid tokens are moved: the cached ones in, and the ones written by the replay back out.
+        copy_kv_token_range_into(static_kv, past_keys_values, 0, prev_steps)
+        graph.replay()
+        # The replay writes the new tokens into static_kv without running the Python-side size bookkeeping, so the
+        # sizes are set from the number of cached and new steps of the signature.
+        copy_kv_token_range_into(past_keys_values, static_kv, prev_steps, prev_steps + num_steps)
+        for kv_cache in past_keys_values:
+            kv_cache._k_cache._size = kv_cache._v_cache._size = prev_steps + num_steps
+        return tuple(None if output is None else output.clone() for output in static_outputs)
+
+    def _capture_forward_core(self, sequences: torch.Tensor, past_keys_values: KeysValues,
+                              start_pos: Optional[torch.Tensor], num_steps: int, prev_steps: int,
+                              needed_heads: Optional[frozenset] = None) -> tuple:
+        """
+        Overview:
+            Capture ``_forward_core`` into a CUDA graph for the signature of the given inputs, after a warmup on a \
+            side stream. The policy and value heads run unfused, so that the graph reads the parameters themselves \
+            and in-place optimizer updates are seen by later replays.
+        Returns:
+            - entry (:obj:`tuple`): The graph, its static sequences, start positions, KeysValues and outputs.
+        """
+        static_sequences = sequences.clone()
+        static_start_pos = None if start_pos is None else start_pos.clone()
+        cache = past_keys_values[0]._k_cache._cache
+        n, num_heads, max_tokens, head_dim = cache.shape
+        static_kv = KeysValues(n, num_heads, max_tokens, num_heads * head_dim, len(past_keys_values), cache.device,
+                               dtype=cache.dtype)
+
+        def run_core():
+            copy_kv_cache_into(static_kv, past_keys_values)
+            return WorldModel._forward_core(
+                self, static_sequences, static_kv, False, None, static_start_pos, num_steps, prev_steps,
+                needed_heads, False
+            )
+
+        side_stream = torch.cuda.Stream()
+        side_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(side_stream):
+            for _ in range(2):
+                run_core()
+        torch.cuda.current_stream().wait_stream(side_stream)
+
+        copy_kv_cache_into(static_kv, past_keys_values)
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            static_outputs = WorldModel._forward_core(
+                self, static_sequences, static_kv, False, None, static_start_pos, num_steps, prev_steps,
+                needed_heads, False
+            )
+        return graph, static_sequences, static_start_pos, static_kv, static_outputs
 
     def _transformer_pass(self, sequences, past_keys_values, kvcache_independent, valid_context_lengths, start_pos: int = 0):
         """
@@ -746,12 +1154,61 @@ class WorldModel(nn.Module):
             - torch.Tensor: Transformer output.
         """
         if kvcache_independent:
-            x = [self.transformer(sequences[k].unsqueeze(0), past_kv,
-                                  valid_context_lengths=valid_context_lengths[k].unsqueeze(0), start_pos=start_pos) for k, past_kv in
-                 enumerate(past_keys_values)]
-            return torch.cat(x, dim=0)
+            return self._independent_transformer_pass(sequences, past_keys_values, valid_context_lengths, start_pos)
         else:
-            return self.transformer(sequences, past_keys_values, valid_context_lengths=valid_context_lengths, start_pos=start_pos)
+            transformer = self.transformer.forward if self._fast_eval else self.transformer
+            return transformer(sequences, past_keys_values, valid_context_lengths=valid_context_lengths, start_pos=start_pos)
+
+    def _independent_transformer_pass(self, sequences: torch.Tensor, past_keys_values: List[KeysValues],
+                                      valid_context_lengths: Optional[torch.Tensor],
+                                      start_pos: Union[int, torch.Tensor] = 0) -> torch.Tensor:
+        """
+        Overview:
+            Run the transformer once for all environments with independent caches. The caches are left-padded to a \
+            common length into one batched cache, whose padding is masked out through the valid context lengths, and \
+            the keys and values of the new tokens are then appended back to every environment's own cache.
+        Arguments:
+            - sequences (:obj:`torch.Tensor`): Input sequences of shape (num_envs, num_tokens, embed_dim).
+            - past_keys_values (:obj:`List[KeysValues]`): The single-sample cache of each environment.
+            - valid_context_lengths (:obj:`Optional[torch.Tensor]`): Valid context lengths of the environments. If \
+                None, the whole cache of each environment is valid.
+            - start_pos (:obj:`Union[int, torch.Tensor]`): Starting positions for rotary embeddings.
+        Returns:
+            - x (:obj:`torch.Tensor`): Transformer output of shape (num_envs, num_tokens, embed_dim).
+        """
+        sizes = [past_kv.size for past_kv in past_keys_values]
+        num_tokens = sequences.shape[1]
+        max_tokens = past_keys_values[0].max_tokens
+        # Pad the context so that the attended key length is a multiple of 8 when the capacity allows, which keeps
+        # the attention matmuls on Tensor Core friendly shapes; the extra positions are masked like any other padding.
+        padded_size = max(sizes)
+        aligned_size = -(-(padded_size + num_tokens) // 8) * 8 - num_tokens
+        if aligned_size + num_tokens <= max_tokens:
+            padded_size = aligned_size
+
+        batched_kv = self.transformer.generate_empty_keys_values(
+            n=len(past_keys_values), max_tokens=max_tokens, dtype=past_keys_values[0]._buffer.dtype
+        )
+        # The padding is zeroed, masked scores would otherwise still multiply uninitialized values.
+        left_pad_kv_caches_into(batched_kv, past_keys_values, sizes, padded_size)
+
+        if valid_context_lengths is None:
+            valid_context_lengths = torch.tensor(sizes, device=sequences.device)
+        transformer = self.transformer.forward if self._fast_eval else self.transformer
+        x = transformer(sequences, batched_kv, valid_context_lengths=valid_context_lengths, start_pos=start_pos)
+
+        new_tokens = slice(padded_size, padded_size + num_tokens)
+        for i, (past_kv, size) in enumerate(zip(past_keys_values, sizes)):
+            if past_kv.is_stacked():
+                past_kv._buffer[:, :, 0, :, size:size + num_tokens].copy_(batched_kv._buffer[:, :, i, :, new_tokens])
+                for kv_cache, batched_cache in zip(past_kv, batched_kv):
+                    kv_cache._k_cache._size = kv_cache._v_cache._size = size + num_tokens
+                    kv_cache._compute_dtype = batched_cache._compute_dtype
+            else:
+                for kv_cache, batched_cache in zip(past_kv, batched_kv):
+                    kv_cache.update(batched_cache._k_cache._cache[i:i + 1, :, new_tokens],
+                                    batched_cache._v_cache._cache[i:i + 1, :, new_tokens])
+        return x
 
     @torch.no_grad()
     def reset_for_initial_inference(self, obs_act_dict: torch.FloatTensor, start_pos: int = 0) -> torch.FloatTensor:
@@ -827,37 +1284,44 @@ class WorldModel(nn.Module):
                     self.keys_values_wm_list = []
                     self.keys_values_wm_size_list = []
 
+                    # Hash the latent states of all environments with a single transfer, instead of one device
+                    # sync per environment.
+                    # TODO: len(last_obs_embeddings) may smaller than len(current_obs_embeddings), because some environments may have done
+                    cache_keys = hash_states(last_obs_embeddings[:ready_env_num])
+                    matched_values = []
+                    miss_indices = []
                     for i in range(ready_env_num):
-                        # Retrieve latent state for a single environment
-                        # TODO: len(last_obs_embeddings) may smaller than len(current_obs_embeddings), because some environments may have done
-
-                        state_single_env = last_obs_embeddings[i]
-                        # Compute hash value using latent state for a single environment
-                        cache_key = hash_state(state_single_env.view(-1).cpu().numpy())  # last_obs_embeddings[i] is torch.Tensor
-
                         # Retrieve cached value
-                        cache_index = self.past_kv_cache_init_infer_envs[i].get(cache_key)
+                        cache_index = self.past_kv_cache_init_infer_envs[i].get(cache_keys[i])
                         if cache_index is not None:
-                            matched_value = self.shared_pool_init_infer[i][cache_index]
-                        else:
-                            matched_value = None
-
-                        self.root_total_query_cnt += 1
-                        if matched_value is not None:
-                            # If a matching value is found, add it to the list
-                            self.root_hit_cnt += 1
-                            # NOTE: deepcopy is needed because forward modifies matched_value in place
-                            self.keys_values_wm_list.append(self.custom_copy_kv_cache_to_shared_wm(matched_value))
-                            self.keys_values_wm_size_list.append(matched_value.size)
+                            matched_values.append(self.shared_pool_init_infer[i][cache_index])
                         else:
-                            # Reset using zero values
-                            self.keys_values_wm_single_env = self.transformer.generate_empty_keys_values(n=1, max_tokens=self.context_length)
-                            # If using RoPE positional encoding, then at reset, the pos_embed should use the absolute position start_pos[i].
-                            outputs_wm = self.forward({'obs_embeddings': state_single_env.unsqueeze(0)},
-                                                      past_keys_values=self.keys_values_wm_single_env,
-                                                      is_init_infer=True, start_pos=start_pos[i].item())
-                            self.keys_values_wm_list.append(self.keys_values_wm_single_env)
+                            matched_values.append(None)
+                            miss_indices.append(i)
+
+                    self.root_total_query_cnt += ready_env_num
+                    self.root_hit_cnt += ready_env_num - len(miss_indices)
+                    if miss_indices:
+                        # Reset all missed environments using zero values with one batched forward pass.
+                        # If using RoPE positional encoding, then at reset, the pos_embed should use the absolute position start_pos[i].
+                        # start_pos arrives as a list of timesteps from the collector: gather the rows from a tensor.
+                        miss_rows = self._pad_miss_rows(miss_indices)
+                        miss_kv = self._miss_keys_values(len(miss_rows))
+                        self.forward({'obs_embeddings': last_obs_embeddings[miss_rows]},
+                                     past_keys_values=miss_kv, is_init_infer=True,
+                                     start_pos=self._as_int_tensor(start_pos)[miss_rows])
+
+                    miss_slots = {i: j for j, i in enumerate(miss_indices)}
+                    for i, matched_value in enumerate(matched_values):
+                        if i in miss_slots:
+                            # A zero-copy single-sample view of the batched cache of the missed environments.
+                            self.keys_values_wm_list.append(miss_kv.sample(miss_slots[i]))
                             self.keys_values_wm_size_list.append(1)
+                        else:
+                            # The forward pass runs on the padded batch built by trim_and_pad_kv_cache, so the
+                            # matched pool entry itself is never modified and needs no private copy.
+                            self.keys_values_wm_list.append(self._kv_cache_for_batching(matched_value))
+                            self.keys_values_wm_size_list.append(matched_value.size)
 
                     # Input self.keys_values_wm_list, output self.keys_values_wm
                     self.keys_values_wm_size_list_current = self.trim_and_pad_kv_cache(is_init_infer=True)
@@ -877,15 +1341,21 @@ class WorldModel(nn.Module):
                     #     print(f"len(batch_action): {len(batch_action)}")
                     #     print(f"len(current_obs_embeddings): {len(current_obs_embeddings)}")
 
+                    act_tokens = self._actions_to_device(batch_action, last_obs_embeddings.device)
                     if self.continuous_action_space:
-                        act_tokens = torch.from_numpy(np.array(batch_action)).to(last_obs_embeddings.device).unsqueeze(1)
+                        act_tokens = act_tokens.unsqueeze(1)
                     else:
-                        act_tokens = torch.from_numpy(np.array(batch_action)).to(last_obs_embeddings.device).unsqueeze(-1)
+                        act_tokens = act_tokens.unsqueeze(-1)
                     
-                    outputs_wm = self.forward({'act_tokens': act_tokens}, past_keys_values=self.keys_values_wm,
-                                              is_init_infer=True, start_pos=start_pos)
-                    outputs_wm = self.forward({'obs_embeddings': current_obs_embeddings},
-                                              past_keys_values=self.keys_values_wm, is_init_infer=True, start_pos=start_pos)
+                    if self.fuse_init_act_obs and not self.reanalyze_phase:
+                        outputs_wm = self.forward({'act_then_obs_embeddings': (act_tokens, current_obs_embeddings)},
+                                                  past_keys_values=self.keys_values_wm, is_init_infer=True,
+                                                  start_pos=start_pos)
+                    else:
+                        outputs_wm = self.forward({'act_tokens': act_tokens}, past_keys_values=self.keys_values_wm,
+                                                  is_init_infer=True, start_pos=start_pos)
+                        outputs_wm = self.forward({'obs_embeddings': current_obs_embeddings},
+                                                  past_keys_values=self.keys_values_wm, is_init_infer=True, start_pos=start_pos)
 
                     # Copy and store keys_values_wm for a single environment
                     self.update_cache_context(current_obs_embeddings, is_init_infer=True)
@@ -925,6 +1395,19 @@ class WorldModel(nn.Module):
 
         return outputs_wm
 
+    @contextmanager
+    def _fast_eval_mode(self):
+        """
+        Overview:
+            Enable ``_fast_eval`` for the duration of an inference call of an eval-mode model. Training-mode models \
+            keep the regular module calls, so that forward hooks, e.g. those used to measure dormant neurons, still run.
+        """
+        self._fast_eval = not self.training
+        try:
+            yield
+        finally:
+            self._fast_eval = False
+
     @torch.no_grad()
     def forward_initial_inference(self, obs_act_dict, start_pos: int = 0):
         """
@@ -935,12 +1418,13 @@ class WorldModel(nn.Module):
         Returns:
             - tuple: A tuple containing output sequence, latent state, logits rewards, logits policy, and logits value.
         """
-        # UniZero has context in the root node
-        outputs_wm, latent_state = self.reset_for_initial_inference(obs_act_dict, start_pos)
-        self.past_kv_cache_recurrent_infer.clear()
+        with self._fast_eval_mode():
+            # UniZero has context in the root node
+            outputs_wm, latent_state = self.reset_for_initial_inference(obs_act_dict, start_pos)
+            self.past_kv_cache_recurrent_infer.clear()
 
-        return (outputs_wm.output_sequence, latent_state, outputs_wm.logits_rewards,
-                outputs_wm.logits_policy, outputs_wm.logits_value)
+            return (outputs_wm.output_sequence, latent_state, outputs_wm.logits_rewards,
+                    outputs_wm.logits_policy, outputs_wm.logits_value)
 
     @torch.no_grad()
     def forward_recurrent_inference(self, state_action_history, simulation_index=0,
@@ -955,78 +1439,134 @@ class WorldModel(nn.Module):
         Returns:
             - tuple: A tuple containing output sequence, updated latent state, reward, logits policy, and logits value.
         """
-        latest_state, action = state_action_history[-1]
-        ready_env_num = latest_state.shape[0]
-
-        self.keys_values_wm_list = []
-        self.keys_values_wm_size_list = []
-        self.keys_values_wm_size_list = self.retrieve_or_generate_kvcache(latest_state, ready_env_num, simulation_index, start_pos)
-
-        latent_state_list = []
-        if not self.continuous_action_space:
-            token = action.reshape(-1, 1)
-        else:
-            token = action.reshape(-1, self.action_space_size)
-
-        # ======= Print statistics for debugging =============
-        # min_size = min(self.keys_values_wm_size_list)
-        # if min_size >= self.config.max_tokens - 5:
-        #     self.length_largethan_maxminus5_context_cnt += len(self.keys_values_wm_size_list)
-        # if min_size >= self.config.max_tokens - 7:
-        #     self.length_largethan_maxminus7_context_cnt += len(self.keys_values_wm_size_list)
-        # if self.total_query_count > 0 and self.total_query_count % 10000 == 0:
-        #     self.hit_freq = self.hit_count / self.total_query_count
-        #     print('total_query_count:', self.total_query_count)
-        #     length_largethan_maxminus5_context_cnt_ratio = self.length_largethan_maxminus5_context_cnt / self.total_query_count
-        #     print('recurrent largethan_maxminus5_context:', self.length_largethan_maxminus5_context_cnt)
-        #     print('recurrent largethan_maxminus5_context_ratio:', length_largethan_maxminus5_context_cnt_ratio)
-        #     length_largethan_maxminus7_context_cnt_ratio = self.length_largethan_maxminus7_context_cnt / self.total_query_count
-        #     print('recurrent largethan_maxminus7_context_ratio:', length_largethan_maxminus7_context_cnt_ratio)
-        #     print('recurrent largethan_maxminus7_context:', self.length_largethan_maxminus7_context_cnt)
-
-        # Trim and pad kv_cache: modify self.keys_values_wm in-place
-        self.keys_values_wm_size_list = self.trim_and_pad_kv_cache(is_init_infer=False)
-        self.keys_values_wm_size_list_current = self.keys_values_wm_size_list
-
-        for k in range(2):
-            # action_token obs_token
-            if k == 0:
-                obs_embeddings_or_act_tokens = {'act_tokens': token}
+        with self._fast_eval_mode():
+            latest_state, action = state_action_history[-1]
+            ready_env_num = latest_state.shape[0]
+
+            self.keys_values_wm_list = []
+            self.keys_values_wm_size_list = []
+            self.keys_values_wm_size_list = self.retrieve_or_generate_kvcache(latest_state, ready_env_num, simulation_index, start_pos)
+            if self.config.rotary_emb:
+                # Move the positions and depths to the device once, for both the action and the observation step.
+                start_pos, search_depth = self._positions_to_device(start_pos, search_depth)
+
+            latent_state = None
+            if not self.continuous_action_space:
+                token = action.reshape(-1, 1)
             else:
-                obs_embeddings_or_act_tokens = {'obs_embeddings': token}
+                token = action.reshape(-1, self.action_space_size)
+
+            # ======= Print statistics for debugging =============
+            # min_size = min(self.keys_values_wm_size_list)
+            # if min_size >= self.config.max_tokens - 5:
+            #     self.length_largethan_maxminus5_context_cnt += len(self.keys_values_wm_size_list)
+            # if min_size >= self.config.max_tokens - 7:
+            #     self.length_largethan_maxminus7_context_cnt += len(self.keys_values_wm_size_list)
+            # if self.total_query_count > 0 and self.total_query_count % 10000 == 0:
+            #     self.hit_freq = self.hit_count / self.total_query_count
+            #     print('total_query_count:', self.total_query_count)
+            #     length_largethan_maxminus5_context_cnt_ratio = self.length_largethan_maxminus5_context_cnt / self.total_query_count
+            #     print('recurrent largethan_maxminus5_context:', self.length_largethan_maxminus5_context_cnt)
+            #     print('recurrent largethan_maxminus5_context_ratio:', length_largethan_maxminus5_context_cnt_ratio)
+            #     length_largethan_maxminus7_context_cnt_ratio = self.length_largethan_maxminus7_context_cnt / self.total_query_count
+            #     print('recurrent largethan_maxminus7_context_ratio:', length_largethan_maxminus7_context_cnt_ratio)
+            #     print('recurrent largethan_maxminus7_context:', self.length_largethan_maxminus7_context_cnt)
+
+            # Trim and pad kv_cache: modify self.keys_values_wm in-place
+            self.keys_values_wm_size_list = self.trim_and_pad_kv_cache(is_init_infer=False)
+            self.keys_values_wm_size_list_current = self.keys_values_wm_size_list
+
+            for k in range(2):
+                # action_token obs_token. The action token predicts the reward and the next latent state, the
+                # observation token the policy and value; the other heads are skipped.
+                if k == 0:
+                    obs_embeddings_or_act_tokens = {'act_tokens': token}
+                    needed_heads = ACT_STEP_HEADS
+                else:
+                    obs_embeddings_or_act_tokens = {'obs_embeddings': token}
+                    needed_heads = OBS_STEP_HEADS
+
+                # Perform forward pass
+                outputs_wm = self.forward(
+                    obs_embeddings_or_act_tokens,
+                    past_keys_values=self.keys_values_wm,
+                    kvcache_independent=False,
+                    is_init_infer=False,
+                    start_pos=start_pos,
+                    search_depth=search_depth, # List containing depth of latent states in the search tree. 
+                    needed_heads=needed_heads
+                )
 
-            # Perform forward pass
-            outputs_wm = self.forward(
-                obs_embeddings_or_act_tokens,
-                past_keys_values=self.keys_values_wm,
-                kvcache_independent=False,
-                is_init_infer=False,
-                start_pos=start_pos,
-                search_depth=search_depth # List containing depth of latent states in the search tree. 
-            )
+                self.keys_values_wm_size_list_current = [i + 1 for i in self.keys_values_wm_size_list_current]
 
-            self.keys_values_wm_size_list_current = [i + 1 for i in self.keys_values_wm_size_list_current]
+                if k == 0:
+                    reward = outputs_wm.logits_rewards  # (B,)
 
-            if k == 0:
-                reward = outputs_wm.logits_rewards  # (B,)
+                if k < self.num_observations_tokens:
+                    token = outputs_wm.logits_observations
+                    if len(token.shape) != 3:
+                        token = token.unsqueeze(1)  # (8,1024) -> (8,1,1024)
+                    if self.num_observations_tokens == 1:
+                        # A single predicted token is the latent state itself, no copy needed.
+                        latent_state = token
+                    else:
+                        if latent_state is None:
+                            latent_state = token.new_empty(
+                                token.shape[0], self.num_observations_tokens, token.shape[-1]
+                            )
+                        latent_state[:, k:k + 1].copy_(token)
 
-            if k < self.num_observations_tokens:
-                token = outputs_wm.logits_observations
-                if len(token.shape) != 3:
-                    token = token.unsqueeze(1)  # (8,1024) -> (8,1,1024)
-                latent_state_list.append(token)
+            del self.latent_state  # Very important to minimize cuda memory usage
+            self.latent_state = latent_state  # (B, K, E)
 
-        del self.latent_state  # Very important to minimize cuda memory usage
-        self.latent_state = torch.cat(latent_state_list, dim=1)  # (B, K)
+            self.update_cache_context(
+                self.latent_state,
+                is_init_infer=False,
+                simulation_index=simulation_index,
+            )
 
-        self.update_cache_context(
-            self.latent_state,
-            is_init_infer=False,
-            simulation_index=simulation_index,
-        )
+            return (outputs_wm.output_sequence, self.latent_state, reward, outputs_wm.logits_policy, outputs_wm.logits_value)
 
-        return (outputs_wm.output_sequence, self.latent_state, reward, outputs_wm.logits_policy, outputs_wm.logits_value)
 
+    @staticmethod
+    def _actions_to_device(batch_action: Union[List, np.ndarray], device: torch.device) -> torch.Tensor:
+        """
+        Overview:
+            Convert the actions collected from the environments to a tensor on ``device``. The host array is built \
+            in a single pass and shared with the CPU tensor without a copy; on CUDA it is staged in pinned memory \
+            so that the transfer does not block the host.
+        Arguments:
+            - batch_action (:obj:`Union[List, np.ndarray]`): The actions, a list of ints or of per-env action arrays.
+            - device (:obj:`torch.device`): The target device.
+        Returns:
+            - actions (:obj:`torch.Tensor`): The actions as a tensor on ``device``.
+        """
+        if isinstance(batch_action, (list, tuple)) and len(batch_action) > 0 and isinstance(batch_action[0], np.ndarray):
+            batch_action = np.stack(batch_action)
+        actions = torch.as_tensor(np.asarray(batch_action))
+        if device.type == 'cuda':
+            return actions.pin_memory().to(device, non_blocking=True)
+        return actions.to(device)
+
+    @staticmethod
+    def _host_rows_to_device(rows: List[np.ndarray], device: torch.device) -> torch.Tensor:
+        """
+        Overview:
+            Stack host arrays of the same shape, e.g. the latent states of several environments, into one tensor on \
+            ``device``. On CUDA the rows are stacked straight into pinned memory and sent with a single \
+            non-blocking copy; otherwise the stacked array is shared with the CPU tensor without a copy.
+        Arguments:
+            - rows (:obj:`List[np.ndarray]`): The arrays to stack.
+            - device (:obj:`torch.device`): The target device.
+        Returns:
+            - tensor (:obj:`torch.Tensor`): The stacked rows, of shape (len(rows), *rows[0].shape), on ``device``.
+        """
+        if device.type != 'cuda':
+            return torch.from_numpy(np.stack(rows)).to(device)
+        first = np.asarray(rows[0])
+        staging = torch.empty((len(rows),) + first.shape, dtype=torch.from_numpy(first).dtype, pin_memory=True)
+        np.stack(rows, out=staging.numpy())
+        return staging.to(device, non_blocking=True)
 
     def trim_and_pad_kv_cache(self, is_init_infer=True) -> list:
         """
@@ -1041,42 +1581,18 @@ class WorldModel(nn.Module):
         Returns:
             - list: Updated sizes of the key-value caches.
         """
-        # Find the maximum size among all key-value caches
-        max_size = max(self.keys_values_wm_size_list)
-
-        # Iterate over each layer of the transformer
-        for layer in range(self.num_layers):
-            kv_cache_k_list = []
-            kv_cache_v_list = []
-
-            # Enumerate through each environment's key-value pairs
-            for idx, keys_values in enumerate(self.keys_values_wm_list):
-                k_cache = keys_values[layer]._k_cache._cache
-                v_cache = keys_values[layer]._v_cache._cache
-
-                effective_size = self.keys_values_wm_size_list[idx]
-                pad_size = max_size - effective_size
-
-                # If padding is required, trim the end and pad the beginning of the cache
-                if pad_size > 0:
-                    k_cache_trimmed = k_cache[:, :, :-pad_size, :]
-                    v_cache_trimmed = v_cache[:, :, :-pad_size, :]
-                    k_cache_padded = F.pad(k_cache_trimmed, (0, 0, pad_size, 0), "constant", 0)
-                    v_cache_padded = F.pad(v_cache_trimmed, (0, 0, pad_size, 0), "constant", 0)
-                else:
-                    k_cache_padded = k_cache
-                    v_cache_padded = v_cache
-
-                kv_cache_k_list.append(k_cache_padded)
-                kv_cache_v_list.append(v_cache_padded)
-
-            # Stack the caches along a new dimension and remove any extra dimensions
-            self.keys_values_wm._keys_values[layer]._k_cache._cache = torch.stack(kv_cache_k_list, dim=0).squeeze(1)
-            self.keys_values_wm._keys_values[layer]._v_cache._cache = torch.stack(kv_cache_v_list, dim=0).squeeze(1)
+        num_envs = len(self.keys_values_wm_list)
 
-            # Update the cache size to the maximum size
-            self.keys_values_wm._keys_values[layer]._k_cache._size = max_size
-            self.keys_values_wm._keys_values[layer]._v_cache._size = max_size
+        # The padded batch is assembled in place in the stacked buffer of self.keys_values_wm, which is only
+        # reallocated when the batch size changes, instead of padding every cache and stacking the results into
+        # freshly allocated tensors at every step.
+        if self.keys_values_wm.n != num_envs or self.keys_values_wm.max_tokens != self.context_length:
+            self.keys_values_wm = self.transformer.generate_empty_keys_values(n=num_envs, max_tokens=self.context_length)
+        else:
+            # Re-attach the layer caches to the buffer, in case they were replaced since the last call.
+            self.keys_values_wm._bind_buffer(self.keys_values_wm._buffer)
+        # Zero the left padding and right-align the tokens of all environments with one fused copy.
+        left_pad_kv_caches_into(self.keys_values_wm, self.keys_values_wm_list, self.keys_values_wm_size_list)
 
         return self.keys_values_wm_size_list
 
@@ -1095,123 +1611,55 @@ class WorldModel(nn.Module):
         if self.context_length <= 2:
             # No context to update if the context length is less than or equal to 2.
             return
+        # Hash the latent states of all environments with a single transfer to the host.
+        cache_keys = hash_states(latent_state)
+        # Loop invariants, bound once instead of being looked up (and, for the padded length, recomputed) per env.
+        context_length = self.context_length
+        keys_values_wm = self.keys_values_wm
+        wm_size = keys_values_wm.size
+        if not is_init_infer:
+            sizes = self.keys_values_wm_size_list_current
+            current_max_context_length = max(sizes)
+            recur_pool, recur_table = self.shared_pool_recur_infer, self.past_kv_cache_recurrent_infer
         for i in range(latent_state.size(0)):
             # ============ Iterate over each environment ============
-            cache_key = hash_state(latent_state[i].view(-1).cpu().numpy())  # latent_state[i] is torch.Tensor
-            context_length = self.context_length
+            cache_key = cache_keys[i]
 
             if not is_init_infer:
                 # ============ Internal Node ============
                 # Retrieve KV from global KV cache self.keys_values_wm to single environment KV cache self.keys_values_wm_single_env, ensuring correct positional encoding
-                current_max_context_length = max(self.keys_values_wm_size_list_current)
-                trim_size = current_max_context_length - self.keys_values_wm_size_list_current[i]
-                for layer in range(self.num_layers):
-                    # ============ Apply trimming and padding to each layer of kv_cache ============
-                    # cache shape [batch_size, num_heads, sequence_length, features]
-                    k_cache_current = self.keys_values_wm._keys_values[layer]._k_cache._cache[i]
-                    v_cache_current = self.keys_values_wm._keys_values[layer]._v_cache._cache[i]
-
-                    if trim_size > 0:
-                        # Trim invalid leading zeros as per effective length
-                        # Remove the first trim_size zero kv items
-                        k_cache_trimmed = k_cache_current[:, trim_size:, :]
-                        v_cache_trimmed = v_cache_current[:, trim_size:, :]
-                        # If effective length < current_max_context_length, pad the end of cache with 'trim_size' zeros
-                        k_cache_padded = F.pad(k_cache_trimmed, (0, 0, 0, trim_size), "constant",
-                                               0)  # Pad with 'trim_size' zeros at end of cache
-                        v_cache_padded = F.pad(v_cache_trimmed, (0, 0, 0, trim_size), "constant", 0)
-                    else:
-                        k_cache_padded = k_cache_current
-                        v_cache_padded = v_cache_current
-
-                    # Update cache of self.keys_values_wm_single_env
-                    self.keys_values_wm_single_env._keys_values[layer]._k_cache._cache = k_cache_padded.unsqueeze(0)
-                    self.keys_values_wm_single_env._keys_values[layer]._v_cache._cache = v_cache_padded.unsqueeze(0)
-                    # Update size of self.keys_values_wm_single_env
-                    self.keys_values_wm_single_env._keys_values[layer]._k_cache._size = \
-                        self.keys_values_wm_size_list_current[i]
-                    self.keys_values_wm_single_env._keys_values[layer]._v_cache._size = \
-                        self.keys_values_wm_size_list_current[i]
-
-                    # ============ NOTE: Very Important ============
-                    if self.keys_values_wm_single_env._keys_values[layer]._k_cache._size >= context_length - 1:
-                        # Keep only the last self.context_length-3 timesteps of context
-                        # For memory environments, training is for H steps, recurrent_inference might exceed H steps
-                        # Assuming cache dimension is [batch_size, num_heads, sequence_length, features]
-                        k_cache_current = self.keys_values_wm_single_env._keys_values[layer]._k_cache._cache
-                        v_cache_current = self.keys_values_wm_single_env._keys_values[layer]._v_cache._cache
-
-                        # Remove the first 2 steps, keep the last self.context_length-3 steps
-                        k_cache_trimmed = k_cache_current[:, :, 2:context_length - 1, :].squeeze(0)
-                        v_cache_trimmed = v_cache_current[:, :, 2:context_length - 1, :].squeeze(0)
-
-                        if not self.config.rotary_emb:
-                            # Index pre-computed positional encoding differences
-                            pos_emb_diff_k = self.pos_emb_diff_k[layer][(2, context_length - 1)]
-                            pos_emb_diff_v = self.pos_emb_diff_v[layer][(2, context_length - 1)]
-                            # ============ NOTE: Very Important ============
-                            # Apply positional encoding correction to k and v
-                            k_cache_trimmed += pos_emb_diff_k.squeeze(0)
-                            v_cache_trimmed += pos_emb_diff_v.squeeze(0)
-
-                        # Pad the last 3 steps along the third dimension with zeros
-                        # F.pad parameters (0, 0, 0, 3) specify padding amounts for each dimension: (left, right, top, bottom). For 3D tensor, they correspond to (dim2 left, dim2 right, dim1 left, dim1 right).
-                        padding_size = (0, 0, 0, 3)
-                        k_cache_padded = F.pad(k_cache_trimmed, padding_size, 'constant', 0)
-                        v_cache_padded = F.pad(v_cache_trimmed, padding_size, 'constant', 0)
-                        # Update single environment cache
-                        self.keys_values_wm_single_env._keys_values[layer]._k_cache._cache = k_cache_padded.unsqueeze(0)
-                        self.keys_values_wm_single_env._keys_values[layer]._v_cache._cache = v_cache_padded.unsqueeze(0)
-
-                        self.keys_values_wm_single_env._keys_values[layer]._k_cache._size = context_length - 3
-                        self.keys_values_wm_single_env._keys_values[layer]._v_cache._size = context_length - 3
-
+                # The tokens of environment i are left-padded to the longest cache of the batch: drop the padding.
+                trim_size = current_max_context_length - sizes[i]
+                pool_slot = recur_pool[self.shared_pool_index]
+                if isinstance(pool_slot, KeysValues) and pool_slot._buffer.dtype == keys_values_wm._buffer.dtype:
+                    # Write the trimmed cache straight into the next slot of the recurrent pool, without staging it
+                    # in self.keys_values_wm_single_env first.
+                    self._slice_env_kv_cache(i, trim_size, sizes[i], pool_slot)
+                    recur_table[cache_key] = self.shared_pool_index
+                    self.shared_pool_index = (self.shared_pool_index + 1) % self.shared_pool_size
+                    continue
+                self._slice_env_kv_cache(i, trim_size, sizes[i])
             else:
                 # ============ Root Node ============
                 # Retrieve KV from global KV cache self.keys_values_wm to single environment KV cache self.keys_values_wm_single_env, ensuring correct positional encoding
-
-                for layer in range(self.num_layers):
-                    # ============ Apply trimming and padding to each layer of kv_cache ============
-
-                    if self.keys_values_wm._keys_values[layer]._k_cache._size < context_length - 1:  # Keep only the last self.context_length-1 timesteps of context
-                        self.keys_values_wm_single_env._keys_values[layer]._k_cache._cache = \
-                        self.keys_values_wm._keys_values[layer]._k_cache._cache[i].unsqueeze(
-                            0)  # Shape torch.Size([2, 100, 512])
-                        self.keys_values_wm_single_env._keys_values[layer]._v_cache._cache = \
-                        self.keys_values_wm._keys_values[layer]._v_cache._cache[i].unsqueeze(0)
-                        self.keys_values_wm_single_env._keys_values[layer]._k_cache._size = \
-                        self.keys_values_wm._keys_values[layer]._k_cache._size
-                        self.keys_values_wm_single_env._keys_values[layer]._v_cache._size = \
-                        self.keys_values_wm._keys_values[layer]._v_cache._size
-                    else:
-                        # Assuming cache dimension is [batch_size, num_heads, sequence_length, features]
-                        k_cache_current = self.keys_values_wm._keys_values[layer]._k_cache._cache[i]
-                        v_cache_current = self.keys_values_wm._keys_values[layer]._v_cache._cache[i]
-
-                        # Remove the first 2 steps, keep the last self.context_length-3 steps
-                        k_cache_trimmed = k_cache_current[:, 2:context_length - 1, :]
-                        v_cache_trimmed = v_cache_current[:, 2:context_length - 1, :]
-
-                        if not self.config.rotary_emb:
-                            # Index pre-computed positional encoding differences
-                            pos_emb_diff_k = self.pos_emb_diff_k[layer][(2, context_length - 1)]
-                            pos_emb_diff_v = self.pos_emb_diff_v[layer][(2, context_length - 1)]
-                            # ============ NOTE: Very Important ============
-                            # Apply positional encoding correction to k and v
-                            k_cache_trimmed += pos_emb_diff_k.squeeze(0)
-                            v_cache_trimmed += pos_emb_diff_v.squeeze(0)
-
-                        # Pad the last 3 steps along the third dimension with zeros
-                        # F.pad parameters (0, 0, 0, 3) specify padding amounts for each dimension: (left, right, top, bottom). For 3D tensor, they correspond to (dim2 left, dim2 right, dim1 left, dim1 right).
-                        padding_size = (0, 0, 0, 3)
-                        k_cache_padded = F.pad(k_cache_trimmed, padding_size, 'constant', 0)
-                        v_cache_padded = F.pad(v_cache_trimmed, padding_size, 'constant', 0)
-                        # Update cache of self.keys_values_wm_single_env
-                        self.keys_values_wm_single_env._keys_values[layer]._k_cache._cache = k_cache_padded.unsqueeze(0)
-                        self.keys_values_wm_single_env._keys_values[layer]._v_cache._cache = v_cache_padded.unsqueeze(0)
-                        # Update size of self.keys_values_wm_single_env
-                        self.keys_values_wm_single_env._keys_values[layer]._k_cache._size = context_length - 3
-                        self.keys_values_wm_single_env._keys_values[layer]._v_cache._size = context_length - 3
+                if wm_size < context_length - 1 and keys_values_wm.is_stacked():
+                    # Keep only the last self.context_length-1 timesteps of context
+                    # The tokens of environment i are viewed in place in the stacked buffer, with no per-layer
+                    # bookkeeping and no copy before the one into the init pool.
+                    cache_index = self.custom_copy_kv_cache_to_shared_init_envs(keys_values_wm.sample(i), i)
+                    self.past_kv_cache_init_infer_envs[i][cache_key] = cache_index
+                    continue
+                elif wm_size < context_length - 1:  # Keep only the last self.context_length-1 timesteps of context
+                    # A one-sample slice views the cache of environment i with a single op, instead of an index
+                    # followed by unsqueeze(0).
+                    for src_layer, dst_layer in zip(keys_values_wm._keys_values,
+                                                    self.keys_values_wm_single_env._keys_values):
+                        dst_layer._k_cache._cache = src_layer._k_cache._cache[i:i + 1]  # Shape torch.Size([1, 2, 100, 512])
+                        dst_layer._v_cache._cache = src_layer._v_cache._cache[i:i + 1]
+                        dst_layer._k_cache._size = src_layer._k_cache._size
+                        dst_layer._v_cache._size = src_layer._v_cache._size
+                else:
+                    self._slice_env_kv_cache(i, 0, wm_size)
 
             if is_init_infer:
                 # Store the latest key-value cache for initial inference
@@ -1223,6 +1671,36 @@ class WorldModel(nn.Module):
                 self.past_kv_cache_recurrent_infer[cache_key] = cache_index
 
 
+    def _slice_env_kv_cache(self, env_index: int, start: int, size: int,
+                            dst_kv: Optional[KeysValues] = None) -> None:
+        """
+        Overview:
+            Copy the ``size`` valid tokens of environment ``env_index``, which start at ``start`` in the batched \
+            cache self.keys_values_wm, to ``dst_kv``, for all layers at once. Once the tokens fill the context, the \
+            first 2 steps are dropped and only the last self.context_length-3 steps are kept.
+        Arguments:
+            - env_index (:obj:`int`): The index of the environment in self.keys_values_wm.
+            - start (:obj:`int`): The index of the first valid token of the environment.
+            - size (:obj:`int`): The number of valid tokens of the environment.
+            - dst_kv (:obj:`Optional[KeysValues]`): The single-sample destination, with the dtype of \
+                self.keys_values_wm. Defaults to self.keys_values_wm_single_env.
+        """
+        shift = size >= self.context_length - 1
+        if shift:
+            # Remove the first 2 steps, keep the last self.context_length-3 steps
+            start, size = start + 2, self.context_length - 3
+        if dst_kv is None:
+            dst_kv = self.keys_values_wm_single_env
+        if shift and not self.config.rotary_emb:
+            # ============ NOTE: Very Important ============
+            # Apply the pre-computed positional encoding correction to the k and v of all layers, fused into the copy.
+            slice_kv_cache_into(
+                dst_kv, self.keys_values_wm, env_index, start, size,
+                k_offset=self.pos_emb_diff_k[:, 0], v_offset=self.pos_emb_diff_v[:, 0]
+            )
+        else:
+            slice_kv_cache_into(dst_kv, self.keys_values_wm, env_index, start, size)
+
     def retrieve_or_generate_kvcache(self, latent_state: list, ready_env_num: int,
                                      simulation_index: int = 0, start_pos: int = 0) -> list:
         """
@@ -1239,64 +1717,154 @@ class WorldModel(nn.Module):
         Returns:
             - list: Sizes of the key-value caches for each environment.
         """
-        for index in range(ready_env_num):
-            self.total_query_count += 1
-            state_single_env = latent_state[index]  # latent_state[i] is np.array
-            cache_key = hash_state(state_single_env)
-
+        # Read the start positions on the host once, with a single transfer if they live on the device, instead of
+        # one synchronizing .item() per missed environment.
+        start_pos_host = start_pos.cpu().numpy() if isinstance(start_pos, torch.Tensor) else np.asarray(start_pos)
+        if self.reanalyze_phase:
+            # TODO: check if this is correct
+            # No cache is looked up in the reanalyze phase, so the states are not hashed and every environment is
+            # reset.
+            matched_values, miss_indices = [None] * ready_env_num, list(range(ready_env_num))
+        else:
+            cache_keys = hash_states(latent_state[:ready_env_num])
+            # Resolve the recurrent-pool indices of all environments with one batched lookup.
+            recur_indices = self.past_kv_cache_recurrent_infer.get_many(cache_keys)
+            # The loop only resolves the matched pool entries: the counters and the start positions of the missed
+            # environments are then computed for the whole batch at once.
+            init_tables, init_pools = self.past_kv_cache_init_infer_envs, self.shared_pool_init_infer
+            recur_pool = self.shared_pool_recur_infer
+            recur_pool_size = len(recur_pool)
+            matched_values, miss_indices = [], []
+            for index in range(ready_env_num):
+                # Try to retrieve the cached value from past_kv_cache_init_infer_envs
+                cache_index = init_tables[index].get(cache_keys[index])
+                matched_value = init_pools[index][cache_index] if cache_index is not None else None
+                if matched_value is None:
+                    # If not found, try to retrieve from past_kv_cache_recurrent_infer
+                    idx = recur_indices[index]
+                    if idx is not None and 0 <= idx < recur_pool_size:
+                        matched_value = recur_pool[idx]
+                    if matched_value is None:
+                        miss_indices.append(index)
+                matched_values.append(matched_value)
+        self.total_query_count += ready_env_num
+        self.hit_count += ready_env_num - len(miss_indices)
+
+        if miss_indices:
+            # If no matching cache is found, generate a new one using zero reset. All missed environments are reset
+            # with one batched forward pass, and each of them then uses a single-sample view of the batched cache.
+            # The padded rows only bound the number of distinct CUDA graph shapes; their caches are never read.
+            miss_rows = self._pad_miss_rows(miss_indices)
+            miss_kv = self._miss_keys_values(len(miss_rows))
+            # latent_state[i] is np.array
+            miss_states = self._host_rows_to_device([latent_state[index] for index in miss_rows], self.device)
+            # Determine the absolute start positions based on the reanalyze phase flag.
+            miss_index_array = np.asarray(miss_rows)
             if self.reanalyze_phase:
-                # TODO: check if this is correct
-                matched_value = None
+                num_cols = start_pos_host.shape[1]  # Original start_pos shape is (batch, num_columns)
+                # Each logical row is extended by one column.
+                row_idx, col_idx = np.divmod(miss_index_array, num_cols + 1)
+                # A column index equal to the original number of columns indicates the added column; set to 0.
+                added_col = col_idx == num_cols
+                miss_start_pos = np.where(added_col, 0, start_pos_host[row_idx, np.where(added_col, 0, col_idx)])
             else:
-                # Try to retrieve the cached value from past_kv_cache_init_infer_envs
-                cache_index = self.past_kv_cache_init_infer_envs[index].get(cache_key)
-                if cache_index is not None:
-                    matched_value = self.shared_pool_init_infer[index][cache_index]
-                else:
-                    matched_value = None
-
-                # If not found, try to retrieve from past_kv_cache_recurrent_infer
-                if matched_value is None: # TODO: Check this case
-                    # matched_value = self.shared_pool_recur_infer[self.past_kv_cache_recurrent_infer.get(cache_key)]
-                    idx = self.past_kv_cache_recurrent_infer.get(cache_key)
-                    if idx is not None and 0 <= idx < len(self.shared_pool_recur_infer):
-                        matched_value = self.shared_pool_recur_infer[idx]
-                    else:
-                        matched_value = None
+                miss_start_pos = start_pos_host[miss_index_array].reshape(-1)
+            self.forward(
+                {'obs_embeddings': miss_states},
+                past_keys_values=miss_kv, is_init_infer=True, start_pos=miss_start_pos.astype(np.int64)
+            )
 
-            if matched_value is not None:
+        miss_slots = {index: j for j, index in enumerate(miss_indices)}
+        for index, matched_value in enumerate(matched_values):
+            if index in miss_slots:
+                self.keys_values_wm_list.append(miss_kv.sample(miss_slots[index]))
+                self.keys_values_wm_size_list.append(1)
+            else:
                 # If a matching cache is found, add it to the lists
-                self.hit_count += 1
-                # Perform a deep copy because the transformer's forward pass might modify matched_value in-place
-                self.keys_values_wm_list.append(self.custom_copy_kv_cache_to_shared_wm(matched_value))
+                # The forward pass runs on the padded batch built by trim_and_pad_kv_cache, so the matched pool entry
+                # itself is never modified and needs no private copy.
+                self.keys_values_wm_list.append(self._kv_cache_for_batching(matched_value))
                 self.keys_values_wm_size_list.append(matched_value.size)
-            else:
-                # If no matching cache is found, generate a new one using zero reset
-                self.keys_values_wm_single_env = self.transformer.generate_empty_keys_values(
-                    n=1, max_tokens=self.context_length
-                )
-                
-                # Determine the absolute start position based on the reanalyze phase flag.
-                if self.reanalyze_phase:
-                    num_rows, num_cols = start_pos.shape  # Original start_pos shape is (batch, num_columns)
-                    total_cols = num_cols + 1             # Each logical row is extended by one column.
-                    row_idx = index // total_cols
-                    col_idx = index % total_cols
-                    # If the column index equals the original number of columns, this indicates the added column; set to 0.
-                    start_pos_adjusted: int = 0 if col_idx == num_cols else int(start_pos[row_idx, col_idx])
-                else:
-                    start_pos_adjusted = int(start_pos[index].item())
-
-                self.forward(
-                    {'obs_embeddings': torch.from_numpy(state_single_env).unsqueeze(0).to(self.device)},
-                    past_keys_values=self.keys_values_wm_single_env, is_init_infer=True, start_pos=start_pos_adjusted
-                )
-                self.keys_values_wm_list.append(self.keys_values_wm_single_env)
-                self.keys_values_wm_size_list.append(1)
 
         return self.keys_values_wm_size_list
 
 
+    @staticmethod
+    def _masked_obs_loss(logits_observations: torch.Tensor, labels_observations: torch.Tensor,
+                         mask_padding: torch.Tensor, loss_type: str, num_groups: int,
+                         group_size: int) -> torch.Tensor:
+        """
+        Overview:
+            The masked latent-state prediction loss of every (batch, timestep) sample. Kept as a pure tensor \
+            function, so that its elementwise chain can be fused into one kernel with ``torch.compile``.
+        Arguments:
+            - logits_observations (:obj:`torch.Tensor`): The predicted latent states, of shape (B*T, D).
+            - labels_observations (:obj:`torch.Tensor`): The target latent states, of shape (B*T, D).
+            - mask_padding (:obj:`torch.Tensor`): The padding mask of the samples, of shape (B*T,).
+            - loss_type (:obj:`str`): 'mse' or 'group_kl'.
+            - num_groups (:obj:`int`): The number of SimNorm groups, for 'group_kl'.
+            - group_size (:obj:`int`): The size of the SimNorm groups, for 'group_kl'.
+        Returns:
+            - loss_obs (:obj:`torch.Tensor`): The masked loss of every sample, of shape (B*T,).
+        """
+        if loss_type == 'mse':
+            # MSE loss, directly compare logits and labels
+            loss_obs = F.mse_loss(logits_observations, labels_observations, reduction='none').mean(-1)
+        elif loss_type == 'group_kl':
+            # Group KL loss, group features and calculate KL divergence within each group
+            batch_size = logits_observations.shape[0]
+            epsilon = 1e-6
+            logits_reshaped = logits_observations.reshape(batch_size, num_groups, group_size) + epsilon
+            labels_reshaped = labels_observations.reshape(batch_size, num_groups, group_size) + epsilon
+            loss_obs = F.kl_div(logits_reshaped.log(), labels_reshaped, reduction='none').sum(dim=-1).mean(dim=-1)
+        else:
+            raise ValueError(f"Unsupported predict_latent_loss_type: {loss_type}")
+        # Apply mask to loss_obs
+        return loss_obs * mask_padding
+
+    @staticmethod
+    def _first_middle_last_means(losses: torch.Tensor, mask_padding: torch.Tensor) -> torch.Tensor:
+        """
+        Overview:
+            The mean of several per-timestep losses over the unpadded samples at the first, middle and last \
+            timestep, without the host synchronization of boolean-mask indexing. A step without any unpadded sample \
+            gives NaN, like the mean of an empty selection.
+        Arguments:
+            - losses (:obj:`torch.Tensor`): The losses, of shape (num_losses, batch_size, seq_len).
+            - mask_padding (:obj:`torch.Tensor`): The boolean padding mask of the losses, of shape (batch_size, M). \
+                Its first, ``seq_len // 2``-th and last columns are used for the three timesteps.
+        Returns:
+            - means (:obj:`torch.Tensor`): The means, of shape (num_losses, 3), for the first, middle and last step.
+        """
+        seq_len = losses.shape[-1]
+        step_losses = losses[..., [0, seq_len // 2, seq_len - 1]]
+        step_mask = mask_padding[:, [0, seq_len // 2, mask_padding.shape[1] - 1]].bool()
+        sums = torch.where(step_mask, step_losses, torch.zeros_like(step_losses)).sum(dim=1)
+        return sums / step_mask.sum(dim=0)
+
+    @staticmethod
+    def _gaam_pairwise_kl(sigmas: torch.Tensor, mus: torch.Tensor) -> torch.Tensor:
+        """
+        Overview:
+            The sum of KL[N(m_i,s_i²) || N(m_j,s_j²)] over all head pairs i < j of the Gaussian attention spans, \
+            computed for all pairs at once by broadcasting.
+        Arguments:
+            - sigmas (:obj:`torch.Tensor`): The span widths, of shape (..., num_heads).
+            - mus (:obj:`torch.Tensor`): The span centers, of shape (..., num_heads).
+        Returns:
+            - kl_sum (:obj:`torch.Tensor`): The summed divergences, a scalar.
+        """
+        # The squares and logs are taken once per head, not once per pair.
+        var, log_sigma = sigmas * sigmas, torch.log(sigmas)
+        var_i, var_j = var.unsqueeze(-1), var.unsqueeze(-2)
+        kl = 0.5 * (
+                var_i / var_j
+                + (mus.unsqueeze(-2) - mus.unsqueeze(-1)).pow(2) / var_j
+                - 1.0
+                + 2.0 * (log_sigma.unsqueeze(-2) - log_sigma.unsqueeze(-1))
+        )  # (..., num_heads, num_heads), row i and column j
+        return kl.triu(diagonal=1).sum()
+
     def compute_loss(self, batch, target_tokenizer: Tokenizer = None, inverse_scalar_transform_handle=None, plot_policy : bool = False,
                      **kwargs: Any) -> LossWithIntermediateLosses:
         start_pos = batch['timestep']
@@ -1318,17 +1886,16 @@ class WorldModel(nn.Module):
         if self.analysis_dormant_ratio:
             # Calculate dormant ratio of the encoder
             shape = batch['observations'].shape  # (..., C, H, W)
-            inputs = batch['observations'].contiguous().view(-1, *shape[-3:])  # (32,5,3,64,64) -> (160,3,64,64)
+            inputs = batch['observations'].reshape(-1, *shape[-3:])  # (32,5,3,64,64) -> (160,3,64,64)
             dormant_ratio_encoder = cal_dormant_ratio(self.tokenizer.representation_network, inputs.detach(),
                                                       percentage=self.dormant_threshold)
             self.past_kv_cache_recurrent_infer.clear()
             self.keys_values_wm_list.clear()
-            torch.cuda.empty_cache()
         else:
             dormant_ratio_encoder = torch.tensor(0.)
 
-        # Calculate the L2 norm of the latent state roots
-        latent_state_l2_norms = torch.norm(obs_embeddings, p=2, dim=2).mean()
+        # Calculate the L2 norm of the latent state roots. It is only logged, so it is kept out of the autograd graph.
+        latent_state_l2_norms = torch.norm(obs_embeddings.detach(), p=2, dim=2).mean()
 
         if self.obs_type == 'image':
             # Reconstruct observations from latent state representations
@@ -1352,8 +1919,7 @@ class WorldModel(nn.Module):
             perceptual_loss = self.perceptual_loss
 
         elif self.obs_type == 'vector':
-            perceptual_loss = torch.tensor(0., device=batch['observations'].device,
-                                           dtype=batch['observations'].dtype)
+            perceptual_loss = self.perceptual_loss.to(batch['observations'].dtype)
 
             # Reconstruct observations from latent state representations
             # reconstructed_images = self.tokenizer.decode_to_obs(obs_embeddings.reshape(-1, self.embed_dim))
@@ -1364,8 +1930,7 @@ class WorldModel(nn.Module):
             latent_recon_loss = self.latent_recon_loss
 
         elif self.obs_type == 'text':
-            perceptual_loss = torch.tensor(0., device=batch['observations'].device,
-                                           dtype=torch.float32)
+            perceptual_loss = self.perceptual_loss
 
             # Reconstruct observations from latent state representations
             # reconstructed_images = self.tokenizer.decode_to_obs(obs_embeddings.reshape(-1, self.embed_dim))
@@ -1413,7 +1978,6 @@ class WorldModel(nn.Module):
                                                           percentage=self.dormant_threshold)
             self.past_kv_cache_recurrent_infer.clear()
             self.keys_values_wm_list.clear()
-            torch.cuda.empty_cache()
         else:
             dormant_ratio_world_model = torch.tensor(0.)
 
@@ -1442,46 +2006,43 @@ class WorldModel(nn.Module):
                                                                                            batch['mask_padding'])
 
         # Reshape the logits and labels for observations
-        logits_observations = rearrange(outputs.logits_observations[:, :-1], 'b t o -> (b t) o')
+        logits_observations = outputs.logits_observations[:, :-1].reshape(-1, outputs.logits_observations.shape[-1])
         labels_observations = labels_observations.reshape(-1, self.projection_input_dim)
 
         # Compute prediction loss for observations. Options: MSE and Group KL
-        if self.predict_latent_loss_type == 'mse':
-            # MSE loss, directly compare logits and labels
-            loss_obs = torch.nn.functional.mse_loss(logits_observations, labels_observations, reduction='none').mean(
-                -1)
-        elif self.predict_latent_loss_type == 'group_kl':
-            # Group KL loss, group features and calculate KL divergence within each group
-            batch_size, num_features = logits_observations.shape
-            epsilon = 1e-6
-            logits_reshaped = logits_observations.reshape(batch_size, self.num_groups, self.group_size) + epsilon
-            labels_reshaped = labels_observations.reshape(batch_size, self.num_groups, self.group_size) + epsilon
-
-            loss_obs = F.kl_div(logits_reshaped.log(), labels_reshaped, reduction='none').sum(dim=-1).mean(dim=-1)
-
-            #  ========== for debugging ==========
-            # print('loss_obs:', loss_obs.mean())
-            # assert not torch.isnan(loss_obs).any(), "loss_obs contains NaN values"
-            # assert not torch.isinf(loss_obs).any(), "loss_obs contains Inf values"
-            # for name, param in self.tokenizer.encoder.named_parameters():
-            #     print('name, param.mean(), param.std():', name, param.mean(), param.std())
+        mask_padding_expanded = batch['mask_padding'][:, 1:].reshape(-1)
+        masked_obs_loss = WorldModel._masked_obs_loss
+        if self.compile_obs_loss:
+            if WorldModel._compiled_masked_obs_loss is None:
+                WorldModel._compiled_masked_obs_loss = torch.compile(WorldModel._masked_obs_loss, dynamic=None)
+            masked_obs_loss = WorldModel._compiled_masked_obs_loss
+        loss_obs = masked_obs_loss(
+            logits_observations, labels_observations, mask_padding_expanded, self.predict_latent_loss_type,
+            self.num_groups, self.group_size
+        )
 
-        # Apply mask to loss_obs
-        mask_padding_expanded = batch['mask_padding'][:, 1:].contiguous().view(-1)
-        loss_obs = (loss_obs * mask_padding_expanded)
+        #  ========== for debugging ==========
+        # print('loss_obs:', loss_obs.mean())
+        # assert not torch.isnan(loss_obs).any(), "loss_obs contains NaN values"
+        # assert not torch.isinf(loss_obs).any(), "loss_obs contains Inf values"
+        # for name, param in self.tokenizer.encoder.named_parameters():
+        #     print('name, param.mean(), param.std():', name, param.mean(), param.std())
 
         # Compute labels for policy and value
         labels_policy, labels_value = self.compute_labels_world_model_value_policy(batch['target_value'],
                                                                                    batch['target_policy'],
                                                                                    batch['mask_padding'])
 
-        # Compute losses for rewards, policy, and value
-        loss_rewards = self.compute_cross_entropy_loss(outputs, labels_rewards, batch, element='rewards')
+        # Compute losses for rewards, policy, and value. The padding mask is flattened once for all of them.
+        mask_padding_flat = batch['mask_padding'].reshape(-1)
+        loss_rewards = self.compute_cross_entropy_loss(
+            outputs, labels_rewards, batch, element='rewards', mask_padding=mask_padding_flat
+        )
 
         if not self.continuous_action_space:
-            loss_policy, orig_policy_loss, policy_entropy = self.compute_cross_entropy_loss(outputs, labels_policy,
-                                                                                            batch,
-                                                                                            element='policy')
+            loss_policy, orig_policy_loss, policy_entropy = self.compute_cross_entropy_loss(
+                outputs, labels_policy, batch, element='policy', mask_padding=mask_padding_flat
+            )
         else:
             # NOTE: for continuous action space
             if self.config.policy_loss_type == 'simple':
@@ -1492,117 +2053,93 @@ class WorldModel(nn.Module):
             loss_policy = orig_policy_loss + self.policy_entropy_weight * policy_entropy_loss
             policy_entropy = - policy_entropy_loss
 
-        loss_value = self.compute_cross_entropy_loss(outputs, labels_value, batch, element='value')
+        loss_value = self.compute_cross_entropy_loss(
+            outputs, labels_value, batch, element='value', mask_padding=mask_padding_flat
+        )
 
         # ==== TODO: calculate the new priorities for each transition. ====
         # value_priority = L1Loss(reduction='none')(labels_value.squeeze(-1), outputs['logits_value'][:, 0])
         # value_priority = value_priority.data.cpu().numpy() + 1e-6
 
-        # Compute timesteps
-        timesteps = torch.arange(batch['actions'].shape[1], device=batch['actions'].device)
         # Compute discount coefficients for each timestep
-        discounts = self.gamma ** timesteps
+        discounts = self._discounts(batch['actions'].shape[1])
 
         if batch['mask_padding'].sum() == 0:
             assert False, "mask_padding is all zeros"
 
+        # The losses predicted from every timestep, stacked to (5, batch_size, seq_len) so that each statistic below
+        # is one reduction over all of them. The observation loss covers one step less and is handled on its own.
+        seq_len = batch['actions'].shape[1]
+        mask_padding = batch['mask_padding']
+        step_loss_names = ['loss_rewards', 'loss_value', 'loss_policy', 'orig_policy_loss', 'policy_entropy']
+        step_losses = torch.stack([
+            loss_tmp.view(-1, seq_len)
+            for loss_tmp in (loss_rewards, loss_value, loss_policy, orig_policy_loss, policy_entropy)
+        ])
+        loss_obs = loss_obs.view(-1, seq_len - 1)
+
         # Group losses into first step, middle step, and last step
-        first_step_losses = {}
-        middle_step_losses = {}
-        last_step_losses = {}
         # batch['mask_padding'] indicates mask status for future H steps, exclude masked losses to maintain accurate mean statistics
-        # Group losses for each loss item
-        for loss_name, loss_tmp in zip(
-                ['loss_obs', 'loss_rewards', 'loss_value', 'loss_policy', 'orig_policy_loss', 'policy_entropy'],
-                [loss_obs, loss_rewards, loss_value, loss_policy, orig_policy_loss, policy_entropy]
-        ):
-            if loss_name == 'loss_obs':
-                seq_len = batch['actions'].shape[1] - 1
-                # Get the corresponding mask_padding
-                mask_padding = batch['mask_padding'][:, 1:seq_len]
-            else:
-                seq_len = batch['actions'].shape[1]
-                # Get the corresponding mask_padding
-                mask_padding = batch['mask_padding'][:, :seq_len]
-
-            # Adjust loss shape to (batch_size, seq_len)
-            loss_tmp = loss_tmp.view(-1, seq_len)
-
-            # First step loss
-            first_step_mask = mask_padding[:, 0]
-            first_step_losses[loss_name] = loss_tmp[:, 0][first_step_mask].mean()
-
-            # Middle step loss
-            middle_timestep = seq_len // 2
-            middle_step_mask = mask_padding[:, middle_timestep]
-            middle_step_losses[loss_name] = loss_tmp[:, middle_timestep][middle_step_mask].mean()
-
-            # Last step loss
-            last_step_mask = mask_padding[:, -1]
-            last_step_losses[loss_name] = loss_tmp[:, -1][last_step_mask].mean()
+        obs_step_means = self._first_middle_last_means(loss_obs.unsqueeze(0), mask_padding[:, 1:seq_len - 1])[0]
+        step_means = self._first_middle_last_means(step_losses, mask_padding[:, :seq_len])
+        first_step_losses = {'loss_obs': obs_step_means[0]}
+        middle_step_losses = {'loss_obs': obs_step_means[1]}
+        last_step_losses = {'loss_obs': obs_step_means[2]}
+        for loss_name, means in zip(step_loss_names, step_means):
+            first_step_losses[loss_name], middle_step_losses[loss_name], last_step_losses[loss_name] = means
 
         # Discount reconstruction loss and perceptual loss
         discounted_latent_recon_loss = latent_recon_loss
         discounted_perceptual_loss = perceptual_loss
 
         # Calculate overall discounted loss
-        discounted_loss_obs = (loss_obs.view(-1, batch['actions'].shape[1] - 1) * discounts[1:]).sum()/ batch['mask_padding'][:,1:].sum()
-        discounted_loss_rewards = (loss_rewards.view(-1, batch['actions'].shape[1]) * discounts).sum()/ batch['mask_padding'].sum()
-        discounted_loss_value = (loss_value.view(-1, batch['actions'].shape[1]) * discounts).sum()/ batch['mask_padding'].sum()
-        discounted_loss_policy = (loss_policy.view(-1, batch['actions'].shape[1]) * discounts).sum()/ batch['mask_padding'].sum()
-        discounted_orig_policy_loss = (orig_policy_loss.view(-1, batch['actions'].shape[1]) * discounts).sum()/ batch['mask_padding'].sum()
-        discounted_policy_entropy = (policy_entropy.view(-1, batch['actions'].shape[1]) * discounts).sum()/ batch['mask_padding'].sum()
-
-        # Adaptive-span regularization
-        span_reg = torch.zeros((), device=discounted_loss_policy.device)
-        for block in self.transformer.blocks:
-            attn = block.attn
-            if isinstance(attn, AdaptiveSpanAttention):
-                # sum over all heads in this block
-                if self.config.adaptive_regularization == "l1":
-                    span_reg = span_reg + F.softplus(attn.span_p).sum()
-                elif self.config.adaptive_regularization == "l2":
-                    span_reg = span_reg + (F.softplus(attn.span_p) ** 2).sum()
-
-        reg_loss = self.config.adaptive_span_regularization * span_reg # O if not used
-        discounted_loss_policy = discounted_loss_policy + reg_loss
+        discounted_loss_obs = (loss_obs * discounts[1:]).sum() / mask_padding[:, 1:].sum()
+        discounted_step_losses = (step_losses * discounts).sum(dim=(1, 2)) / mask_padding.sum()
+        discounted_loss_rewards, discounted_loss_value, discounted_loss_policy, discounted_orig_policy_loss, \
+            discounted_policy_entropy = discounted_step_losses.unbind(0)
+
+        # The spans are computed once for the regularizers and the span logging. Without adaptive-span or GAAM
+        # blocks, or with zero coefficients, the corresponding regularizer is skipped.
+        spans = None
+        if self._adaptive_span_attns:
+            spans = F.softplus(torch.stack([attn.span_p for _, attn in self._adaptive_span_attns]))  # (blocks, nh)
+
+        # Adaptive-span regularization, over the spans of all adaptive-span blocks at once
+        if self.config.adaptive_span_regularization > 0 and spans is not None:
+            span_reg = None
+            # sum over all heads of all blocks
+            if self.config.adaptive_regularization == "l1":
+                span_reg = spans.sum()
+            elif self.config.adaptive_regularization == "l2":
+                span_reg = (spans ** 2).sum()
+            if span_reg is not None:
+                discounted_loss_policy = discounted_loss_policy + self.config.adaptive_span_regularization * span_reg
+
+        sigmas = mus = None
+        if self._gaam_attns:
+            # The raw widths and centers of all blocks go through one stack and one softplus.
+            gaam_params = F.softplus(torch.stack(
+                [param for _, attn in self._gaam_attns for param in (attn.sigma_p, attn.mu_p_raw)]
+            )).view(len(self._gaam_attns), 2, -1)  # (blocks, 2, nh)
+            sigmas = gaam_params[:, 0]  # (blocks, nh)
+            mus = torch.minimum(gaam_params[:, 1], self.gaam_max_lens)  # (blocks, nh)
 
         # GAAM span diversity regularization
-        if self.config.gaam_span_diversity_coeff > 0:
-            div_reg = 0.0
-            for block in self.transformer.blocks:
-                attn = block.attn
-                if isinstance(attn, GAAM):
-                    sigmas = F.softplus(attn.sigma_p)  # (nh,)
-                    mus = F.softplus(attn.mu_p_raw).clamp(max=attn.max_len)  # (nh,)
-                    H = sigmas.size(0)
-                    for i in range(H):
-                        for j in range(i + 1, H):
-                            s_i, s_j = sigmas[i], sigmas[j]
-                            m_i, m_j = mus[i], mus[j]
-                            # KL[N(m_i,s_i²) || N(m_j,s_j²)]
-                            kl_ij = 0.5 * (
-                                    (s_i ** 2) / (s_j ** 2)
-                                    + ((m_j - m_i) ** 2) / (s_j ** 2)
-                                    - 1
-                                    + 2 * (torch.log(s_j) - torch.log(s_i))
-                            )
-                            div_reg += kl_ij
-            discounted_loss_policy += self.config.gaam_span_diversity_coeff * div_reg
+        if self.config.gaam_span_diversity_coeff > 0 and sigmas is not None:
+            discounted_loss_policy = discounted_loss_policy + \
+                self.config.gaam_span_diversity_coeff * self._gaam_pairwise_kl(sigmas, mus)
 
-        # log span
+        # log span. The metrics stay on the device, so that the loss computation does not synchronize with the host
+        # for them; they are only moved to the host where they are actually logged.
         span_metrics = {}
-        for ℓ, block in enumerate(self.transformer.blocks):
-            attn = block.attn
-            if isinstance(attn, AdaptiveSpanAttention):
-                spans = F.softplus(attn.span_p).detach()  # tensor (nh,)
-                span_metrics[f"span_layer_{ℓ}"] = spans.cpu()
-            elif isinstance(attn, GAAM):
-                # only log them if the layers are GAAM
-                sigmas = F.softplus(attn.sigma_p).detach().cpu()
-                mus = F.softplus(attn.mu_p_raw).clamp(max=attn.max_len).detach().cpu()
-                span_metrics[f"gaam_sigma_layer_{ℓ}"] = sigmas
-                span_metrics[f"gaam_mu_layer_{ℓ}"] = mus
+        if spans is not None:
+            for (ℓ, _), layer_spans in zip(self._adaptive_span_attns, spans.detach()):
+                span_metrics[f"span_layer_{ℓ}"] = layer_spans  # tensor (nh,)
+        if sigmas is not None:
+            # only log them if the layers are GAAM
+            for (ℓ, _), layer_sigmas, layer_mus in zip(self._gaam_attns, sigmas.detach(), mus.detach()):
+                span_metrics[f"gaam_sigma_layer_{ℓ}"] = layer_sigmas
+                span_metrics[f"gaam_mu_layer_{ℓ}"] = layer_mus
 
         if self.continuous_action_space:
             return LossWithIntermediateLosses(
@@ -1667,9 +2204,9 @@ class WorldModel(nn.Module):
 
         # Get the policy logits and batch data
         policy_logits_all = outputs.logits_policy
-        mask_batch = batch['mask_padding'].contiguous().view(-1)
-        target_policy = batch['target_policy'].contiguous().view(batch_size * num_unroll_steps, -1)
-        target_sampled_actions = batch['child_sampled_actions'].contiguous().view(batch_size * num_unroll_steps, -1, action_space_size)
+        mask_batch = batch['mask_padding'].reshape(-1)
+        target_policy = batch['target_policy'].reshape(batch_size * num_unroll_steps, -1)
+        target_sampled_actions = batch['child_sampled_actions'].reshape(batch_size * num_unroll_steps, -1, action_space_size)
 
         # Flatten for vectorized computation
         policy_logits_all = policy_logits_all.view(batch_size * num_unroll_steps, -1)
@@ -1681,13 +2218,16 @@ class WorldModel(nn.Module):
         # Find the indices of the maximum values in the target policy
         target_best_action_idx = torch.argmax(target_policy, dim=1)
 
-        # Select the best actions based on the indices
-        target_best_action = target_sampled_actions[torch.arange(target_best_action_idx.size(0)), target_best_action_idx]
+        # Select the best actions based on the indices, with one gather along the sampled-action dimension
+        target_best_action = target_sampled_actions.gather(
+            1, target_best_action_idx.view(-1, 1, 1).expand(-1, 1, action_space_size)
+        ).squeeze(1)
 
         # Clip the target actions to prevent numerical issues during arctanh
         # target_best_action_clamped = torch.clamp(target_best_action, -1 + 1e-6, 1 - 1e-6)
-        target_best_action_clamped = torch.clamp(target_best_action, -0.999, 0.999)
-        target_best_action_before_tanh = torch.arctanh(target_best_action_clamped)
+        # The clamp returns a fresh tensor that requires no gradient, so arctanh runs in place on it instead of
+        # allocating a second (batch_size * num_unroll_steps, action_space_size) tensor.
+        target_best_action_before_tanh = torch.clamp(target_best_action, -0.999, 0.999).arctanh_()
 
         # Calculate the log probability of the best action
         log_prob_best_action = dist.log_prob(target_best_action_before_tanh)
@@ -1702,17 +2242,32 @@ class WorldModel(nn.Module):
         policy_entropy = dist.entropy().mean()
         policy_entropy_loss = -policy_entropy * mask_batch
         # Calculate the entropy of the target policy distribution
-        non_masked_indices = torch.nonzero(mask_batch).squeeze(-1)
-        if len(non_masked_indices) > 0:
-            target_normalized_visit_count = target_policy.contiguous().view(batch_size * num_unroll_steps, -1)
-            target_dist = Categorical(target_normalized_visit_count[non_masked_indices])
-            target_policy_entropy = target_dist.entropy().mean().item()
-        else:
-            target_policy_entropy = 0.0
+        # target_policy is already flattened to (batch_size * num_unroll_steps, num_sampled_actions) above.
+        target_policy_entropy = self._masked_categorical_entropy(target_policy, mask_batch)
 
         return policy_loss, policy_entropy_loss, target_policy_entropy, target_sampled_actions, mu, sigma
 
-    def _calculate_policy_loss_cont(self, outputs, batch: dict) -> Tuple[torch.Tensor, torch.Tensor, float, torch.Tensor, torch.Tensor, torch.Tensor]:
+    @staticmethod
+    def _masked_categorical_entropy(probs: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+        """
+        Overview:
+            The mean entropy of the categorical distributions given by the rows of ``probs`` over the unmasked rows, \
+            like ``Categorical(probs[mask]).entropy().mean()`` but without the host synchronization of the boolean \
+            indexing and without building a distribution. Without any unmasked row the entropy is 0.
+        Arguments:
+            - probs (:obj:`torch.Tensor`): Unnormalized probabilities, of shape (N, num_categories).
+            - mask (:obj:`torch.Tensor`): The mask of the rows, of shape (N,).
+        Returns:
+            - entropy (:obj:`torch.Tensor`): The mean entropy, a scalar tensor.
+        """
+        probs = probs / probs.sum(-1, keepdim=True)
+        # xlogy gives 0 for the categories of zero probability, like Categorical.entropy.
+        entropy = -torch.xlogy(probs, probs).sum(-1)
+        # The masked rows, e.g. all-zero padding targets whose entropy is NaN, are selected out rather than weighted.
+        mask = mask.bool()
+        return torch.where(mask, entropy, torch.zeros_like(entropy)).sum() / mask.sum().clamp_min(1)
+
+    def _calculate_policy_loss_cont(self, outputs, batch: dict) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
         """
         Calculate the policy loss for continuous actions.
 
@@ -1722,7 +2277,7 @@ class WorldModel(nn.Module):
         Returns:
             - policy_loss (:obj:`torch.Tensor`): The calculated policy loss.
             - policy_entropy_loss (:obj:`torch.Tensor`): The entropy loss of the policy.
-            - target_policy_entropy (:obj:`float`): The entropy of the target policy distribution.
+            - target_policy_entropy (:obj:`torch.Tensor`): The entropy of the target policy distribution, a scalar.
             - target_sampled_actions (:obj:`torch.Tensor`): The actions sampled from the target policy.
             - mu (:obj:`torch.Tensor`): The mean of the normal distribution.
             - sigma (:obj:`torch.Tensor`): The standard deviation of the normal distribution.
@@ -1737,19 +2292,19 @@ class WorldModel(nn.Module):
 
         # Flatten the unroll step dimension for easier vectorized operations
         policy_logits_all = policy_logits_all.view(batch_size * num_unroll_steps, -1)
-        mask_batch = mask_batch.contiguous().view(-1)
-        child_sampled_actions_batch = child_sampled_actions_batch.contiguous().view(batch_size * num_unroll_steps, -1,
-                                                                                    action_space_size)
+        mask_batch = mask_batch.reshape(-1)
+        child_sampled_actions_batch = child_sampled_actions_batch.reshape(batch_size * num_unroll_steps, -1,
+                                                                          action_space_size)
 
         mu, sigma = policy_logits_all[:, :action_space_size], policy_logits_all[:, action_space_size:]
-        mu = mu.unsqueeze(1).expand(-1, child_sampled_actions_batch.shape[1], -1)
-        sigma = sigma.unsqueeze(1).expand(-1, child_sampled_actions_batch.shape[1], -1)
-        dist = Independent(Normal(mu, sigma), 1)
+        log_sigma = torch.log(sigma)
 
-        target_normalized_visit_count = target_policy.contiguous().view(batch_size * num_unroll_steps, -1)
+        target_normalized_visit_count = target_policy.reshape(batch_size * num_unroll_steps, -1)
         target_sampled_actions = child_sampled_actions_batch
 
-        policy_entropy = dist.entropy().mean(dim=1)
+        # The entropy of Independent(Normal(mu, sigma), 1), which is the same for all sampled actions, computed in
+        # closed form on the (batch_size * num_unroll_steps, action_space_size) parameters.
+        policy_entropy = (log_sigma + 0.5 * (1.0 + math.log(2 * math.pi))).sum(-1)
         policy_entropy_loss = -policy_entropy * mask_batch
 
         # NOTE： Alternative way to calculate the log probability of the target actions
@@ -1760,13 +2315,18 @@ class WorldModel(nn.Module):
         # log_prob = log_prob - torch.log(y + 1e-6).sum(-1)
         # log_prob_sampled_actions = log_prob
 
-        base_dist = Normal(mu, sigma)
-        tanh_transform = TanhTransform()
-        dist = TransformedDistribution(base_dist, [tanh_transform])
-        dist = Independent(dist, 1)
+        # The log-probability of the sampled actions under Independent(TransformedDistribution(Normal(mu, sigma),
+        # [TanhTransform()]), 1), computed in closed form. mu and sigma broadcast over the sampled actions instead of
+        # being expanded, and no distribution objects (with their argument validation) are built per step.
         target_sampled_actions_clamped = torch.clamp(target_sampled_actions, -0.999, 0.999)
         # assert torch.all(target_sampled_actions_clamped < 1) and torch.all(target_sampled_actions_clamped > -1), "Actions are not properly clamped."
-        log_prob = dist.log_prob(target_sampled_actions_clamped)
+        # The inverse of the tanh transform, computed like TanhTransform does.
+        pre_tanh = 0.5 * (torch.log1p(target_sampled_actions_clamped) - torch.log1p(-target_sampled_actions_clamped))
+        z = (pre_tanh - mu.unsqueeze(1)) / sigma.unsqueeze(1)
+        # log|d tanh(x) / dx| in the numerically stable form of TanhTransform.log_abs_det_jacobian.
+        log_abs_det_jacobian = 2.0 * (math.log(2.0) - pre_tanh - F.softplus(-2.0 * pre_tanh))
+        log_prob = (-0.5 * z * z - log_abs_det_jacobian).sum(-1) \
+            - (log_sigma.sum(-1, keepdim=True) + 0.5 * action_space_size * math.log(2 * math.pi))
         log_prob_sampled_actions = log_prob
 
         # KL as projector
@@ -1776,54 +2336,83 @@ class WorldModel(nn.Module):
         ) * mask_batch
 
         # Calculate the entropy of the target policy distribution
-        non_masked_indices = torch.nonzero(mask_batch).squeeze(-1)
-        if len(non_masked_indices) > 0:
-            target_dist = Categorical(target_normalized_visit_count[non_masked_indices])
-            target_policy_entropy = target_dist.entropy().mean().item()
-        else:
-            target_policy_entropy = 0.0
+        target_policy_entropy = self._masked_categorical_entropy(target_normalized_visit_count, mask_batch)
 
+        # mu and sigma are returned per sampled action, as views, like the expanded parameters of the distribution.
+        num_sampled_actions = target_sampled_actions.shape[1]
+        mu = mu.unsqueeze(1).expand(-1, num_sampled_actions, -1)
+        sigma = sigma.unsqueeze(1).expand(-1, num_sampled_actions, -1)
         return policy_loss, policy_entropy_loss, target_policy_entropy, target_sampled_actions, mu, sigma
 
-    def compute_cross_entropy_loss(self, outputs, labels, batch, element='rewards'):
+    def compute_cross_entropy_loss(self, outputs, labels, batch, element='rewards', mask_padding=None):
         # Assume outputs is an object with logits attributes like 'rewards', 'policy', and 'value'.
         # labels is a target tensor for comparison. batch is a dictionary with a mask indicating valid timesteps.
+        # mask_padding optionally is the flattened mask of the batch, shared by the calls for the different elements.
 
         logits = getattr(outputs, f'logits_{element}')
 
-        if torch.isnan(logits).any():
+        if self.debug_nan_checks and torch.isnan(logits).any():
             raise ValueError(f"NaN detected in outputs for batch {batch} and element '{element}'")
         
-        if torch.isnan(labels).any():
+        if self.debug_nan_checks and torch.isnan(labels).any():
             raise ValueError(f"NaN detected in labels_value for batch {batch} and element '{element}'")
 
         # Reshape your tensors
-        logits = rearrange(logits, 'b t e -> (b t) e')
+        logits = logits.reshape(-1, logits.shape[-1])
         labels = labels.reshape(-1, labels.shape[-1])  # Assume labels initially have shape [batch, time, dim]
 
         # Reshape your mask. True indicates valid data.
-        mask_padding = rearrange(batch['mask_padding'], 'b t -> (b t)')
-
-        # Compute cross-entropy loss
-        loss = -(torch.log_softmax(logits, dim=1) * labels).sum(1)
-        loss = (loss * mask_padding)
-
-        if torch.isnan(loss).any():
+        if mask_padding is None:
+            mask_padding = batch['mask_padding'].reshape(-1)
+
+        # Compute cross-entropy loss, together with the policy entropy for the policy.
+        masked_cross_entropy = WorldModel._masked_cross_entropy
+        if self.compile_ce_loss:
+            if WorldModel._compiled_masked_cross_entropy is None:
+                WorldModel._compiled_masked_cross_entropy = torch.compile(WorldModel._masked_cross_entropy, dynamic=None)
+            masked_cross_entropy = WorldModel._compiled_masked_cross_entropy
+        loss, policy_entropy = masked_cross_entropy(logits, labels, mask_padding, element == 'policy')
+
+        if self.debug_nan_checks and torch.isnan(loss).any():
             raise ValueError(f"NaN detected in outputs for batch {batch} and element '{element}'")
 
         if element == 'policy':
-            # Compute policy entropy loss
-            policy_entropy = self.compute_policy_entropy_loss(logits, mask_padding)
             # Combine losses with specified weight
             combined_loss = loss - self.policy_entropy_weight * policy_entropy
             return combined_loss, loss, policy_entropy
 
         return loss
 
-    def compute_policy_entropy_loss(self, logits, mask):
-        # Compute entropy of the policy
-        probs = torch.softmax(logits, dim=1)
+    @staticmethod
+    def _masked_cross_entropy(logits: torch.Tensor, labels: torch.Tensor, mask_padding: torch.Tensor,
+                              with_entropy: bool) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        """
+        Overview:
+            The per-sample cross-entropy between the soft ``labels`` and ``softmax(logits)``, and optionally the \
+            entropy of ``softmax(logits)``, both zeroed at the padded samples. The log-probabilities are computed \
+            once for both. Kept free of Python-side handling so that it can be wrapped with ``torch.compile``.
+        Arguments:
+            - logits (:obj:`torch.Tensor`): The logits, of shape (N, num_classes).
+            - labels (:obj:`torch.Tensor`): The target distributions, of shape (N, num_classes).
+            - mask_padding (:obj:`torch.Tensor`): The mask of the valid samples, of shape (N,).
+            - with_entropy (:obj:`bool`): Whether to also compute the entropy.
+        Returns:
+            - loss (:obj:`torch.Tensor`): The masked cross-entropy, of shape (N,).
+            - entropy (:obj:`Optional[torch.Tensor]`): The masked entropy, of shape (N,), or None.
+        """
         log_probs = torch.log_softmax(logits, dim=1)
+        loss = -(log_probs * labels).sum(1) * mask_padding
+        entropy = None
+        if with_entropy:
+            entropy = -(log_probs.exp() * log_probs).sum(1) * mask_padding
+        return loss, entropy
+
+    def compute_policy_entropy_loss(self, logits, mask, log_probs=None):
+        # Compute entropy of the policy. The probabilities are derived from the log-probabilities, which the caller
+        # may pass in, instead of a second pass of softmax over the logits.
+        if log_probs is None:
+            log_probs = torch.log_softmax(logits, dim=1)
+        probs = log_probs.exp()
         entropy = -(probs * log_probs).sum(1)
         # Apply mask and return average entropy loss
         entropy_loss = (entropy * mask)
@@ -1835,11 +2424,10 @@ class WorldModel(nn.Module):
         mask_fill = torch.logical_not(mask_padding)
 
         # Prepare observation labels
-        labels_observations = obs_embeddings.contiguous().view(rewards.shape[0], -1, self.projection_input_dim)[:, 1:]
+        labels_observations = obs_embeddings.reshape(rewards.shape[0], -1, self.projection_input_dim)[:, 1:]
 
-        # Fill the masked areas of rewards
-        mask_fill_rewards = mask_fill.unsqueeze(-1).expand_as(rewards)
-        labels_rewards = rewards.masked_fill(mask_fill_rewards, -100)
+        # Fill the masked areas of rewards; masked_fill broadcasts the (batch, time, 1) mask over the support.
+        labels_rewards = rewards.masked_fill(mask_fill.unsqueeze(-1), -100)
 
         # Fill the masked areas of ends
         # labels_endgs = ends.masked_fill(mask_fill, -100)
@@ -1851,21 +2439,39 @@ class WorldModel(nn.Module):
     def compute_labels_world_model_value_policy(self, target_value: torch.Tensor, target_policy: torch.Tensor,
                                                 mask_padding: torch.BoolTensor) -> Tuple[torch.Tensor, torch.Tensor]:
         """ Compute labels for value and policy predictions. """
-        mask_fill = torch.logical_not(mask_padding)
-
-        # Fill the masked areas of policy
-        mask_fill_policy = mask_fill.unsqueeze(-1).expand_as(target_policy)
-        labels_policy = target_policy.masked_fill(mask_fill_policy, -100)
+        # The (batch, time, 1) mask is broadcast by masked_fill over the last dimension of the targets.
+        mask_fill = torch.logical_not(mask_padding).unsqueeze(-1)
 
         # Fill the masked areas of value
-        mask_fill_value = mask_fill.unsqueeze(-1).expand_as(target_value)
-        labels_value = target_value.masked_fill(mask_fill_value, -100)
+        labels_value = target_value.masked_fill(mask_fill, -100)
 
         if self.continuous_action_space:
+            # The policy labels are not used for continuous actions.
             return None, labels_value.reshape(-1, self.support_size)
         else:
+            # Fill the masked areas of policy
+            labels_policy = target_policy.masked_fill(mask_fill, -100)
             return labels_policy.reshape(-1, self.action_space_size), labels_value.reshape(-1, self.support_size)
 
+    def clear_cuda_graphs(self) -> None:
+        """
+        Overview:
+            Release the captured CUDA graphs, which are captured again on their next use. Graphs read the parameters \
+            and buffers at their addresses of capture time, so this is called whenever those storages may be \
+            replaced: by ``_apply`` (e.g. ``.to()``) and by ``load_state_dict``. Call it after assigning \
+            ``param.data`` directly.
+        """
+        if hasattr(self, '_cuda_graphs'):
+            self._cuda_graphs.clear()
+
+    def _apply(self, *args, **kwargs):
+        self.clear_cuda_graphs()
+        return super()._apply(*args, **kwargs)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self.clear_cuda_graphs()
+        return super()._load_from_state_dict(*args, **kwargs)
+
     def clear_caches(self):
         """
         Clears the caches of the world model.
@@ -463,10 +463,13 @@ class SampledUniZeroPolicy(UniZeroPolicy):
 
         batch_for_gpt['child_sampled_actions'] = child_sampled_actions_batch[:, :-1]
 
-        # Extract valid target policy data and compute entropy
-        valid_target_policy = batch_for_gpt['target_policy'][batch_for_gpt['mask_padding']]
-        target_policy_entropy = -torch.sum(valid_target_policy * torch.log(valid_target_policy + 1e-9), dim=-1)
-        average_target_policy_entropy = target_policy_entropy.mean().item()
+        # Compute the mean entropy of the valid target policies. The padded steps are selected out with torch.where
+        # instead of boolean indexing, whose data-dependent output size would synchronize with the device.
+        valid_mask = batch_for_gpt['mask_padding']
+        step_target_policy = batch_for_gpt['target_policy']
+        target_policy_entropy = -torch.sum(step_target_policy * torch.log(step_target_policy + 1e-9), dim=-1)
+        target_policy_entropy = torch.where(valid_mask, target_policy_entropy, torch.zeros_like(target_policy_entropy))
+        average_target_policy_entropy = target_policy_entropy.sum() / valid_mask.sum()
 
         # Update world model
         losses = self._learn_model.world_model.compute_loss(
@@ -480,20 +483,6 @@ class SampledUniZeroPolicy(UniZeroPolicy):
         for loss_name, loss_value in losses.intermediate_losses.items():
             self.intermediate_losses[f"{loss_name}"] = loss_value
 
-        obs_loss = self.intermediate_losses['loss_obs']
-        reward_loss = self.intermediate_losses['loss_rewards']
-        policy_loss = self.intermediate_losses['loss_policy']
-        value_loss = self.intermediate_losses['loss_value']
-        latent_recon_loss = self.intermediate_losses['latent_recon_loss']
-        perceptual_loss = self.intermediate_losses['perceptual_loss']
-        orig_policy_loss = self.intermediate_losses['orig_policy_loss']
-        policy_entropy = self.intermediate_losses['policy_entropy']
-        first_step_losses = self.intermediate_losses['first_step_losses']
-        middle_step_losses = self.intermediate_losses['middle_step_losses']
-        last_step_losses = self.intermediate_losses['last_step_losses']
-        dormant_ratio_encoder = self.intermediate_losses['dormant_ratio_encoder']
-        dormant_ratio_world_model = self.intermediate_losses['dormant_ratio_world_model']
-        latent_state_l2_norms = self.intermediate_losses['latent_state_l2_norms']
         policy_mu = self.intermediate_losses['policy_mu']
         policy_sigma = self.intermediate_losses['policy_sigma']
         target_sampled_actions = self.intermediate_losses['target_sampled_actions']
@@ -551,21 +540,40 @@ class SampledUniZeroPolicy(UniZeroPolicy):
             current_memory_allocated_gb = 0.
             max_memory_allocated_gb = 0.
 
+        # All scalar losses, and the target policy entropy, are moved to the host with a single transfer, instead of
+        # one .item() sync per value.
+        losses.intermediate_losses['target_policy_entropy'] = average_target_policy_entropy
+        intermediate_losses_cpu = losses.intermediate_losses_cpu
+        obs_loss = intermediate_losses_cpu['loss_obs']
+        reward_loss = intermediate_losses_cpu['loss_rewards']
+        policy_loss = intermediate_losses_cpu['loss_policy']
+        value_loss = intermediate_losses_cpu['loss_value']
+        latent_recon_loss = intermediate_losses_cpu['latent_recon_loss']
+        perceptual_loss = intermediate_losses_cpu['perceptual_loss']
+        orig_policy_loss = intermediate_losses_cpu['orig_policy_loss']
+        policy_entropy = intermediate_losses_cpu['policy_entropy']
+        first_step_losses = intermediate_losses_cpu['first_step_losses']
+        middle_step_losses = intermediate_losses_cpu['middle_step_losses']
+        last_step_losses = intermediate_losses_cpu['last_step_losses']
+        dormant_ratio_encoder = intermediate_losses_cpu['dormant_ratio_encoder']
+        dormant_ratio_world_model = intermediate_losses_cpu['dormant_ratio_world_model']
+        latent_state_l2_norms = intermediate_losses_cpu['latent_state_l2_norms']
+
         return_log_dict = {
-            'analysis/first_step_loss_value': first_step_losses['loss_value'].item(),
-            'analysis/first_step_loss_policy': first_step_losses['loss_policy'].item(),
-            'analysis/first_step_loss_rewards': first_step_losses['loss_rewards'].item(),
-            'analysis/first_step_loss_obs': first_step_losses['loss_obs'].item(),
+            'analysis/first_step_loss_value': first_step_losses['loss_value'],
+            'analysis/first_step_loss_policy': first_step_losses['loss_policy'],
+            'analysis/first_step_loss_rewards': first_step_losses['loss_rewards'],
+            'analysis/first_step_loss_obs': first_step_losses['loss_obs'],
 
-            'analysis/middle_step_loss_value': middle_step_losses['loss_value'].item(),
-            'analysis/middle_step_loss_policy': middle_step_losses['loss_policy'].item(),
-            'analysis/middle_step_loss_rewards': middle_step_losses['loss_rewards'].item(),
-            'analysis/middle_step_loss_obs': middle_step_losses['loss_obs'].item(),
+            'analysis/middle_step_loss_value': middle_step_losses['loss_value'],
+            'analysis/middle_step_loss_policy': middle_step_losses['loss_policy'],
+            'analysis/middle_step_loss_rewards': middle_step_losses['loss_rewards'],
+            'analysis/middle_step_loss_obs': middle_step_losses['loss_obs'],
 
-            'analysis/last_step_loss_value': last_step_losses['loss_value'].item(),
-            'analysis/last_step_loss_policy': last_step_losses['loss_policy'].item(),
-            'analysis/last_step_loss_rewards': last_step_losses['loss_rewards'].item(),
-            'analysis/last_step_loss_obs': last_step_losses['loss_obs'].item(),
+            'analysis/last_step_loss_value': last_step_losses['loss_value'],
+            'analysis/last_step_loss_policy': last_step_losses['loss_policy'],
+            'analysis/last_step_loss_rewards': last_step_losses['loss_rewards'],
+            'analysis/last_step_loss_obs': last_step_losses['loss_obs'],
 
             'Current_GPU': current_memory_allocated_gb,
             'Max_GPU': max_memory_allocated_gb,
@@ -579,7 +587,7 @@ class SampledUniZeroPolicy(UniZeroPolicy):
             'policy_loss': policy_loss,
             'orig_policy_loss': orig_policy_loss,
             'policy_entropy': policy_entropy,
-            'target_policy_entropy': average_target_policy_entropy,
+            'target_policy_entropy': intermediate_losses_cpu['target_policy_entropy'],
             'reward_loss': reward_loss,
             'value_loss': value_loss,
             'value_priority_orig': np.zeros(self._cfg.batch_size),  # TODO
@@ -19,8 +19,6 @@ from lzero.policy import scalar_transform, InverseScalarTransform, phi_transform
 from lzero.policy.muzero import MuZeroPolicy
 from .utils import configure_optimizers_nanogpt
 from ..model.unizero_world_models.attention_map import visualize_attention_maps
-from ..model.unizero_world_models.modeling.adaptive_attention import AdaptiveSpanAttention
-from ..model.unizero_world_models.modeling.gaam import GAAM
 
 
 @POLICY_REGISTRY.register('unizero')
@@ -109,6 +107,48 @@ class UniZeroPolicy(MuZeroPolicy):
                 support_size=101,
                 # (int) The maximum size of the cache.
                 max_cache_size=5000,
+                # (str) The storage dtype of the KV-cache snapshots kept for MCTS, e.g. 'bfloat16' to halve their memory
+                # and copy bandwidth. None keeps the default dtype.
+                kv_cache_dtype=None,
+                # (str) The storage dtype of the working KV caches that the attention reads and writes during inference,
+                # e.g. 'bfloat16' to halve the bandwidth of the cache gathers and trims. The attention still computes in
+                # the dtype of the model. When set, kv_cache_dtype defaults to it.
+                working_kv_cache_dtype=None,
+                # (bool) Whether to store the recurrent inference KV-cache snapshots as int8 with per-head scales, which
+                # quarters their memory and copy bandwidth at a small precision cost. Takes precedence over kv_cache_dtype
+                # for that pool.
+                kv_cache_quantize=False,
+                # (bool) Whether to compile the transformer and heads with torch.compile for inference (torch>=2.0).
+                # Training always runs eagerly.
+                compile_forward_core=False,
+                # (bool) Whether to compile the assembly of the interleaved obs/act sequence (action embedding, interleave and
+                # position embeddings) with torch.compile (torch>=2.0), for training and the reanalyze phase.
+                compile_obs_act_assembly=False,
+                # (bool) Whether to compile the masked latent-state prediction loss of training (MSE or group KL) with
+                # torch.compile (torch>=2.0), so that its elementwise chain runs as one fused kernel.
+                compile_obs_loss=False,
+                # (bool) Whether to compile the masked cross-entropy losses of training (reward, value and policy, with the
+                # policy entropy) with torch.compile (torch>=2.0), so that softmax, product, mask and sum run fused.
+                compile_ce_loss=False,
+                # (bool) Whether to replay the fixed-shape recurrent inference steps of MCTS from CUDA graphs, which removes
+                # the kernel launch overhead of small batches. Only used on CUDA devices.
+                cuda_graph_recurrent_step=False,
+                # (bool) Whether to also replay from CUDA graphs the batched resets of the environments whose KV cache was
+                # not found, i.e. the initial-inference passes that start from an empty cache. Only used on CUDA devices.
+                cuda_graph_miss_reset=False,
+                # (int) The maximum number of CUDA graphs kept by the world model. The least recently replayed graph is
+                # released when a new signature would exceed it. Miss-reset batches are padded to a power of two, so
+                # they add at most log2(env_num) + 1 signatures per cache size.
+                cuda_graph_max_graphs=32,
+                # (bool) Whether to process the previous action and the new observation of a continuing episode in one
+                # transformer pass at initial inference, instead of one pass for each. False keeps the two-pass path.
+                fuse_init_act_obs=True,
+                # (bool) Whether to check the logits, labels and losses of the cross-entropy losses for NaNs at every training
+                # step. Each check reads the whole tensor and synchronizes with the host, so it is meant for debugging.
+                debug_nan_checks=False,
+                # (int) The number of training steps between two loggings of the learned spans (span_metrics) returned by
+                # the world model loss. Each logging moves them to the host; the span regularizers apply at every step.
+                span_metrics_interval=1,
                 # (int) The number of environments.
                 env_num=8,
                 # (float) The weight of the latent reconstruction loss.
@@ -134,6 +174,10 @@ class UniZeroPolicy(MuZeroPolicy):
                 rope_theta=10000,
                 # (int) The maximum sequence length for position encoding.
                 max_seq_len=8192,
+                # (bool) Whether to keep the keys in the KV cache unrotated and apply RoPE by cache slot at attention time.
+                # RoPE scores only depend on position differences, so cached contexts then stay valid when they are
+                # re-padded, trimmed or reused at another absolute timestep. Only supported by causal attention.
+                rope_unrotated_kv_cache=False,
             ),
         ),
         # ****** common ******
@@ -437,10 +481,13 @@ class UniZeroPolicy(MuZeroPolicy):
         batch_for_gpt['target_value'] = target_value_categorical[:, :-1]
         batch_for_gpt['target_policy'] = target_policy[:, :-1]
 
-        # Extract valid target policy data and compute entropy
-        valid_target_policy = batch_for_gpt['target_policy'][batch_for_gpt['mask_padding']]
-        target_policy_entropy = -torch.sum(valid_target_policy * torch.log(valid_target_policy + 1e-9), dim=-1)
-        average_target_policy_entropy = target_policy_entropy.mean()
+        # Compute the mean entropy of the valid target policies. The padded steps are selected out with torch.where
+        # instead of boolean indexing, whose data-dependent output size would synchronize with the device.
+        valid_mask = batch_for_gpt['mask_padding']
+        step_target_policy = batch_for_gpt['target_policy']
+        target_policy_entropy = -torch.sum(step_target_policy * torch.log(step_target_policy + 1e-9), dim=-1)
+        target_policy_entropy = torch.where(valid_mask, target_policy_entropy, torch.zeros_like(target_policy_entropy))
+        average_target_policy_entropy = target_policy_entropy.sum() / valid_mask.sum()
 
         # Update world model and plots attention map
         plot_policy = (train_iter >= 20_000)
@@ -461,21 +508,6 @@ class UniZeroPolicy(MuZeroPolicy):
         for loss_name, loss_value in losses.intermediate_losses.items():
             self.intermediate_losses[f"{loss_name}"] = loss_value
 
-        obs_loss = self.intermediate_losses['loss_obs']
-        reward_loss = self.intermediate_losses['loss_rewards']
-        policy_loss = self.intermediate_losses['loss_policy']
-        value_loss = self.intermediate_losses['loss_value']
-        latent_recon_loss = self.intermediate_losses['latent_recon_loss']
-        perceptual_loss = self.intermediate_losses['perceptual_loss']
-        orig_policy_loss = self.intermediate_losses['orig_policy_loss']
-        policy_entropy = self.intermediate_losses['policy_entropy']
-        first_step_losses = self.intermediate_losses['first_step_losses']
-        middle_step_losses = self.intermediate_losses['middle_step_losses']
-        last_step_losses = self.intermediate_losses['last_step_losses']
-        dormant_ratio_encoder = self.intermediate_losses['dormant_ratio_encoder']
-        dormant_ratio_world_model = self.intermediate_losses['dormant_ratio_world_model']
-        latent_state_l2_norms = self.intermediate_losses['latent_state_l2_norms']
-
         assert not torch.isnan(losses.loss_total).any(), "Loss contains NaN values"
         assert not torch.isinf(losses.loss_total).any(), "Loss contains Inf values"
 
@@ -532,21 +564,40 @@ class UniZeroPolicy(MuZeroPolicy):
             current_memory_allocated_gb = 0.
             max_memory_allocated_gb = 0.
 
+        # All scalar losses, and the target policy entropy, are moved to the host with a single transfer, instead of
+        # one .item() sync per value.
+        losses.intermediate_losses['target_policy_entropy'] = average_target_policy_entropy
+        intermediate_losses_cpu = losses.intermediate_losses_cpu
+        obs_loss = intermediate_losses_cpu['loss_obs']
+        reward_loss = intermediate_losses_cpu['loss_rewards']
+        policy_loss = intermediate_losses_cpu['loss_policy']
+        value_loss = intermediate_losses_cpu['loss_value']
+        latent_recon_loss = intermediate_losses_cpu['latent_recon_loss']
+        perceptual_loss = intermediate_losses_cpu['perceptual_loss']
+        orig_policy_loss = intermediate_losses_cpu['orig_policy_loss']
+        policy_entropy = intermediate_losses_cpu['policy_entropy']
+        first_step_losses = intermediate_losses_cpu['first_step_losses']
+        middle_step_losses = intermediate_losses_cpu['middle_step_losses']
+        last_step_losses = intermediate_losses_cpu['last_step_losses']
+        dormant_ratio_encoder = intermediate_losses_cpu['dormant_ratio_encoder']
+        dormant_ratio_world_model = intermediate_losses_cpu['dormant_ratio_world_model']
+        latent_state_l2_norms = intermediate_losses_cpu['latent_state_l2_norms']
+
         return_log_dict = {
-            'analysis/first_step_loss_value': first_step_losses['loss_value'].item(),
-            'analysis/first_step_loss_policy': first_step_losses['loss_policy'].item(),
-            'analysis/first_step_loss_rewards': first_step_losses['loss_rewards'].item(),
-            'analysis/first_step_loss_obs': first_step_losses['loss_obs'].item(),
+            'analysis/first_step_loss_value': first_step_losses['loss_value'],
+            'analysis/first_step_loss_policy': first_step_losses['loss_policy'],
+            'analysis/first_step_loss_rewards': first_step_losses['loss_rewards'],
+            'analysis/first_step_loss_obs': first_step_losses['loss_obs'],
 
-            'analysis/middle_step_loss_value': middle_step_losses['loss_value'].item(),
-            'analysis/middle_step_loss_policy': middle_step_losses['loss_policy'].item(),
-            'analysis/middle_step_loss_rewards': middle_step_losses['loss_rewards'].item(),
-            'analysis/middle_step_loss_obs': middle_step_losses['loss_obs'].item(),
+            'analysis/middle_step_loss_value': middle_step_losses['loss_value'],
+            'analysis/middle_step_loss_policy': middle_step_losses['loss_policy'],
+            'analysis/middle_step_loss_rewards': middle_step_losses['loss_rewards'],
+            'analysis/middle_step_loss_obs': middle_step_losses['loss_obs'],
 
-            'analysis/last_step_loss_value': last_step_losses['loss_value'].item(),
-            'analysis/last_step_loss_policy': last_step_losses['loss_policy'].item(),
-            'analysis/last_step_loss_rewards': last_step_losses['loss_rewards'].item(),
-            'analysis/last_step_loss_obs': last_step_losses['loss_obs'].item(),
+            'analysis/last_step_loss_value': last_step_losses['loss_value'],
+            'analysis/last_step_loss_policy': last_step_losses['loss_policy'],
+            'analysis/last_step_loss_rewards': last_step_losses['loss_rewards'],
+            'analysis/last_step_loss_obs': last_step_losses['loss_obs'],
 
             'Current_GPU': current_memory_allocated_gb,
             'Max_GPU': max_memory_allocated_gb,
@@ -554,24 +605,24 @@ class UniZeroPolicy(MuZeroPolicy):
             'collect_epsilon': self._collect_epsilon,
             'cur_lr_world_model': self._optimizer_world_model.param_groups[0]['lr'],
             'weighted_total_loss': weighted_total_loss.item(),
-            'obs_loss': obs_loss.item(),
-            'latent_recon_loss': latent_recon_loss.item(),
-            'perceptual_loss': perceptual_loss.item(),
-            'policy_loss': policy_loss.item(),
-            'orig_policy_loss': orig_policy_loss.item(),
-            'policy_entropy': policy_entropy.item(),
-            'target_policy_entropy': average_target_policy_entropy.item(),
-            'reward_loss': reward_loss.item(),
-            'value_loss': value_loss.item(),
+            'obs_loss': obs_loss,
+            'latent_recon_loss': latent_recon_loss,
+            'perceptual_loss': perceptual_loss,
+            'policy_loss': policy_loss,
+            'orig_policy_loss': orig_policy_loss,
+            'policy_entropy': policy_entropy,
+            'target_policy_entropy': intermediate_losses_cpu['target_policy_entropy'],
+            'reward_loss': reward_loss,
+            'value_loss': value_loss,
             # 'value_priority_orig': np.zeros(self._cfg.batch_size),  # TODO
             'target_reward': target_reward.mean().item(),
             'target_value': target_value.mean().item(),
             'transformed_target_reward': transformed_target_reward.mean().item(),
             'transformed_target_value': transformed_target_value.mean().item(),
             'total_grad_norm_before_clip_wm': total_grad_norm_before_clip_wm.item(),
-            'analysis/dormant_ratio_encoder': dormant_ratio_encoder.item(),
-            'analysis/dormant_ratio_world_model': dormant_ratio_world_model.item(),
-            'analysis/latent_state_l2_norms': latent_state_l2_norms.item(),
+            'analysis/dormant_ratio_encoder': dormant_ratio_encoder,
+            'analysis/dormant_ratio_world_model': dormant_ratio_world_model,
+            'analysis/latent_state_l2_norms': latent_state_l2_norms,
             'analysis/l2_norm_before': self.l2_norm_before,
             'analysis/l2_norm_after': self.l2_norm_after,
             'analysis/grad_norm_before': self.grad_norm_before,
@@ -579,23 +630,21 @@ class UniZeroPolicy(MuZeroPolicy):
         }
 
 
-        # Adds learned spans
-        for layer_id, block in enumerate(self._learn_model.world_model.transformer.blocks):
-            attn = block.attn
-            if isinstance(attn, AdaptiveSpanAttention):
-                spans = F.softplus(attn.span_p).detach().cpu().tolist()
-                for head_id, span in enumerate(spans):
-                    return_log_dict[f"adaptive_span/layer_{layer_id}/head_{head_id}"] = float(span)
-
-        # Adds learned params for GAAM
-        for layer_id, block in enumerate(self._learn_model.world_model.transformer.blocks):
-            attn = block.attn
-            if isinstance(attn, GAAM):
-                sigmas = F.softplus(attn.sigma_p).detach().cpu().tolist()
-                mus = F.softplus(attn.mu_p_raw).clamp(max=attn.max_len).detach().cpu().tolist()
-                return_log_dict[f"gaam_sigma/layer_{layer_id}"] = wandb.Histogram(sigmas)
-                return_log_dict[f"gaam_mu/layer_{layer_id}"] = wandb.Histogram(mus)
-        
+        # Adds the learned spans and GAAM params returned by the world model loss every span_metrics_interval
+        # steps, moved to the host with one transfer for all layers
+        span_metrics = losses.intermediate_losses['span_metrics']
+        span_metrics_interval = max(int(self._cfg.model.world_model_cfg.get('span_metrics_interval', 1)), 1)
+        if span_metrics and train_iter % span_metrics_interval == 0:
+            span_values = torch.stack(list(span_metrics.values())).cpu().tolist()
+            for name, values in zip(span_metrics.keys(), span_values):
+                kind, layer_id = name.rsplit('_layer_', 1)
+                if kind == 'span':
+                    for head_id, span in enumerate(values):
+                        return_log_dict[f"adaptive_span/layer_{layer_id}/head_{head_id}"] = span
+                else:
+                    # gaam_sigma / gaam_mu
+                    return_log_dict[f"{kind}/layer_{layer_id}"] = wandb.Histogram(values)
+
         if self._cfg.use_wandb:
             wandb.log({'learner_step/' + k: v for k, v in return_log_dict.items()}, step=self.env_step)
             wandb.log({"learner_iter_vs_env_step": self.train_iter}, step=self.env_step)